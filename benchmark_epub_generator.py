@@ -0,0 +1,428 @@
+# encoding: utf-8
+import os
+import sys
+import json
+import time
+import random
+import struct
+import zlib
+import shutil
+import platform
+import functools
+import statistics
+import subprocess
+import yaml
+from epub_generator import DATA_DIR, SCRIPT_DIR, Utility, FileSystem, DateTimeHelper, BatchBase, Batch
+
+BENCHMARK_DIR = os.path.join(DATA_DIR, 'benchmark')
+
+
+class SyntheticBook(object):
+    '''
+    ベンチマーク用の電子書籍プロジェクト作成クラス（同じパラメータからは同じプロジェクトを作成する）
+    '''
+
+    # パラメータの初期値
+    # chapters: チャプター数／chapterSize: チャプターファイルのサイズ（KB）／simpleRules・regexRules: チャプター共通の置換設定の数
+    # images: 画像数／imageSize: 画像ファイルのサイズ（KB）／fanOut: 全チャプターを使用するコンテンツファイルの数
+    # transformMode: 本文データの置換方式／seed: 乱数のシード
+    DEFAULT_PARAMETERS = {
+        'chapters': 20,
+        'chapterSize': 16,
+        'simpleRules': 4,
+        'regexRules': 4,
+        'images': 4,
+        'imageSize': 64,
+        'fanOut': 1,
+        'transformMode': 'line',
+        'seed': 1,
+    }
+
+    # 本文データに使用する語句（置換設定にマッチする語句を含む）
+    WORDS = ['吾輩', 'は', '猫', 'である。', '名前', 'はまだ無い。', '「どこで生れたか', 'とんと見当がつかぬ」', '！？', '！！', '｜薄暗《うすぐら》い', '｜所《ところ》', '{$setting.title}', 'abc', '0123']
+
+    def __init__(self, dirpath, parameters=None):
+        '''
+        コンストラクタ
+        '''
+        self.dirpath = dirpath
+        self.parameters = dict(self.DEFAULT_PARAMETERS)
+        if parameters != None:
+            self.parameters.update(parameters)
+        self.random = random.Random(self.parameters['seed'])
+
+    def create(self):
+        '''
+        プロジェクト作成（設定ファイルのパスを返す）
+        '''
+        parameters = self.parameters
+        for dirname in ['chapter', 'image', 'template']:
+            FileSystem.create_directory(os.path.join(self.dirpath, dirname))
+
+        chapters = []
+        for index in range(parameters['chapters']):
+            filepath = os.path.join(self.dirpath, 'chapter', '{0:05d}.txt'.format(index + 1))
+            self.create_chapter_file(filepath, parameters['chapterSize'] * 1024)
+            chapters.append({'title': '第{0}話'.format(index + 1), 'fileType': 'text', 'filePath': './chapter/{0:05d}.txt'.format(index + 1)})
+
+        images = []
+        for index in range(parameters['images']):
+            filepath = os.path.join(self.dirpath, 'image', '{0:05d}.png'.format(index + 1))
+            self.create_png_file(filepath, parameters['imageSize'] * 1024)
+            images.append({'filePath': './image/{0:05d}.png'.format(index + 1), 'isCover': index == 0})
+
+        with open(os.path.join(self.dirpath, 'template', 'style.css'), 'w', encoding='utf-8') as f:
+            f.write('body { writing-mode: vertical-rl; }\n.tcu { text-combine-upright: all; }\n')
+            f.close()
+        with open(os.path.join(self.dirpath, 'template', 'navigation.xhtml'), 'w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">\n<head><title>{$setting.title}</title></head>\n<body>\n<nav epub:type="toc"><ol>\n{$foreach.chapters}<li><a href="{$chapter.filePath}">{$chapter.title}</a></li>\n{$endforeach}</ol></nav>\n</body>\n</html>\n')
+            f.close()
+        with open(os.path.join(self.dirpath, 'template', 'chapter.xhtml'), 'w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<html xmlns="http://www.w3.org/1999/xhtml">\n<head><title>{$setting.title}</title><link rel="stylesheet" type="text/css" href="{$setting.resources.styleSheets.1.filePath}" /></head>\n<body>\n<h1>{$chapter.title}</h1>\n<p>\n{$chapter.body}</p>\n</body>\n</html>\n')
+            f.close()
+
+        contents = [{'filePath': './template/navigation.xhtml', 'isNavigationContent': True, 'createByChaptersCount': False}]
+        use_chapters = [{'chapterIndex': index + 1} for index in range(parameters['chapters'])]
+        if len(use_chapters) > 0:
+            for index in range(parameters['fanOut']):
+                contents.append({'filePath': './template/chapter.xhtml', 'isNavigationContent': False, 'createByChaptersCount': True, 'useChapters': use_chapters})
+
+        settings = {
+            'bookId': '5a4ec2a4-4f5b-4a6e-9f44-6c59e6b5a0b1',
+            'language': 'ja-JP',
+            'modified': '2022-01-31T00:00:00Z',
+            'title': 'ベンチマーク',
+            'authorName': 'ベンチマーク',
+            'pageProgressionDirection': 'rtl',
+            'resources': {
+                'styleSheets': [{'filePath': './template/style.css'}],
+                'images': images,
+                'chapters': {
+                    'transformMode': parameters['transformMode'],
+                    'replaces': self.create_replaces(parameters['simpleRules'], parameters['regexRules']),
+                    'files': chapters,
+                },
+            },
+            'contents': contents,
+        }
+        setting_filepath = os.path.join(self.dirpath, 'setting.yaml')
+        with open(setting_filepath, 'w', encoding='utf-8') as f:
+            yaml.safe_dump(settings, f, allow_unicode=True, sort_keys=False)
+            f.close()
+        return setting_filepath
+
+    def create_replaces(self, simple_rules, regex_rules):
+        '''
+        置換設定作成（行をまたがない置換のみ）
+        '''
+        replaces = []
+        regex_patterns = [
+            (r'｜([^《]+)《([^》]+)》', r'<ruby>\1<rt>\2</rt></ruby>'),
+            (r'(！？|！！)', r'<span class="tcu">\1</span>'),
+            (r'([0-9]{2,4})', r'<span class="num">\1</span>'),
+            (r'「([^」]*)」', r'<span class="talk">「\1」</span>'),
+        ]
+        for index in range(regex_rules):
+            pattern, replace_content = regex_patterns[index % len(regex_patterns)]
+            if index >= len(regex_patterns):
+                # 同じパターンにならないように、マッチしない選択肢を追加する
+                pattern = '(?:ZZ{0}Z)?{1}'.format(index, pattern)
+            replaces.append({'type': 'regex', 'placeHolder': pattern, 'replaceContent': replace_content})
+        simple_words = ['吾輩', '名前', 'abc', 'どこで']
+        for index in range(simple_rules):
+            word = simple_words[index % len(simple_words)]
+            if index >= len(simple_words):
+                word = '{0}{1}'.format(word, index)
+            replaces.append({'type': 'simple', 'placeHolder': word, 'replaceContent': '<em>{0}</em>'.format(word)})
+        return replaces
+
+    def create_chapter_file(self, filepath, size):
+        '''
+        チャプターファイル作成（指定したサイズ程度のテキスト）
+        '''
+        lines = []
+        total_size = 0
+        while total_size < size:
+            line = ''.join(self.random.choice(self.WORDS) for index in range(self.random.randint(4, 24))) + '\n'
+            lines.append(line)
+            total_size += len(line.encode('utf-8'))
+        with open(filepath, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(''.join(lines))
+            f.close()
+
+    def create_png_file(self, filepath, size):
+        '''
+        PNGファイル作成（指定したサイズ程度のノイズ画像）
+        '''
+        # NOTE: ノイズはほとんど圧縮されないため、画素数からファイルサイズが決まる
+        width = 256
+        height = max(1, size // (width * 3))
+        rows = []
+        for y in range(height):
+            rows.append(b'\x00' + self.random.randbytes(width * 3))
+        data = zlib.compress(b''.join(rows))
+
+        def chunk(chunk_type, chunk_data):
+            return struct.pack('>I', len(chunk_data)) + chunk_type + chunk_data + struct.pack('>I', zlib.crc32(chunk_type + chunk_data))
+
+        with open(filepath, 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n')
+            f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+            f.write(chunk(b'IDAT', data))
+            f.write(chunk(b'IEND', b''))
+            f.close()
+
+
+class Benchmark(BatchBase):
+    '''
+    ベンチマーククラス（合成した電子書籍プロジェクトからepubファイルを作成し、処理時間等をJSONファイルに出力する）
+    '''
+
+    # 処理時間を計測するBatchの処理（build()から呼び出す順）
+    STAGES = [
+        'load_setting_file',
+        'open_epub',
+        'load_previous_epub',
+        'create_mimetype',
+        'create_meta_inf_container_xml',
+        'deploy_resource_files',
+        'find_reusable_contents',
+        'load_chapter_files',
+        'create_oebps_content_files',
+        'create_oebps_book_opf',
+        'create_epub',
+    ]
+
+    # ケースのプリセット（名前 => パラメータのリスト）
+    PRESETS = {
+        'quick': [{}],
+        'chapters': [{'chapters': count} for count in [10, 100, 1000]],
+        'chapterSize': [{'chapters': 10, 'chapterSize': size} for size in [64, 1024, 8192]],
+        'rules': [{'simpleRules': count, 'regexRules': count} for count in [0, 8, 32, 128]],
+        'images': [{'images': count, 'imageSize': 256} for count in [0, 50, 200]],
+        'fanOut': [{'chapters': 100, 'fanOut': count} for count in [1, 4, 16]],
+    }
+
+    def __init__(self):
+        '''
+        コンストラクタ
+        '''
+        batch_name = 'epub generator benchmark'
+        description = '合成した電子書籍プロジェクトでepubファイル作成の処理時間・メモリ使用量を計測する'
+        set_argument_settings = []
+        set_argument_settings.append({'short_name': '-p', 'long_name': '--presets', 'destination': 'presets', 'required': False, 'default_value': 'quick', 'help': 'ケースのプリセット（カンマ区切り、all: quick以外の全て）: {0}'.format(', '.join(self.PRESETS.keys()))})
+        set_argument_settings.append({'short_name': '-c', 'long_name': '--case', 'destination': 'case', 'required': False, 'default_value': '', 'help': '個別に指定するケースのパラメータ（例: chapters=500,chapterSize=64）'})
+        set_argument_settings.append({'short_name': '-x', 'long_name': '--options', 'destination': 'options', 'required': False, 'default_value': '', 'help': 'epubファイル作成のパラメータ（例: "-j 0 -t 0"）'})
+        set_argument_settings.append({'short_name': '-r', 'long_name': '--repeat', 'destination': 'repeat', 'required': False, 'default_value': '1', 'help': 'ケースごとの実行回数'})
+        set_argument_settings.append({'short_name': '-o', 'long_name': '--output_file', 'destination': 'output_file', 'required': False, 'default_value': '', 'help': '結果を出力するJSONファイルのパス'})
+        set_argument_settings.append({'short_name': '-b', 'long_name': '--baseline_file', 'destination': 'baseline_file', 'required': False, 'default_value': '', 'help': '比較する結果のJSONファイルのパス'})
+        set_argument_settings.append({'short_name': '-w', 'long_name': '--work_dir', 'destination': 'work_dir', 'required': False, 'default_value': '', 'help': '電子書籍プロジェクトを作成するディレクトリ'})
+        set_argument_settings.append({'short_name': '-k', 'long_name': '--keep', 'destination': 'keep', 'required': False, 'default_value': '0', 'help': '作成した電子書籍プロジェクトを残すか'})
+        super(Benchmark, self).__init__(batch_name, description, set_argument_settings)
+
+    def main(self, args):
+        '''
+        メイン処理
+        '''
+        self.args = args
+
+        cases = self.get_cases()
+        options = self.args.options.split()
+        try:
+            repeat = int(self.args.repeat)
+        except ValueError:
+            raise BatchBase.BatchException('実行回数の指定が不正です。 {0}'.format(self.args.repeat))
+        if repeat < 1:
+            raise BatchBase.BatchException('実行回数の指定が不正です。 {0}'.format(self.args.repeat))
+
+        work_dir = os.path.abspath(self.args.work_dir) if not Utility.is_empty(self.args.work_dir) else os.path.join(BENCHMARK_DIR, 'work')
+        output_file = self.args.output_file
+        if Utility.is_empty(output_file):
+            output_file = os.path.join(BENCHMARK_DIR, 'result_{0}.json'.format(DateTimeHelper.now().strftime('%Y%m%d%H%M%S')))
+
+        results = []
+        for name, parameters in cases:
+            case_dir = os.path.join(work_dir, name)
+            if os.path.exists(case_dir):
+                shutil.rmtree(case_dir)
+            self.info_log('ケース作成 - {0}'.format(name))
+            setting_filepath = SyntheticBook(case_dir, parameters).create()
+            runs = []
+            for count in range(repeat):
+                run = self.run_case(setting_filepath, os.path.join(case_dir, 'book.epub'), options)
+                if run['returnCode'] != int(BatchBase.ReturnCode.NormalEnd):
+                    raise BatchBase.BatchException('epubファイルの作成に失敗しました。 {0} {1}'.format(name, run.get('message', '')))
+                runs.append(run)
+            result = {
+                'name': name,
+                'parameters': SyntheticBook(case_dir, parameters).parameters,
+                'options': options,
+                'runs': runs,
+                'wall': statistics.median([run['wall'] for run in runs]),
+                'peakRss': max([run['peakRss'] for run in runs]) if runs[0]['peakRss'] != None else None,
+                'outputSize': runs[-1]['outputSize'],
+            }
+            results.append(result)
+            self.info_log('ケース実行 - {0}: {1:.3f}秒'.format(name, result['wall']))
+            if self.args.keep != '1':
+                shutil.rmtree(case_dir)
+
+        report = {
+            'environment': self.get_environment(),
+            'results': results,
+        }
+        FileSystem.create_directory(os.path.dirname(os.path.abspath(output_file)))
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+            f.close()
+        self.info_log('結果出力 - {0}'.format(output_file))
+
+        baseline = None
+        if not Utility.is_empty(self.args.baseline_file):
+            try:
+                with open(self.args.baseline_file, 'r', encoding='utf-8') as f:
+                    baseline = {result['name']: result for result in json.load(f)['results']}
+                    f.close()
+            except Exception as e:
+                raise BatchBase.BatchException('比較する結果の読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
+        self.output_results(results, baseline)
+
+    def get_cases(self):
+        '''
+        ケースの一覧（名前, パラメータ）取得
+        '''
+        cases = []
+        presets = [preset.strip() for preset in self.args.presets.split(',') if preset.strip() != '']
+        if 'all' in presets:
+            presets = [preset for preset in self.PRESETS if preset != 'quick']
+        for preset in presets:
+            if not preset in self.PRESETS:
+                raise BatchBase.BatchException('プリセットの指定が不正です。 {0}'.format(preset))
+            for parameters in self.PRESETS[preset]:
+                cases.append((self.get_case_name(preset, parameters), parameters))
+        if not Utility.is_empty(self.args.case):
+            parameters = {}
+            for item in self.args.case.split(','):
+                key, separator, value = item.partition('=')
+                key = key.strip()
+                if separator == '' or not key in SyntheticBook.DEFAULT_PARAMETERS:
+                    raise BatchBase.BatchException('ケースのパラメータの指定が不正です。 {0}'.format(item))
+                if type(SyntheticBook.DEFAULT_PARAMETERS[key]) is int:
+                    try:
+                        value = int(value)
+                    except ValueError:
+                        raise BatchBase.BatchException('ケースのパラメータの指定が不正です。 {0}'.format(item))
+                parameters[key] = value
+            cases.append((self.get_case_name('case', parameters), parameters))
+        return cases
+
+    @classmethod
+    def get_case_name(cls, prefix, parameters):
+        '''
+        ケース名取得
+        '''
+        if len(parameters) == 0:
+            return prefix
+        return '{0}-{1}'.format(prefix, '-'.join(['{0}{1}'.format(key, parameters[key]) for key in parameters]))
+
+    @classmethod
+    def run_case(cls, setting_filepath, output_filepath, options):
+        '''
+        ケース実行（最大メモリ使用量をケースごとに計測するため、別プロセスで実行する）
+        '''
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), 'case', setting_filepath, output_filepath, json.dumps(options)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            return json.loads(process.stdout.decode('utf-8').strip().splitlines()[-1])
+        except (ValueError, IndexError):
+            return {'returnCode': int(BatchBase.ReturnCode.AbnormalEnd), 'message': process.stderr.decode('utf-8', 'replace')}
+
+    @classmethod
+    def execute_case(cls, setting_filepath, output_filepath, options):
+        '''
+        epubファイル作成（ケース実行のプロセスで実行する）
+        '''
+        batch = Batch()
+        stages = {}
+
+        def measure(name, method, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                stages[name] = stages.get(name, 0) + time.perf_counter() - start
+
+        # NOTE: build()から呼び出す処理をインスタンスの属性で置き換えて計測する
+        for name in cls.STAGES:
+            setattr(batch, name, functools.partial(measure, name, getattr(batch, name)))
+
+        # NOTE: チャプターキャッシュは指定がない限り使用しない
+        argv = ['-i', setting_filepath, '-o', output_filepath, '-s', '1', '-c', '0'] + options
+        start = time.perf_counter()
+        return_code = batch.execute(argv)
+        wall = time.perf_counter() - start
+
+        return {
+            'returnCode': return_code,
+            'wall': wall,
+            'stages': stages,
+            'peakRss': cls.get_peak_rss(),
+            'outputSize': FileSystem.get_file_size(output_filepath) if FileSystem.exists_file(output_filepath) else None,
+        }
+
+    @classmethod
+    def get_peak_rss(cls):
+        '''
+        プロセスの最大メモリ使用量（バイト、取得できない場合はNone）
+        '''
+        try:
+            import resource
+        except ImportError:
+            return None
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # NOTE: macOSはバイト、それ以外はKB
+        if sys.platform == 'darwin':
+            return peak_rss
+        return peak_rss * 1024
+
+    @classmethod
+    def get_environment(cls):
+        '''
+        実行環境の情報
+        '''
+        commit = None
+        try:
+            process = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SCRIPT_DIR or '.', stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            if process.returncode == 0:
+                commit = process.stdout.decode('utf-8').strip()
+        except OSError:
+            pass
+        return {
+            'date': DateTimeHelper.now().strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpuCount': os.cpu_count(),
+        }
+
+    def output_results(self, results, baseline=None):
+        '''
+        結果の一覧出力（比較する結果がある場合は処理時間の比率も出力する）
+        '''
+        self.info_log('実行結果:')
+        self.info_log('{0:<48}  {1:>9}  {2:>9}  {3:>10}  {4}'.format('Case', 'Time(s)', 'RSS(MB)', 'Output(MB)', 'Baseline'))
+        for result in results:
+            peak_rss = '-' if result['peakRss'] == None else '{0:.1f}'.format(result['peakRss'] / 1024 / 1024)
+            ratio = ''
+            if baseline != None and result['name'] in baseline and baseline[result['name']]['wall'] > 0:
+                ratio = 'x{0:.2f}'.format(result['wall'] / baseline[result['name']]['wall'])
+            self.info_log('{0:<48}  {1:>9.3f}  {2:>9}  {3:>10.2f}  {4}'.format(result['name'], result['wall'], peak_rss, result['outputSize'] / 1024 / 1024, ratio))
+
+
+if __name__ == '__main__':
+    argv = sys.argv
+    del argv[0]
+    # ケース実行（Benchmark.run_case()から起動する）
+    if len(argv) > 0 and argv[0] == 'case':
+        print(json.dumps(Benchmark.execute_case(argv[1], argv[2], json.loads(argv[3]))))
+        exit(0)
+    exit(Benchmark().execute(argv))
@@ -0,0 +1,67 @@
+# encoding: utf-8
+import os
+import sys
+import json
+import socket
+
+# NOTE: 起動を速くするため、epub_generator.pyはインポートしない（ソケットファイルのパスは作成サーバーと同じ）
+SCRIPT_DIR = os.path.split(os.path.abspath(__file__))[0]
+SOCKET_PATH = os.path.join(SCRIPT_DIR, 'data', 'epub_generator.sock')
+
+# 作成サーバーに接続できない場合の戻り値（BatchBase.ReturnCode.AbnormalEnd）
+ABNORMAL_END = 2
+
+
+class BuildClient(object):
+    '''
+    作成サーバーのクライアントクラス（epub_generator.pyと同じパラメータで作成を依頼し、同じ戻り値を返す）
+    '''
+
+    @classmethod
+    def send(cls, socket_path, request):
+        '''
+        作成依頼の送信（結果を返す）
+        '''
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(socket_path)
+            connection.sendall(json.dumps(request, ensure_ascii=False).encode('utf-8') + b'\n')
+            with connection.makefile('rb') as f:
+                data = f.readline()
+        if len(data) == 0:
+            raise ConnectionError('作成サーバーから結果を受信できませんでした。')
+        return json.loads(data.decode('utf-8'))
+
+    @classmethod
+    def execute(cls, argv):
+        '''
+        実行（-u: ソケットファイルのパス、--stop: 作成サーバーの停止、それ以外のパラメータはそのまま作成サーバーに渡す）
+        '''
+        argv = list(argv)
+        socket_path = SOCKET_PATH
+        request = {'command': 'build', 'argv': [], 'currentDirectory': os.getcwd()}
+        while len(argv) > 0:
+            value = argv.pop(0)
+            if value in ['-u', '--socket'] and len(argv) > 0:
+                socket_path = argv.pop(0)
+            elif value.startswith('--socket='):
+                socket_path = value[len('--socket='):]
+            elif value == '--stop':
+                request = {'command': 'stop'}
+                break
+            else:
+                request['argv'].append(value)
+
+        try:
+            response = cls.send(socket_path, request)
+        except (OSError, ValueError) as e:
+            print('作成サーバーへの依頼中にエラーが発生しました。 {0}'.format(e), file=sys.stderr)
+            return ABNORMAL_END
+        if len(response.get('message') or '') > 0:
+            print(response['message'], file=sys.stderr)
+        return int(response['returnCode'])
+
+
+if __name__ == '__main__':
+    argv = sys.argv
+    del argv[0]
+    exit(BuildClient.execute(argv))
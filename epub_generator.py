@@ -12,18 +12,41 @@ import traceback
 import mimetypes
 import logging
 import inspect
-from argparse import ArgumentError, ArgumentParser
+from argparse import ArgumentError, ArgumentParser, Namespace
 from uuid import uuid4
 from datetime import datetime, timedelta
 import xml.dom.minidom
 import linecache
 import time
 import uuid
-import xml.etree.ElementTree as ET
+import io
+import zlib
+import functools
+import operator
+import concurrent.futures
+import collections
+import struct
+import glob
+import multiprocessing
+import hashlib
+import threading
+import json
+import contextlib
+import copy
+import tracemalloc
+import socket
+import socketserver
+import signal
 
 SCRIPT_DIR = os.path.split(__file__)[0]
 DATA_DIR = os.path.join(SCRIPT_DIR, 'data')
 LOG_DIR = os.path.join(DATA_DIR, 'log')
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+# 作成サーバーのソケットファイル
+SOCKET_PATH = os.path.join(DATA_DIR, 'epub_generator.sock')
+
+# str.splitlines()が行の区切りとして扱う文字（\nを除く）
+LINE_BREAK_REGEX = re.compile('\r\n|[\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
 
 
 class Utility(object):
@@ -223,6 +246,18 @@ class Convert(object):
         else:
             return value
 
+    @classmethod
+    def normalize_line_breaks(cls, value):
+        '''
+        改行を\nに統一し、末尾を改行で終わらせる（str.splitlines()で分割した各行に改行を付けて連結した結果と同じになる）
+        '''
+        if Utility.is_empty(value):
+            return value
+        value = LINE_BREAK_REGEX.sub('\n', value)
+        if not value.endswith('\n'):
+            value = value + '\n'
+        return value
+
     @classmethod
     def get_pretty_xml(cls, data):
         '''
@@ -231,6 +266,92 @@ class Convert(object):
         return '\n'.join([line for line in xml.dom.minidom.parseString(data.strip()).toprettyxml().split('\n') if line.strip()])
 
 
+class XmlWriter(object):
+    '''
+    XML書き込みクラス（要素を順に直接書き込み、インデントする場合はConvert.get_pretty_xml()と同じ形式で出力する）
+    '''
+
+    def __init__(self, write, indent='\t'):
+        '''
+        コンストラクタ（indent: インデントの文字列。Noneの場合は改行・インデントしない）
+        '''
+        self.write = write
+        self.indent = indent
+        self.newline = '\n' if indent != None else ''
+        # 書き込み中の要素の階層
+        self.depth = 0
+        # 開始タグを閉じていない（子要素をまだ書き込んでいない）か
+        self.pending = False
+        write('<?xml version="1.0" ?>')
+
+    @classmethod
+    def escape(cls, value):
+        '''
+        テキストのエスケープ（改行はXMLの解析時と同じく\nに統一する）
+        '''
+        value = value.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+        if value.find('\r') != -1:
+            value = value.replace('\r\n', '\n').replace('\r', '\n')
+        return value
+
+    @classmethod
+    def escape_attribute(cls, value):
+        '''
+        属性値のエスケープ（改行・タブは文字参照にする）
+        '''
+        value = value.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+        return value.replace('\n', '&#10;').replace('\r', '&#13;').replace('\t', '&#9;')
+
+    def open_tag(self, tag, attributes):
+        '''
+        開始タグ（閉じる前まで）の文字列作成（親要素の開始タグを閉じる）
+        '''
+        if self.pending:
+            self.write('>')
+            self.pending = False
+        data = [self.newline, self.indent * self.depth if self.indent != None else '', '<', tag]
+        if attributes != None:
+            for name, value in attributes.items():
+                # NOTE: ElementTreeと同じく、値のない属性は出力せずエラーにする
+                if value == None:
+                    raise TypeError('cannot serialize None (attribute: {0})'.format(name))
+                data.append(' {0}="{1}"'.format(name, self.escape_attribute(str(value))))
+        return ''.join(data)
+
+    def start(self, tag, attributes=None):
+        '''
+        子要素を持つ要素の開始（子要素がない場合は空要素になる）
+        '''
+        self.write(self.open_tag(tag, attributes))
+        self.pending = True
+        self.depth += 1
+
+    def end(self, tag):
+        '''
+        子要素を持つ要素の終了
+        '''
+        self.depth -= 1
+        if self.pending:
+            self.write('/>')
+            self.pending = False
+            return
+        self.write('{0}{1}</{2}>'.format(self.newline, self.indent * self.depth if self.indent != None else '', tag))
+
+    def element(self, tag, attributes=None, text=None):
+        '''
+        テキストのみを持つ要素（テキストがない場合は空要素）の書き込み
+        '''
+        data = self.open_tag(tag, attributes)
+        if Utility.is_empty(text):
+            self.write(data + '/>')
+            return
+        data = '{0}>{1}</{2}>'.format(data, self.escape(str(text)), tag)
+        if self.indent != None and data.find('\n', 1) != -1:
+            # 空白のみの行は出力しない（Convert.get_pretty_xml()と同じ）
+            data = '\n' + '\n'.join([line for line in data[1:].split('\n') if line.strip()])
+        self.write(data)
+
+
 class DateTimeHelper(datetime):
     '''
     日付時刻ヘルパクラス
@@ -352,343 +473,2710 @@ class DateTimeHelper(datetime):
             return False
 
 
-class BatchBase(object):
+class ReplaceRules(object):
     '''
-    バッチ基底クラス
+    置換ルールクラス（コンパイル済み・変更不可）
     '''
 
-    debug = False
-    stdout_silent = False
+    __slots__ = ('rules', 'operations', 'line_local')
 
-    class BatchException(Exception):
+    # 行をまたがない正規表現として許可するエスケープ（\nは末尾のみ別途許可する）
+    LINE_LOCAL_ESCAPES = 'dwbB123456789'
+
+    def __init__(self, rules=()):
         '''
-        バッチ例外
+        コンストラクタ
         '''
-        pass
+        # rulesは実行順に並んだ（type, placeHolder, replaceContent）のタプル
+        rules = tuple(rules)
+        operations = []
+        line_local = True
+        for replace_type, place_holder, replace_content in rules:
+            if replace_type == 'regex':
+                pattern = re.compile(place_holder)
+                operations.append(functools.partial(pattern.sub, replace_content))
+            else:
+                pattern = None
+                operations.append(operator.methodcaller('replace', place_holder, replace_content))
+            if line_local and not self.is_line_local_rule(replace_type, place_holder, replace_content, pattern):
+                line_local = False
+        object.__setattr__(self, 'rules', rules)
+        object.__setattr__(self, 'operations', tuple(operations))
+        object.__setattr__(self, 'line_local', line_local)
 
-    class ReturnCode(IntEnum):
+    def __setattr__(self, name, value):
+        raise AttributeError('ReplaceRules is immutable.')
+
+    def __reduce__(self):
+        return (self.__class__, (self.rules,))
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __add__(self, other):
         '''
-        戻り値
+        置換ルールの連結（selfの置換の後にotherの置換を実行する）
         '''
-        NormalEnd = 0
-        WarningEnd = 1
-        AbnormalEnd = 2
+        return self.__class__(self.rules + other.rules)
 
-    def __init__(self, batch_name, description, argument_settings, log_file_name='', debug=False, stdout_silent=False):
+    @classmethod
+    def compile(cls, replaces):
         '''
-        コンストラクタ
+        置換設定のリストから置換ルールを作成する
         '''
-        # パラメータチェック
-        if Utility.is_empty(batch_name):
-            batch_name = 'Unknown batch'
-        if Utility.is_empty(description):
-            description = 'Nothing'
-
-        keys = [
-            'short_name',
-            'long_name',
-            'destination',
-            'default_value',
-            'help'
-        ]
-        for argument_setting in argument_settings:
-            for key in keys:
-                if not key in argument_setting:
-                    raise Exception('パラメータ{0}は必須です。'.format(key))
-
-        # バッチ名
-        self.batch_name = batch_name
+        if replaces == None or len(replaces) == 0:
+            return cls()
 
-        # パラメータ
-        self.parser = ArgumentParser(description=description)
-        for argument_setting in argument_settings:
-            short_name = None
-            if 'short_name' in argument_setting:
-                short_name = argument_setting['short_name']
-            long_name = None
-            if 'long_name' in argument_setting:
-                long_name = argument_setting['long_name']
-            destination = None
-            if 'destination' in argument_setting:
-                destination = argument_setting['destination']
-            required = False
-            if 'required' in argument_setting:
-                required = argument_setting['required']
-            default_value = None
-            if 'default_value' in argument_setting:
-                default_value = argument_setting['default_value']
-            help = None
-            if 'help' in argument_setting:
-                help = argument_setting['help']
-            self.parser.add_argument(short_name, long_name, dest=destination, required=required, default=default_value, help=help)
+        simple_rules = []
+        regex_rules = []
 
-        # デフォルトのパラメータ設定
-        self.parser.add_argument('-d', '--debug', dest='debug', required=False, default='0', help='デバッグ')
-        self.parser.add_argument('-s', '--silent', dest='silent', required=False, default='0', help='標準出力にログを出力するか')
+        for replace in replaces:
+            # YAMLで記載を省略するとNoneになるケースがあるため、置換データを補正する
+            replace_content = replace['replaceContent']
+            if replace_content == None:
+                replace_content = ''
 
-        # ログファイル名決定
-        if Utility.is_empty(log_file_name):
-            frame = inspect.stack()[1]
-            module = inspect.getmodule(frame[0])
-            log_file_name = os.path.basename(module.__file__) + '.log'
-        FileSystem.create_directory(LOG_DIR)
-        log_file_path = os.path.join(LOG_DIR, log_file_name)
+            # シンプル／正規表現タイプの検索／置換セットを追加する
+            if 'type' in replace:
+                if replace['type'] == 'simple':
+                    simple_rules.append(('simple', replace['placeHolder'], replace_content))
+                elif replace['type'] == 'regex':
+                    regex_rules.append(('regex', replace['placeHolder'], replace_content))
+            else:
+                simple_rules.append(('simple', replace['placeHolder'], replace_content))
 
-        # ------------------------------
-        # ログ設定
-        # ------------------------------
-        log_level = logging.INFO
-        if self.debug:
-            log_level = logging.DEBUG
-        log_format = '%(asctime)s- %(name)s - %(levelname)s - %(message)s'
-        self.log0 = logging.getLogger(self.parser.prog)
-        self.log0.setLevel(log_level)
+        # 最初に正規表現での置換、次に単純置換を実行する
+        return cls(regex_rules + simple_rules)
 
-        # 標準出力ログ（パラメータで非表示可能）
-        if not self.stdout_silent:
-            self.sh = logging.StreamHandler()
-            self.sh.setLevel(log_level)
-            self.sh.setFormatter(logging.Formatter(log_format))
-            self.log0.addHandler(self.sh)
+    @classmethod
+    def is_line_local_rule(cls, replace_type, place_holder, replace_content='', pattern=None):
+        '''
+        行単位で置換しても文書全体を一度に置換しても結果が変わらない置換かどうか（判定できない場合はFalse）
+        '''
+        if replace_type != 'regex':
+            return LINE_BREAK_REGEX.search(place_holder) == None and place_holder.find('\n') == -1 and cls.is_line_local_content(replace_content, False)
+
+        # 改行にマッチし得る、または行の前後を参照し得る要素を含むパターンは対象外とする
+        line_end = False
+        in_class = False
+        index = 0
+        length = len(place_holder)
+        while index < length:
+            char = place_holder[index]
+            if char == '\\':
+                escaped = place_holder[index + 1:index + 2]
+                if escaped == 'n' and index + 2 == length and not in_class:
+                    # 末尾の\nは各行の終端の改行にのみマッチする
+                    line_end = True
+                elif escaped.isalnum() and cls.LINE_LOCAL_ESCAPES.find(escaped) == -1:
+                    return False
+                elif escaped == '' or ord(escaped) < 0x20 or LINE_BREAK_REGEX.match(escaped):
+                    return False
+                index += 2
+                continue
+            if ord(char) < 0x20 or LINE_BREAK_REGEX.match(char) or char == '^' or char == '$':
+                return False
+            if in_class:
+                if char == ']':
+                    in_class = False
+            elif char == '[':
+                if place_holder[index + 1:index + 2] in ('^', ']'):
+                    return False
+                in_class = True
+            elif char == '(' and place_holder[index + 1:index + 2] == '?':
+                if not place_holder[index + 2:index + 3] == ':' and not place_holder[index + 2:index + 4] in ('P<', 'P='):
+                    return False
+            index += 1
+
+        # 行末（改行の直後）で空文字にマッチするパターンは対象外とする
+        if pattern == None:
+            pattern = re.compile(place_holder)
+        if pattern.match('\n', 1) != None:
+            return False
 
-        # ファイル出力ログ
-        self.fh = logging.FileHandler(filename=log_file_path, encoding='utf-8')
-        self.fh.setLevel(log_level)
-        self.fh.setFormatter(logging.Formatter(log_format))
-        self.log0.addHandler(self.fh)
+        # 置換後の文字列で改行を削除／追加する置換は対象外とする
+        # NOTE: 後方参照はマッチした文字列によらず判定できないため空文字として展開する（\g<0>で改行を残す置換も対象外になる）
+        try:
+            names = {index: name for name, index in pattern.groupindex.items()}
+            template = re.compile(''.join(['(?P<{0}>)'.format(names[index]) if index in names else '()' for index in range(1, pattern.groups + 1)]))
+            replace_content = template.match('').expand(replace_content)
+        except (re.error, IndexError):
+            return False
+        return cls.is_line_local_content(replace_content, line_end)
 
-    def main(self, args):
+    @classmethod
+    def is_line_local_content(cls, replace_content, line_end):
         '''
-        メイン処理（継承クラスにて実装）
+        置換後の文字列が行の区切りを変えないか（line_end: 行末の改行を置換する場合は同じ改行で終わること）
         '''
-        raise NotImplementedError()
+        if LINE_BREAK_REGEX.search(replace_content) != None:
+            return False
+        if line_end:
+            return replace_content.endswith('\n') and replace_content.count('\n') == 1
+        return replace_content.find('\n') == -1
 
-    def execute(self, argv=[]):
+    def apply(self, content):
         '''
-        バッチ実行
+        置換実行
         '''
-        try:
-            # パラメータ取得
-            args = self.parser.parse_args(args=argv)
-            self.debug = args.debug == '1'
-            self.stdout_silent = args.silent == '1'
-
-            if self.stdout_silent:
-                if 'sh' in vars(self):
-                    self.sh.close()
-                    self.log0.removeHandler(self.sh)
+        if Utility.is_empty(content):
+            return content
+        for operation in self.operations:
+            content = operation(content)
+        return content
 
-            # メイン処理呼び出し
-            self.info_log('-' * 50)
-            self.info_log('{0} 処理開始'.format(self.batch_name))
 
-            self.main(args)
-            self.info_log('{0} 正常終了'.format(self.batch_name))
+class SettingRecord(object):
+    '''
+    設定値のレコードの基底クラス
+    （値は__slots__の属性で保持し、設定値の参照・プレースホルダの置換では辞書と同じくキーで参照する）
+    '''
 
-            # 戻り値（正常終了）
-            return int(BatchBase.ReturnCode.NormalEnd)
+    __slots__ = ()
 
-        except BatchBase.BatchException as e:
-            # 継承クラスでBatchExceptionがスローされたら警告終了
-            self.error_log(e)
-            self.info_log('{0} 警告終了'.format(self.batch_name))
-            return int(BatchBase.ReturnCode.WarningEnd)
+    # 設定ファイルのキー => 属性名
+    FIELDS = {}
+    # 設定値ではない属性（キーで参照できるが、keys／inの対象外）
+    INTERNAL_FIELDS = {}
 
-        except Exception as e:
-            # 継承クラスでExceptionがスローされたら異常終了
-            self.error_log(e)
-            self.info_log('{0} 異常終了'.format(self.batch_name))
-            self.info_log('{0}'.format(traceback.format_exc()))
-            return int(BatchBase.ReturnCode.AbnormalEnd)
+    def __init__(self, values=None):
+        '''
+        コンストラクタ
+        '''
+        if values != None:
+            for key in values:
+                self[key] = values[key]
 
-    def debug_log(self, message):
+    def __getitem__(self, key):
         '''
-        デバッグログ出力
+        キーで値を取得する（未設定の場合はKeyError）
         '''
-        self.log0.debug(message)
+        name = self.FIELDS.get(key)
+        if name == None:
+            name = self.INTERNAL_FIELDS.get(key)
+        if name == None or not hasattr(self, name):
+            raise KeyError(key)
+        return getattr(self, name)
+
+    def __setitem__(self, key, value):
+        '''
+        キーで値を設定する
+        '''
+        name = self.FIELDS.get(key)
+        if name == None:
+            name = self.INTERNAL_FIELDS.get(key)
+        if name == None:
+            raise KeyError(key)
+        setattr(self, name, value)
+
+    def __contains__(self, key):
+        '''
+        設定値のキーがあるか
+        '''
+        return key in self.FIELDS and hasattr(self, self.FIELDS[key])
 
-    def info_log(self, message):
+    def __iter__(self):
         '''
-        インフォメーションログ出力
+        設定値のキーを列挙する
         '''
-        self.log0.info(message)
+        return iter(self.keys())
 
-    def warning_log(self, message):
+    def __len__(self):
         '''
-        ワーニングログ出力
+        設定値の件数
         '''
-        self.log0.warning(message)
+        return len(self.keys())
 
-    def error_log(self, message):
+    def __repr__(self):
         '''
-        エラーログ出力
+        文字列表現
         '''
-        self.log0.error(message)
+        return '{0}({1})'.format(self.__class__.__name__, dict(self.items()))
 
-    def critical_log(self, message):
+    def keys(self):
         '''
-        クリティカルエラーログ出力
+        設定値のキーの一覧
         '''
-        self.log0.critical(message)
+        return [key for key in self.FIELDS if hasattr(self, self.FIELDS[key])]
 
-    def exception_info(self):
+    def items(self):
         '''
-        例外情報取得
+        設定値のキーと値の一覧
         '''
-        exc_type, exc_obj, tb = sys.exc_info()
-        if tb != None:
-            f = tb.tb_frame
-            lineno = tb.tb_lineno
-            filename = f.f_code.co_filename
-            
-            linecache.checkcache(filename)
-            line = linecache.getline(filename, lineno, f.f_globals)
-        
-            return 'Exception in ({0}, line {1} "{2}"): {3}'.format(filename, lineno, line.strip(), exc_obj)
-        else:
-            return 'Exception in unknown'
+        return [(key, self[key]) for key in self.keys()]
 
-    def __del__(self):
+    def get(self, key, default=None):
         '''
-        デストラクタ
+        キーで値を取得する（未設定の場合はdefault）
         '''
-        if not self.stdout_silent:
-            if 'sh' in vars(self):
-                self.sh.close()
-                self.log0.removeHandler(self.sh)
-        if 'fh' in vars(self):
-            self.fh.close()
-            self.log0.removeHandler(self.fh)
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
 
-class Batch(BatchBase):
+class ResourceRecord(SettingRecord):
     '''
-    バッチクラス
+    リソース（スタイルシート／画像）の設定値（設定ファイルに記載された他のキーはextraで保持する）
     '''
 
-    args = None
-    setting_yaml_dirpath = ''
-    settings = {}
-    replaces = {}
-    chapters = []
-    contents = []
-    work_dir = ''
-    mimetype_filepath = ''
-    oebps_dirpath = ''
-    oebps_resources_dirpath = ''
-    oebps_contents_dirpath = ''
+    __slots__ = ('file_path', 'manifest_file_path', 'setting_file_path', 'is_cover', 'extra')
 
-    def __init__(self):
+    FIELDS = {
+        'filePath': 'file_path',
+        'manifestFilePath': 'manifest_file_path',
+        'settingFilePath': 'setting_file_path',
+        'isCover': 'is_cover',
+    }
+
+    def __getitem__(self, key):
         '''
-        コンストラクタ
+        キーで値を取得する（未設定の場合はKeyError）
         '''
-        batch_name = 'Epub generator'
-        description = '設定ファイルに基づいてepubファイルを作成します。'
-        set_argument_settings = []
-        set_argument_settings.append({'short_name': '-i', 'long_name': '--input_setting_file', 'destination': 'input_setting_file', 'required': True, 'default_value': '', 'help': '設定ファイルのパス'})
-        set_argument_settings.append({'short_name': '-o', 'long_name': '--output_file', 'destination': 'output_file', 'required': True, 'default_value': '', 'help': '出力ファイルのパス'})
-        super(Batch, self).__init__(batch_name, description, set_argument_settings)
+        if not key in self.FIELDS and hasattr(self, 'extra'):
+            return self.extra[key]
+        return super(ResourceRecord, self).__getitem__(key)
 
-    def main(self, args):
+    def __setitem__(self, key, value):
         '''
-        メイン処理
+        キーで値を設定する
         '''
-        self.args = args
+        if key in self.FIELDS:
+            super(ResourceRecord, self).__setitem__(key, value)
+            return
+        if not hasattr(self, 'extra'):
+            self.extra = {}
+        self.extra[key] = value
+
+    def __contains__(self, key):
+        '''
+        設定値のキーがあるか
+        '''
+        if not key in self.FIELDS:
+            return hasattr(self, 'extra') and key in self.extra
+        return super(ResourceRecord, self).__contains__(key)
 
-        # パラメータ出力
-        self.info_log('設定ファイル: {0}'.format(self.args.input_setting_file))
-        self.info_log('出力ファイル: {0}'.format(self.args.output_file))
-        if self.args.debug == '1':
-            self.info_log('デバッグ: ON')
+    def keys(self):
+        '''
+        設定値のキーの一覧
+        '''
+        keys = super(ResourceRecord, self).keys()
+        if hasattr(self, 'extra'):
+            keys.extend(self.extra.keys())
+        return keys
 
-        # デバッグ
-        if self.args.debug == '1':
-            self.debug = True
 
-        # ファイルチェック
-        if Utility.is_empty(self.args.input_setting_file):
-            raise BatchBase.BatchException('設定ファイルを指定してください。')
-        if not FileSystem.exists_file(self.args.input_setting_file):
-            raise BatchBase.BatchException('設定ファイルが見つかりません。')
+class ChapterRecord(SettingRecord):
+    '''
+    チャプターの設定値（本文データはbodyで保持し、コンテンツファイル作成時に読み込み、書き込み後に解放する）
+    '''
 
-        # 作業ディレクトリ作成
-        self.work_dir = FileSystem.create_temp_directory()
+    __slots__ = ('title', 'file_type', 'file_path', 'manifest_file_path', 'setting_file_path', 'bind_content', 'replaces', 'body')
+
+    FIELDS = {
+        'title': 'title',
+        'fileType': 'file_type',
+        'filePath': 'file_path',
+        'manifestFilePath': 'manifest_file_path',
+        'settingFilePath': 'setting_file_path',
+        'bindContent': 'bind_content',
+        'replaces': 'replaces',
+    }
+    INTERNAL_FIELDS = {
+        'body': 'body',
+    }
+
+    def __init__(self, values=None):
+        '''
+        コンストラクタ
+        '''
+        self.body = None
+        super(ChapterRecord, self).__init__(values)
+
+    def __getstate__(self):
+        '''
+        pickle化する状態（本文データはワーカープロセスに渡さない）
+        '''
+        state = {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+        state['body'] = None
+        return (None, state)
+
+
+class ContentRecord(SettingRecord):
+    '''
+    コンテンツの設定値
+    '''
+
+    __slots__ = ('file_path', 'manifest_file_path', 'setting_file_path', 'is_navigation_content', 'use_navigation_content', 'create_by_chapters_count', 'use_chapters', 'replaces', 'bind_chapter', 'bind_chapter_index', 'spine_hidden')
+
+    FIELDS = {
+        'filePath': 'file_path',
+        'manifestFilePath': 'manifest_file_path',
+        'settingFilePath': 'setting_file_path',
+        'isNavigationContent': 'is_navigation_content',
+        'useNavigationContent': 'use_navigation_content',
+        'createByChaptersCount': 'create_by_chapters_count',
+        'useChapters': 'use_chapters',
+        'replaces': 'replaces',
+        'bindChapter': 'bind_chapter',
+        'bindChapterIndex': 'bind_chapter_index',
+        'spineHidden': 'spine_hidden',
+    }
+
+
+class SettingResolver(object):
+    '''
+    設定値置換クラス（{$setting.xxxx}形式のプレースホルダを設定値で置換する）
+    '''
+
+    PLACE_HOLDER_REGEX = re.compile(r'\{\$setting\.([^{}]*)\}')
+
+    def __init__(self, settings):
+        '''
+        コンストラクタ
+        '''
+        self.settings = settings
+        # プレースホルダのパス => 置換後の文字列（未定義の場合はNone）
+        self.values = {}
+        # 置換したプレースホルダのパス（setを設定した場合のみ記録する）
+        self.accessed = None
+
+    def resolve(self, content):
+        '''
+        コンテンツ中のプレースホルダを設定値で置換する（未定義のプレースホルダはそのまま残す）
+        '''
+        if Utility.is_empty(content) or content.find('{$setting.') == -1:
+            return content
+        return self.PLACE_HOLDER_REGEX.sub(self.replace_place_holder, content)
+
+    def replace_place_holder(self, match):
+        '''
+        プレースホルダ1件分の置換文字列取得
+        '''
+        value = self.lookup(match.group(1))
+        if value == None:
+            return match.group(0)
+        return value
+
+    def lookup(self, path):
+        '''
+        プレースホルダのパスの置換文字列取得（未定義の場合はNone）
+        '''
+        if self.accessed != None:
+            self.accessed.add(path)
+        if path in self.values:
+            return self.values[path]
+        value = self.get_value(path)
+        self.values[path] = value
+        return value
+
+    def get_value(self, path):
+        '''
+        ドット区切りのパス（配列は1から始まるインデックス）で指定された設定値を文字列で取得する（未定義の場合はNone）
+        '''
+        return self.find_value(self.settings, path.split('.'), 0)
+
+    def find_value(self, data, keys, index):
+        '''
+        設定値を再帰的に検索する
+        '''
+        if index == len(keys):
+            if type(data) is dict or type(data) is list or type(data) is tuple or isinstance(data, SettingRecord):
+                return None
+            if data == None:
+                return ''
+            return str(data)
+
+        if type(data) is dict or isinstance(data, SettingRecord):
+            # キー自体にドットを含む場合も考慮し、長いキーから順に検索する
+            for end in range(len(keys), index, -1):
+                key = '.'.join(keys[index:end])
+                if key in data:
+                    value = self.find_value(data[key], keys, end)
+                    if value != None:
+                        return value
+            return None
+        elif type(data) is list or type(data) is tuple:
+            key = keys[index]
+            if key.isascii() and key.isdigit() and key[0] != '0' and int(key) <= len(data):
+                return self.find_value(data[int(key) - 1], keys, index + 1)
+            return None
+        else:
+            return None
+
+
+class ContentTemplate(object):
+    '''
+    コンテンツテンプレートクラス（テンプレートを固定文字列とプレースホルダのセグメントに分解し、1回の走査で出力する）
+    プレースホルダ: {$setting.xxxx}／{$chapter.title}／{$chapter.body}／{$chapter.filePath}
+    ループ: {$foreach.chapters}～{$endforeach}（全チャプター分繰り返す。ループ内では{$chapter.body}以外のチャプターのプレースホルダを使用できる）
+    '''
+
+    PLACE_HOLDER_REGEX = re.compile(r'\{\$setting\.([^{}]*)\}|\{\$chapter\.(title|body|filePath)\}|\{\$(foreach\.chapters|endforeach)\}')
+
+    # セグメントの種類
+    TEXT = 0
+    SETTING = 1
+    CHAPTER = 2
+    FOREACH = 3
+
+    def __init__(self, content):
+        '''
+        コンストラクタ（テンプレートの解析に失敗した場合はValueError）
+        '''
+        # テンプレート中の設定値のプレースホルダのパス
+        self.setting_paths = set()
+        # 全チャプターのループがあるか
+        self.has_loop = False
+        self.segments = self.parse(content)
+
+    def parse(self, content):
+        '''
+        テンプレートをセグメント（種類, 値）のリストに分解する（ループの値はループ内のセグメントのリスト）
+        '''
+        segments = []
+        stack = []
+        position = 0
+        for match in self.PLACE_HOLDER_REGEX.finditer(content):
+            if match.start() > position:
+                segments.append((self.TEXT, content[position:match.start()]))
+            position = match.end()
+            if match.group(1) != None:
+                segments.append((self.SETTING, match.group(1)))
+                self.setting_paths.add(match.group(1))
+            elif match.group(2) != None:
+                if match.group(2) == 'body' and len(stack) > 0:
+                    raise ValueError('ループ内で{$chapter.body}は使用できません。')
+                segments.append((self.CHAPTER, match.group(2)))
+            elif match.group(3) == 'foreach.chapters':
+                if len(stack) > 0:
+                    raise ValueError('ループは入れ子にできません。')
+                stack.append(segments)
+                segments = []
+            else:
+                if len(stack) == 0:
+                    raise ValueError('{$foreach.chapters}がない{$endforeach}があります。')
+                loop_segments = segments
+                segments = stack.pop()
+                segments.append((self.FOREACH, loop_segments))
+                self.has_loop = True
+        if len(stack) > 0:
+            raise ValueError('{$foreach.chapters}に対応する{$endforeach}がありません。')
+        if position < len(content):
+            segments.append((self.TEXT, content[position:]))
+        return segments
+
+    def render(self, write, setting_resolver, chapter=None, chapters=()):
+        '''
+        出力（本文データは連結せずにそのまま書き込み、それ以外は連結してから書き込む）
+        チャプターを紐づけていない場合、ループ外のチャプターのプレースホルダはそのまま残す
+        '''
+        parts = []
+        self.render_segments(self.segments, write, parts, setting_resolver, chapter, chapters)
+        if len(parts) > 0:
+            write(''.join(parts))
+
+    def render_segments(self, segments, write, parts, setting_resolver, chapter, chapters):
+        '''
+        セグメントのリストを出力する
+        '''
+        for kind, value in segments:
+            if kind == self.TEXT:
+                parts.append(value)
+            elif kind == self.SETTING:
+                data = setting_resolver.lookup(value)
+                if data == None:
+                    data = '{$setting.' + value + '}'
+                parts.append(data)
+            elif kind == self.CHAPTER:
+                if chapter == None:
+                    parts.append('{$chapter.' + value + '}')
+                elif value == 'title':
+                    parts.append(chapter['title'] if chapter['title'] != None else '')
+                elif value == 'filePath':
+                    parts.append(chapter['filePath'])
+                else:
+                    if len(parts) > 0:
+                        write(''.join(parts))
+                        parts.clear()
+                    # NOTE: 本文データ中の{$chapter.filePath}もチャプターのファイルパスで置換する
+                    filepath = chapter['filePath']
+                    for data in chapter['body']:
+                        write(data.replace('{$chapter.filePath}', filepath))
+            else:
+                for loop_chapter in chapters:
+                    self.render_segments(value, write, parts, setting_resolver, loop_chapter, chapters)
+
+
+class ChapterTransformer(object):
+    '''
+    チャプター変換クラス（チャプターファイルを読み込み、置換した本文データを作成する）
+    '''
+
+    # 本文データを連結する単位（文字数）
+    BODY_CHUNK_SIZE = 1024 * 1024
+
+    # ワーカープロセスで使用するインスタンス（プロセスプールのinitializerで設定する）
+    worker_transformer = None
+
+    def __init__(self, setting_resolver, chapter_replace_rules=None, source_files=None):
+        '''
+        コンストラクタ
+        '''
+        self.setting_resolver = setting_resolver
+        # チャプター毎の置換ルール（ワーカープロセスではチャプターのインデックスで参照する）
+        if chapter_replace_rules == None:
+            chapter_replace_rules = []
+        self.chapter_replace_rules = chapter_replace_rules
+        # メモリ上のファイル（ファイルパス => 内容）
+        if source_files == None:
+            source_files = {}
+        self.source_files = source_files
+
+    @classmethod
+    def open_source(cls, filepath, source_files):
+        '''
+        テキストファイルを開く（メモリ上のファイルの場合は、ファイルを開いた場合と同じく改行をLFにして読み込む）
+        '''
+        if not filepath in source_files:
+            return open(filepath, 'r', encoding='utf-8')
+        data = source_files[filepath]
+        if type(data) is bytes:
+            return io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+        return io.StringIO(data, newline=None)
+
+    def transform(self, filepath, replace_rules, transform_mode='line'):
+        '''
+        チャプターファイルを読み込み、置換した本文データを分割された文字列のリストで返す
+        line: 1行ずつ置換する／document: ファイル全体を一度に置換する（行をまたがない置換のみ同じ結果になる）
+        '''
+        body = []
+        with self.open_source(filepath, self.source_files) as f:
+            if transform_mode == 'document':
+                data = Convert.normalize_line_breaks(f.read())
+                # チャプター共通の置換→該当チャプターの置換
+                data = replace_rules.apply(data)
+                data = self.setting_resolver.resolve(data)
+                if not Utility.is_empty(data):
+                    body.append(data)
+            else:
+                # NOTE: ファイル全体を読み込まず、読み込んだ行を置換してBODY_CHUNK_SIZE文字程度ずつ連結する
+                #       （str.splitlines()と同じ区切りにするため、読み込んだ行をさらに分割する）
+                lines = []
+                size = 0
+                for data in f:
+                    for line in data.splitlines():
+                        line = line + '\n'
+                        # チャプター共通の置換→該当チャプターの置換
+                        line = replace_rules.apply(line)
+                        line = self.setting_resolver.resolve(line)
+                        lines.append(line)
+                        size += len(line)
+                    if size >= self.BODY_CHUNK_SIZE:
+                        body.append(''.join(lines))
+                        lines = []
+                        size = 0
+                if len(lines) > 0:
+                    body.append(''.join(lines))
+            f.close()
+        return body
+
+    def iter_transform(self, filepath, replace_rules, transform_mode='line'):
+        '''
+        チャプターファイルをBODY_CHUNK_SIZE文字ずつ読み込み、置換した本文データを順に返す（transformと同じ結果になる）
+        読み込んだデータの末尾の改行で終わらない行は、次に読み込んだデータと連結してから置換する
+        NOTE: documentは行をまたがない置換のみのため、改行で区切った単位で置換しても結果は変わらない
+        '''
+        with self.open_source(filepath, self.source_files) as f:
+            carry = ''
+            for data in iter(functools.partial(f.read, self.BODY_CHUNK_SIZE), ''):
+                data = carry + data
+                lines = data.splitlines(True)
+                carry = lines[-1]
+                if carry.splitlines()[0] == carry:
+                    # 改行で終わらない行は持ち越す
+                    lines.pop()
+                else:
+                    carry = ''
+                if len(lines) > 0:
+                    data = self.transform_lines(data[:len(data) - len(carry)] if transform_mode == 'document' else lines, replace_rules, transform_mode)
+                    if not Utility.is_empty(data):
+                        yield data
+            if carry != '':
+                data = self.transform_lines(carry if transform_mode == 'document' else [carry], replace_rules, transform_mode)
+                if not Utility.is_empty(data):
+                    yield data
+            f.close()
+
+    def transform_lines(self, data, replace_rules, transform_mode):
+        '''
+        改行で区切った単位の置換（document: 文字列を一度に置換する／line: 行のリストを1行ずつ置換して連結する）
+        '''
+        if transform_mode == 'document':
+            data = replace_rules.apply(Convert.normalize_line_breaks(data))
+            return self.setting_resolver.resolve(data)
+        lines = []
+        for data_line in data:
+            for line in data_line.splitlines():
+                line = replace_rules.apply(line + '\n')
+                lines.append(self.setting_resolver.resolve(line))
+        return ''.join(lines)
+
+    @classmethod
+    def initialize_worker(cls, setting_resolver, chapter_replace_rules, source_files=None):
+        '''
+        ワーカープロセスの初期化（置換ルールとメモリ上のファイルはワーカープロセスごとに1回だけ受け取る）
+        '''
+        cls.worker_transformer = cls(setting_resolver, chapter_replace_rules, source_files)
+
+    @classmethod
+    def transform_in_worker(cls, task):
+        '''
+        ワーカープロセスでのチャプター変換（task: チャプターのインデックス, ファイルパス, 置換方式）
+        本文データ、置換したプレースホルダのパス、処理時間を返す
+        '''
+        index, filepath, transform_mode = task
+        transformer = cls.worker_transformer
+        transformer.setting_resolver.accessed = set()
+        start = time.perf_counter()
+        body = transformer.transform(filepath, transformer.chapter_replace_rules[index], transform_mode)
+        return (body, transformer.setting_resolver.accessed, time.perf_counter() - start)
+
+
+class ChapterStream(object):
+    '''
+    チャプターの本文データを書き込み時に読み込むクラス（反復するたびにチャプターファイルを読み込み、置換した本文データを順に返す）
+    本文データをメモリ上に保持しないため、サイズが大きいチャプターファイルに使用する
+    '''
+
+    def __init__(self, setting_resolver, filepath, replace_rules, transform_mode, source_files=None):
+        '''
+        コンストラクタ
+        '''
+        self.filepath = filepath
+        self.replace_rules = replace_rules
+        self.transform_mode = transform_mode
+        # 置換したプレースホルダのパス（反復した後に確定する）
+        # NOTE: コンテンツの設定値の置換と区別するため、設定値置換クラスは専用のものを使用する
+        self.setting_paths = set()
+        self.transformer = ChapterTransformer(SettingResolver(setting_resolver.settings), source_files=source_files)
+        self.transformer.setting_resolver.accessed = self.setting_paths
+
+    def __iter__(self):
+        '''
+        置換した本文データを順に返す
+        '''
+        return self.transformer.iter_transform(self.filepath, self.replace_rules, self.transform_mode)
+
+
+class FileCache(object):
+    '''
+    ファイルキャッシュ基底クラス（キーごとのファイルをディレクトリに保存し、サイズの上限を超えた場合は使用日時の古いものから削除する）
+    '''
+
+    EXTENSION = '.cache'
+
+    def __init__(self, dirpath, max_size):
+        '''
+        コンストラクタ
+        '''
+        self.dirpath = dirpath
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        FileSystem.create_directory(dirpath)
+
+    def get_filepath(self, key):
+        '''
+        キャッシュファイルのパス
+        '''
+        return os.path.join(self.dirpath, key + self.EXTENSION)
+
+    def store(self, key, write, binary=False):
+        '''
+        データ保存（write: 開いた一時ファイルにデータを書き込む関数。一時ファイルに書き込んでから置き換える）
+        '''
+        filepath = self.get_filepath(key)
+        temp_filepath = '{0}.{1}.tmp'.format(filepath, uuid4().hex)
+        try:
+            with open(temp_filepath, 'wb') if binary else open(temp_filepath, 'w', encoding='utf-8', newline='') as f:
+                write(f)
+                f.close()
+            os.replace(temp_filepath, filepath)
+        except OSError:
+            FileSystem.remove_file(temp_filepath)
+            return False
+        self.stores += 1
+        return True
+
+    def evict(self):
+        '''
+        サイズの上限を超えた場合は、使用日時の古いものから削除する
+        '''
+        entries = []
+        total_size = 0
+        for entry in os.scandir(self.dirpath):
+            if not entry.name.endswith(self.EXTENSION):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            total_size += stat.st_size
+        entries.sort()
+        for mtime, size, filepath in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(filepath)
+            except OSError:
+                continue
+            total_size -= size
+            self.evictions += 1
+
+    def clear(self):
+        '''
+        キャッシュ削除
+        '''
+        for entry in os.scandir(self.dirpath):
+            if entry.name.endswith(self.EXTENSION) or entry.name.endswith('.tmp'):
+                FileSystem.remove_file(entry.path)
+
+
+class ChapterCache(FileCache):
+    '''
+    チャプターキャッシュクラス（置換済みの本文データをディレクトリに保存し、サイズの上限を超えた場合は古いものから削除する）
+    キー: チャプターファイル・置換ルール・置換方式のダイジェスト（参照した設定値は保存したデータと照合する）
+    '''
+
+    def get(self, key, setting_resolver):
+        '''
+        本文データ取得（本文データと置換したプレースホルダのパスを返す。ない場合はNone）
+        '''
+        filepath = self.get_filepath(key)
+        try:
+            with open(filepath, 'r', encoding='utf-8', newline='') as f:
+                header = json.loads(f.readline())
+                if header.get('values') != EntryFingerprint.setting_values_digest(setting_resolver, header['settings']):
+                    f.close()
+                    self.misses += 1
+                    return None
+                # NOTE: 本文データ中の{$chapter.filePath}は分割した単位で置換するため、変換した場合と同じく行末で分割する
+                body = []
+                carry = []
+                for data in iter(functools.partial(f.read, ChapterTransformer.BODY_CHUNK_SIZE), ''):
+                    end = data.rfind('\n') + 1
+                    if end == 0:
+                        carry.append(data)
+                        continue
+                    carry.append(data[:end])
+                    body.append(''.join(carry))
+                    carry = [data[end:]] if end < len(data) else []
+                if len(carry) > 0:
+                    body.append(''.join(carry))
+                f.close()
+            # 最近使用したものから残すため、更新日時を使用日時にする
+            os.utime(filepath)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return (body, set(header['settings']))
+
+    def put(self, key, body, setting_resolver, setting_paths):
+        '''
+        本文データ保存（一時ファイルに書き込んでから置き換える）
+        '''
+        setting_paths = sorted(setting_paths)
+        header = json.dumps({'settings': setting_paths, 'values': EntryFingerprint.setting_values_digest(setting_resolver, setting_paths)}, ensure_ascii=False) + '\n'
+
+        def write(f):
+            f.write(header)
+            for data in body:
+                f.write(data)
+
+        return self.store(key, write)
+
+    @classmethod
+    def clear_directory(cls, dirpath):
+        '''
+        チャプターキャッシュのディレクトリのキャッシュ削除（ディレクトリ内の画像キャッシュも削除する）
+        '''
+        cls(dirpath, 0).clear()
+        ImageCache(os.path.join(dirpath, ImageCache.DIRNAME), 0).clear()
+
+
+class ImageCache(FileCache):
+    '''
+    画像キャッシュクラス（最適化した画像のデータをディレクトリに保存し、サイズの上限を超えた場合は古いものから削除する）
+    キー: 画像ファイルのダイジェスト（最適化しない画像は空のデータを保存する）
+    '''
+
+    EXTENSION = '.png'
+
+    # チャプターキャッシュのディレクトリ内のディレクトリ名
+    DIRNAME = 'png'
+
+    def get(self, key):
+        '''
+        最適化した画像のデータ取得（ない場合はNone）
+        '''
+        filepath = self.get_filepath(key)
+        try:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+                f.close()
+            # 最近使用したものから残すため、更新日時を使用日時にする
+            os.utime(filepath)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        '''
+        最適化した画像のデータ保存（一時ファイルに書き込んでから置き換える）
+        '''
+        return self.store(key, lambda f: f.write(data), binary=True)
+
+
+class FilePrefetcher(object):
+    '''
+    ファイル先読みクラス（読み込みスレッドで、これから使用するファイルを使用する順に先行して読み込む）
+    先読みしたデータは取得した時点で解放する。先読みしていないファイルは使用する側で読み込む
+    '''
+
+    # 先読みしたデータの合計サイズの上限（これより大きいファイルは先読みしない）
+    MAX_BUFFER_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, filepaths, depth, max_buffer_size=None):
+        '''
+        コンストラクタ
+        filepaths: 使用する順のファイルパス
+        depth: 先読みする（取得されていない）ファイル数の上限
+        '''
+        self.filepaths = list(dict.fromkeys(filepaths))
+        self.targets = set(self.filepaths)
+        self.depth = depth
+        self.max_buffer_size = self.MAX_BUFFER_SIZE if max_buffer_size == None else max_buffer_size
+        self.condition = threading.Condition()
+        self.buffer = {}
+        self.buffer_size = 0
+        self.position = 0
+        self.reading = None
+        self.closed = False
+        self.hits = 0
+        self.misses = 0
+        self.thread = None
+
+    def start(self):
+        '''
+        先読み開始
+        '''
+        if self.depth <= 0 or len(self.filepaths) == 0:
+            return
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        '''
+        先読み終了（先読みしたデータを解放する）
+        '''
+        with self.condition:
+            self.closed = True
+            self.buffer = {}
+            self.buffer_size = 0
+            self.condition.notify_all()
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        '''
+        読み込みスレッドの処理（先読みしたデータが上限に達した場合は取得されるまで待機する）
+        '''
+        while True:
+            with self.condition:
+                while not self.closed and (len(self.buffer) >= self.depth or (len(self.buffer) > 0 and self.buffer_size >= self.max_buffer_size)):
+                    self.condition.wait()
+                # 取得済み（使用する側で読み込んだ）ファイルは読み込まない
+                while self.position < len(self.filepaths) and not self.filepaths[self.position] in self.targets:
+                    self.position += 1
+                if self.closed or self.position >= len(self.filepaths):
+                    return
+                filepath = self.filepaths[self.position]
+                self.position += 1
+                self.reading = filepath
+            data = None
+            try:
+                if FileSystem.get_file_size(filepath) <= self.max_buffer_size:
+                    with open(filepath, 'rb') as f:
+                        data = f.read()
+                        f.close()
+            except OSError:
+                # NOTE: 読み込めない場合は使用する側で読み込んでエラーにする
+                data = None
+            with self.condition:
+                self.reading = None
+                if not self.closed and data != None and filepath in self.targets:
+                    self.buffer[filepath] = data
+                    self.buffer_size += len(data)
+                self.condition.notify_all()
+
+    def get(self, filepath):
+        '''
+        先読みしたデータ取得（読み込み中の場合は待機する。先読みしていない場合はNone）
+        '''
+        with self.condition:
+            while self.reading == filepath:
+                self.condition.wait()
+            self.targets.discard(filepath)
+            data = self.buffer.pop(filepath, None)
+            if data == None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.buffer_size -= len(data)
+            self.condition.notify_all()
+            return data
+
+
+class BuildProfiler(object):
+    '''
+    作成処理の計測クラス（処理ごと・ファイルごとの処理時間、読み込んだサイズ、書き込んだサイズを記録する）
+    '''
+
+    # 処理時間の長いファイルの一覧に出力する件数
+    TOP_COUNT = 10
+
+    def __init__(self):
+        '''
+        コンストラクタ
+        '''
+        self.start_time = time.perf_counter()
+        self.duration = 0.0
+        self.stages = []
+        self.items = []
+        self.current_stage = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        処理の計測（処理中に書き込んだエントリ名はentriesに追加する）
+        '''
+        record = {'name': name, 'duration': 0.0, 'bytesRead': 0, 'bytesWritten': 0, 'compressedBytes': 0, 'items': 0, 'entries': []}
+        self.stages.append(record)
+        previous_stage = self.current_stage
+        self.current_stage = record
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['duration'] = time.perf_counter() - start
+            self.current_stage = previous_stage
+
+    @contextlib.contextmanager
+    def item(self, kind, name, arcname=None, filepath=None):
+        '''
+        ファイルごとの計測（filepath: 読み込むファイルのパス）
+        '''
+        record = self.create_item(kind, name, arcname, filepath)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['duration'] = time.perf_counter() - start
+            self.add_item(record)
+
+    def create_item(self, kind, name, arcname=None, filepath=None):
+        '''
+        ファイルごとの計測結果の作成
+        '''
+        bytes_read = 0
+        if filepath != None and FileSystem.exists_file(filepath):
+            bytes_read = FileSystem.get_file_size(filepath)
+        return {
+            'kind': kind,
+            'stage': self.current_stage['name'] if self.current_stage != None else None,
+            'name': name,
+            'arcname': arcname,
+            'duration': 0.0,
+            'bytesRead': bytes_read,
+            'bytesWritten': 0,
+            'compressedBytes': 0,
+        }
+
+    def add_item(self, record):
+        '''
+        ファイルごとの計測結果の追加
+        '''
+        self.items.append(record)
+        if self.current_stage != None:
+            self.current_stage['items'] += 1
+            self.current_stage['bytesRead'] += record['bytesRead']
+
+    def set_entries(self, zip_infos, entries):
+        '''
+        書き込んだエントリのサイズと圧縮方式の設定（zipファイルを閉じた後に呼び出す）
+        '''
+        sizes = {}
+        for zip_info in zip_infos:
+            sizes[zip_info.filename] = (zip_info.file_size, zip_info.compress_size)
+        compressions = dict(entries)
+        for stage in self.stages:
+            for arcname in stage['entries']:
+                if arcname in sizes:
+                    stage['bytesWritten'] += sizes[arcname][0]
+                    stage['compressedBytes'] += sizes[arcname][1]
+        for item in self.items:
+            if item['arcname'] in sizes:
+                item['bytesWritten'], item['compressedBytes'] = sizes[item['arcname']]
+                item['compression'] = compressions.get(item['arcname'])
+
+    def finish(self):
+        '''
+        計測終了
+        '''
+        self.duration = time.perf_counter() - self.start_time
+
+    def get_top_items(self, count=None):
+        '''
+        処理時間の長いファイルの一覧
+        '''
+        if count == None:
+            count = self.TOP_COUNT
+        return sorted(self.items, key=lambda item: item['duration'], reverse=True)[:count]
+
+    def create_report(self, setting_filepath, output_filepath):
+        '''
+        計測結果の作成
+        '''
+        return {
+            'settingFile': setting_filepath,
+            'outputFile': output_filepath,
+            'duration': self.duration,
+            'stages': self.stages,
+            'items': self.items,
+            'slowestItems': self.get_top_items(),
+        }
+
+
+class MemoryTracer(object):
+    '''
+    メモリ使用量の計測クラス（tracemallocで追跡したメモリ、RSSの定期取得で処理ごとの最大値と処理後に残ったメモリを記録する）
+    '''
+
+    # RSSを取得する間隔（秒）
+    SAMPLING_INTERVAL = 0.02
+
+    # メモリを確保した箇所の一覧に出力する件数
+    TOP_COUNT = 10
+
+    # メモリを確保した箇所の集計から除外するファイル
+    EXCLUDE_FILTERS = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        tracemalloc.Filter(False, '<unknown>'),
+    ]
+
+    def __init__(self):
+        '''
+        コンストラクタ
+        '''
+        self.stages = []
+        self.current_stage = None
+        self.peak_rss = None
+        self.peak_traced = 0
+        self.top_allocations = []
+        self.sampler = None
+        self.stop_event = threading.Event()
+        self.started_tracemalloc = False
+
+    @classmethod
+    def get_rss(cls):
+        '''
+        現在のRSS（バイト、取得できない場合はNone）
+        '''
+        # NOTE: Linuxのみ/proc/self/statmから取得する（2番目の値が常駐ページ数）
+        try:
+            with open('/proc/self/statm', 'r') as f:
+                pages = int(f.read().split()[1])
+                f.close()
+            return pages * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError, AttributeError):
+            return None
+
+    def start(self):
+        '''
+        計測開始
+        '''
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        self.peak_rss = self.get_rss()
+        if self.peak_rss != None:
+            self.sampler = threading.Thread(target=self.sample_rss, daemon=True)
+            self.sampler.start()
+
+    def stop(self):
+        '''
+        計測終了（メモリを確保した箇所の集計は終了前に行う）
+        '''
+        self.stop_event.set()
+        if self.sampler != None:
+            self.sampler.join()
+            self.sampler = None
+        if tracemalloc.is_tracing():
+            self.top_allocations = self.get_statistics(self.take_snapshot().statistics('lineno'))
+            self.peak_traced = max([self.peak_traced] + [tracemalloc.get_traced_memory()[1]])
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+
+    def sample_rss(self):
+        '''
+        RSSの定期取得（別スレッドで実行する）
+        '''
+        while not self.stop_event.wait(self.SAMPLING_INTERVAL):
+            self.update_rss()
+
+    def update_rss(self):
+        '''
+        RSSの最大値の更新
+        '''
+        rss = self.get_rss()
+        if rss == None:
+            return
+        if self.peak_rss == None or rss > self.peak_rss:
+            self.peak_rss = rss
+        stage = self.current_stage
+        if stage != None and (stage['rssPeak'] == None or rss > stage['rssPeak']):
+            stage['rssPeak'] = rss
+
+    @classmethod
+    def take_snapshot(cls):
+        '''
+        tracemallocのスナップショット取得（計測用のファイルを除外する）
+        '''
+        return tracemalloc.take_snapshot().filter_traces(cls.EXCLUDE_FILTERS)
+
+    @classmethod
+    def get_statistics(cls, statistics):
+        '''
+        メモリを確保した箇所の一覧（サイズの大きい順）
+        '''
+        result = []
+        for statistic in statistics[:cls.TOP_COUNT]:
+            frame = statistic.traceback[0]
+            result.append({
+                'site': '{0}:{1}'.format(frame.filename, frame.lineno),
+                'size': statistic.size_diff if isinstance(statistic, tracemalloc.StatisticDiff) else statistic.size,
+                'count': statistic.count_diff if isinstance(statistic, tracemalloc.StatisticDiff) else statistic.count,
+            })
+        return result
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        処理の計測（処理中の最大値と、処理前後の差分が大きい箇所を記録する）
+        '''
+        rss = self.get_rss()
+        traced = tracemalloc.get_traced_memory()[0]
+        record = {
+            'name': name,
+            'tracedBefore': traced,
+            'tracedAfter': traced,
+            'tracedPeak': traced,
+            'retained': 0,
+            'rssBefore': rss,
+            'rssAfter': rss,
+            'rssPeak': rss,
+            'topAllocations': [],
+        }
+        self.stages.append(record)
+        self.current_stage = record
+        snapshot = self.take_snapshot()
+        tracemalloc.reset_peak()
+        try:
+            yield record
+        finally:
+            traced, traced_peak = tracemalloc.get_traced_memory()
+            self.update_rss()
+            self.current_stage = None
+            record['tracedAfter'] = traced
+            record['tracedPeak'] = traced_peak
+            record['retained'] = traced - record['tracedBefore']
+            record['rssAfter'] = self.get_rss()
+            record['topAllocations'] = self.get_statistics(self.take_snapshot().compare_to(snapshot, 'lineno'))
+            self.peak_traced = max(self.peak_traced, traced_peak)
+
+    def create_report(self, setting_filepath, output_filepath):
+        '''
+        計測結果の作成
+        '''
+        return {
+            'settingFile': setting_filepath,
+            'outputFile': output_filepath,
+            'peakTraced': self.peak_traced,
+            'peakRss': self.peak_rss,
+            'stages': self.stages,
+            'topAllocations': self.top_allocations,
+        }
+
+
+class CompressionPolicy(object):
+    '''
+    圧縮方式クラス（エントリのメディアタイプごとに無圧縮／deflateを選択する）
+    '''
+
+    # 圧縮済みのデータのため無圧縮で格納するメディアタイプ
+    STORED_MEDIA_TYPES = [
+        'image/png',
+        'image/jpeg',
+        'image/gif',
+        'image/webp',
+        'font/woff',
+        'font/woff2',
+        'audio/mpeg',
+        'audio/mp4',
+        'video/mp4',
+    ]
+
+    # 試験圧縮に使用する先頭データのサイズ
+    PROBE_SIZE = 64 * 1024
+
+    # 試験圧縮後のサイズがこの比率を下回らない場合は無圧縮で格納する
+    PROBE_RATIO = 0.95
+
+    def __init__(self, level=-1, stored_media_types=None, probe=False, optimize_png=False):
+        '''
+        コンストラクタ
+        '''
+        # level: deflateの圧縮レベル（0～9、-1はzlibのデフォルト）
+        self.level = level
+        if stored_media_types == None:
+            stored_media_types = CompressionPolicy.STORED_MEDIA_TYPES
+        self.stored_media_types = frozenset(stored_media_types)
+        self.probe = probe
+        # optimize_png: PNGファイルを最適化してから格納するか
+        self.optimize_png = optimize_png
+
+    def select(self, arcname, sample=None):
+        '''
+        圧縮方式の選択（圧縮方式, 圧縮レベル, 表示名）を返す
+        sample: 試験圧縮に使用するデータ（Noneの場合は試験圧縮しない）
+        '''
+        media_type = mimetypes.guess_type(arcname)[0]
+        if media_type in self.stored_media_types:
+            return (zipfile.ZIP_STORED, None, 'stored')
+
+        if self.probe and sample != None and len(sample) > 0:
+            if len(zlib.compress(sample, self.level)) >= len(sample) * CompressionPolicy.PROBE_RATIO:
+                return (zipfile.ZIP_STORED, None, 'stored(probe)')
+
+        return (zipfile.ZIP_DEFLATED, self.level, 'deflate({0})'.format(6 if self.level == -1 else self.level))
+
+
+class PngOptimizer(object):
+    '''
+    PNG最適化クラス（画素データを変更せずに、IDATをzlibの最大の圧縮率で圧縮し直し、表示に影響しない補助チャンクを削除する）
+    APNG・不正なPNG・小さくならないPNGは最適化しない
+    '''
+
+    # 最適化の方式を変更した場合は変更する（画像キャッシュのキーに使用する）
+    VERSION = 1
+
+    SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+    # 必須チャンク
+    CRITICAL_CHUNKS = [b'IHDR', b'PLTE', b'IDAT', b'IEND']
+
+    # 残す補助チャンク（色・透過・縦横比・向きなど表示に影響するもの）
+    KEEP_CHUNKS = [b'tRNS', b'gAMA', b'cHRM', b'sRGB', b'iCCP', b'cICP', b'mDCV', b'cLLI', b'sBIT', b'pHYs', b'eXIf']
+
+    # APNGのチャンク
+    ANIMATION_CHUNKS = [b'acTL', b'fcTL', b'fdAT']
+
+    # カラータイプごとのチャンネル数
+    CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+    # インターレース（Adam7）の各パスの開始位置と間隔（x, y, xの間隔, yの間隔）
+    ADAM7_PASSES = [(0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4), (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2)]
+
+    # 試すzlibの圧縮方法（最も小さいものを使用する）
+    STRATEGIES = [zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED]
+
+    @classmethod
+    def is_png(cls, data):
+        '''
+        PNGかどうか
+        '''
+        return data[:len(cls.SIGNATURE)] == cls.SIGNATURE
+
+    @classmethod
+    def read_chunks(cls, data):
+        '''
+        チャンクの読み込み（チャンクの種類とデータのリストを返す。不正な場合はValueError）
+        '''
+        if not cls.is_png(data):
+            raise ValueError('PNGではありません。')
+        chunks = []
+        position = len(cls.SIGNATURE)
+        while position + 12 <= len(data):
+            length, chunk_type = struct.unpack('>I4s', data[position:position + 8])
+            end = position + 12 + length
+            if length > 0x7fffffff or end > len(data):
+                raise ValueError('チャンクの長さが不正です。')
+            chunk_data = data[position + 8:end - 4]
+            if zlib.crc32(chunk_type + chunk_data) != struct.unpack('>I', data[end - 4:end])[0]:
+                raise ValueError('チャンクのCRCが不正です。')
+            chunks.append((chunk_type, chunk_data))
+            position = end
+            if chunk_type == b'IEND':
+                break
+        if len(chunks) < 2 or chunks[0][0] != b'IHDR' or chunks[-1][0] != b'IEND' or len(chunks[0][1]) != 13:
+            raise ValueError('IHDR／IENDチャンクがありません。')
+        return chunks
+
+    @classmethod
+    def get_image_data_size(cls, header):
+        '''
+        IHDRチャンクから、展開した画像データ（フィルタの種類を含む）のサイズを計算する（不正な場合はValueError）
+        '''
+        width, height, bit_depth, color_type, compression_method, filter_method, interlace_method = struct.unpack('>IIBBBBB', header)
+        if width == 0 or height == 0 or not color_type in cls.CHANNELS or compression_method != 0 or filter_method != 0 or interlace_method > 1:
+            raise ValueError('IHDRチャンクが不正です。')
+        bits_per_pixel = cls.CHANNELS[color_type] * bit_depth
+        passes = cls.ADAM7_PASSES if interlace_method == 1 else [(0, 0, 1, 1)]
+        size = 0
+        for x, y, x_step, y_step in passes:
+            pass_width = (width - x + x_step - 1) // x_step
+            pass_height = (height - y + y_step - 1) // y_step
+            if pass_width > 0 and pass_height > 0:
+                size += pass_height * ((pass_width * bits_per_pixel + 7) // 8 + 1)
+        return size
+
+    @classmethod
+    def optimize(cls, data):
+        '''
+        最適化したデータを返す（最適化しない場合・小さくならない場合はNone）
+        '''
+        try:
+            chunks = cls.read_chunks(data)
+            image_data_size = cls.get_image_data_size(chunks[0][1])
+        except (ValueError, struct.error):
+            return None
+        chunk_types = [chunk_type for chunk_type, chunk_data in chunks]
+        if len([chunk_type for chunk_type in chunk_types if chunk_type in cls.ANIMATION_CHUNKS]) > 0:
+            return None
+        # NOTE: 不明な必須チャンク（種類の1文字目が大文字）がある場合は変更しない
+        if len([chunk_type for chunk_type in chunk_types if chunk_type[0:1].isupper() and not chunk_type in cls.CRITICAL_CHUNKS]) > 0:
+            return None
+        idat_indexes = [index for index, chunk_type in enumerate(chunk_types) if chunk_type == b'IDAT']
+        if len(idat_indexes) == 0 or idat_indexes[-1] - idat_indexes[0] + 1 != len(idat_indexes):
+            return None
+
+        # 画像データの展開（展開したデータのサイズが画像のサイズと一致しない場合は変更しない）
+        try:
+            decompressor = zlib.decompressobj()
+            image_data = decompressor.decompress(b''.join([chunks[index][1] for index in idat_indexes]), image_data_size + 1)
+            if not decompressor.eof or len(image_data) != image_data_size:
+                return None
+        except zlib.error:
+            return None
+
+        compressed = None
+        for strategy in cls.STRATEGIES:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+            candidate = compressor.compress(image_data) + compressor.flush()
+            if compressed == None or len(candidate) < len(compressed):
+                compressed = candidate
+
+        output = [cls.SIGNATURE]
+        for index, (chunk_type, chunk_data) in enumerate(chunks):
+            if chunk_type == b'IDAT':
+                if index != idat_indexes[0]:
+                    continue
+                chunk_data = compressed
+            elif not chunk_type in cls.CRITICAL_CHUNKS and not chunk_type in cls.KEEP_CHUNKS:
+                continue
+            output.append(struct.pack('>I4s', len(chunk_data), chunk_type))
+            output.append(chunk_data)
+            output.append(struct.pack('>I', zlib.crc32(chunk_type + chunk_data)))
+        optimized = b''.join(output)
+        if len(optimized) >= len(data):
+            return None
+        return optimized
+
+    @classmethod
+    def optimize_file(cls, filepath, data=None, cache_dirpath=None):
+        '''
+        ファイルの最適化（ワーカープロセスでも実行する）
+        最適化したデータ（最適化しない場合はNone）、元のサイズ、画像キャッシュにあったかを返す
+        data: メモリ上のファイルの内容／cache_dirpath: 画像キャッシュのディレクトリ（Noneの場合は使用しない）
+        '''
+        if data == None:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+                f.close()
+        cache = None
+        if cache_dirpath != None:
+            cache = ImageCache(cache_dirpath, 0)
+            key = EntryFingerprint.digest(hashlib.sha256(data).hexdigest(), cls.VERSION)
+            optimized = cache.get(key)
+            if optimized != None:
+                return (optimized if len(optimized) > 0 else None, len(data), True)
+        optimized = cls.optimize(data)
+        if cache != None:
+            cache.put(key, optimized if optimized != None else b'')
+        return (optimized, len(data), False)
+
+
+class EntryFingerprint(object):
+    '''
+    エントリの指紋クラス（エントリを作成した入力データのダイジェストを、zipファイルのエントリのコメントに保存する）
+    '''
+
+    VERSION = 1
+
+    @classmethod
+    def digest(cls, *values):
+        '''
+        値のダイジェスト作成
+        '''
+        return hashlib.sha256(repr(values).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def file_digest(cls, filepath):
+        '''
+        ファイルのダイジェスト作成
+        '''
+        file_hash = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for data in iter(functools.partial(f.read, 1024 * 1024), b''):
+                file_hash.update(data)
+            f.close()
+        return file_hash.hexdigest()
+
+    @classmethod
+    def setting_values_digest(cls, setting_resolver, setting_paths):
+        '''
+        プレースホルダで参照した設定値のダイジェスト作成
+        '''
+        if setting_resolver == None:
+            return cls.digest()
+        return cls.digest(*[(path, setting_resolver.get_value(path)) for path in setting_paths])
+
+    @classmethod
+    def create(cls, inputs, setting_resolver=None, setting_paths=None):
+        '''
+        エントリのコメントに保存する指紋作成
+        （inputs: 入力データのダイジェスト, setting_paths: エントリの作成時に置換したプレースホルダのパス）
+        '''
+        setting_paths = sorted(setting_paths or [])
+        comment = json.dumps({
+            'version': cls.VERSION,
+            'inputs': inputs,
+            'settings': setting_paths,
+            'values': cls.setting_values_digest(setting_resolver, setting_paths),
+        }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        # NOTE: zipファイルのコメントの上限を超える場合は保存しない（次回は再作成する）
+        if len(comment) > 0xffff:
+            return b''
+        return comment
+
+    @classmethod
+    def matches(cls, comment, inputs, setting_resolver=None):
+        '''
+        前回作成したエントリの指紋と一致するか（入力データと、前回参照した設定値が同じであれば同じエントリになる）
+        '''
+        try:
+            fingerprint = json.loads(comment.decode('utf-8'))
+        except ValueError:
+            return False
+        if type(fingerprint) is not dict or fingerprint.get('version') != cls.VERSION or fingerprint.get('inputs') != inputs:
+            return False
+        setting_paths = fingerprint.get('settings')
+        if type(setting_paths) is not list:
+            return False
+        return fingerprint.get('values') == cls.setting_values_digest(setting_resolver, setting_paths)
+
+
+class EpubReader(object):
+    '''
+    epubファイル読み込みクラス（前回作成したepubファイルから圧縮済みのエントリを読み込む）
+    '''
+
+    def __init__(self, filepath):
+        '''
+        コンストラクタ
+        '''
+        self.filepath = filepath
+        with zipfile.ZipFile(filepath, 'r') as zip_file:
+            self.entries = {zip_info.filename: zip_info for zip_info in zip_file.infolist()}
+            zip_file.close()
+
+    def find(self, arcname):
+        '''
+        エントリ情報取得（データディスクリプタを使用したエントリ・暗号化されたエントリは対象外）
+        '''
+        if not arcname in self.entries:
+            return None
+        zip_info = self.entries[arcname]
+        if zip_info.flag_bits & 0x09:
+            return None
+        return zip_info
+
+    def iter_raw(self, zip_info, chunk_size=1024 * 1024):
+        '''
+        エントリの圧縮済みのデータを読み込む
+        '''
+        with open(self.filepath, 'rb') as f:
+            # ローカルファイルヘッダの後ろからデータを読み込む
+            f.seek(zip_info.header_offset)
+            header = f.read(30)
+            if len(header) != 30 or header[:4] != b'PK\x03\x04':
+                raise zipfile.BadZipFile('ローカルファイルヘッダが不正です。 {0}'.format(zip_info.filename))
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            f.seek(zip_info.header_offset + 30 + name_length + extra_length)
+            size = zip_info.compress_size
+            while size > 0:
+                data = f.read(min(chunk_size, size))
+                if len(data) == 0:
+                    raise zipfile.BadZipFile('エントリのデータが不足しています。 {0}'.format(zip_info.filename))
+                size -= len(data)
+                yield data
+            f.close()
+
+    def read_raw(self, zip_info):
+        '''
+        エントリの圧縮済みのデータを一度に読み込む
+        '''
+        return b''.join(self.iter_raw(zip_info))
+
+
+class EpubWriter(object):
+    '''
+    epubファイル書き込みクラス（生成したデータ／リソースファイルをzipファイルに直接書き込む）
+    '''
+
+    # 並列圧縮する場合にメモリ上で圧縮するエントリの上限サイズ（これより大きいエントリは直接書き込む）
+    PARALLEL_MAX_SIZE = 16 * 1024 * 1024
+    # 圧縮済みのデータを直接書き込む処理で使用するzipfileの実装（動作を確認したPythonのバージョンの範囲、ZipFileの属性、ZipInfoのメソッド）
+    # NOTE: zipfileの公開APIには圧縮済みのデータを書き込む方法がないため、非公開の実装を使用できる場合のみ直接書き込み、それ以外は公開APIで書き込む
+    RAW_WRITE_VERSIONS = ((3, 8), (3, 13))
+    RAW_WRITE_ATTRIBUTES = ['fp', 'filelist', 'NameToInfo', 'start_dir', '_lock', '_seekable', '_writecheck', '_didModify']
+    RAW_WRITE_METHODS = ['FileHeader']
+    # データディスクリプタのシグネチャ
+    DD_SIGNATURE = 0x08074b50
+    # 圧縮済みのデータを直接書き込めるか（初回の確認結果）
+    raw_write_supported = None
+
+    class EntryBuffer(io.BufferedIOBase):
+        '''
+        並列圧縮するエントリのデータを保持するバッファ（上限サイズを超えた場合はzipファイルに直接書き込む）
+        '''
+
+        def __init__(self, writer, zip_info):
+            '''
+            コンストラクタ
+            '''
+            super().__init__()
+            self.writer = writer
+            self.zip_info = zip_info
+            self.chunks = []
+            self.size = 0
+            self.direct = None
+
+        def writable(self):
+            '''
+            書き込み可能か
+            '''
+            return True
+
+        def write(self, data):
+            '''
+            データ書き込み
+            '''
+            if self.direct != None:
+                return self.direct.write(data)
+            self.chunks.append(bytes(data))
+            self.size += len(data)
+            if self.size > self.writer.PARALLEL_MAX_SIZE:
+                # 圧縮中のエントリを書き込んでから、以降のデータを直接書き込む
+                self.writer.flush_pending()
+                self.direct = self.writer.zip_file.open(self.zip_info, 'w')
+                for chunk in self.chunks:
+                    self.direct.write(chunk)
+                self.chunks = []
+            return len(data)
+
+        def close(self):
+            '''
+            バッファを閉じる（保持したデータを圧縮する）
+            '''
+            if self.closed:
+                return
+            try:
+                if self.direct != None:
+                    self.direct.close()
+                else:
+                    data = b''.join(self.chunks)
+                    self.chunks = []
+                    self.writer.submit(self.zip_info, lambda: data)
+            finally:
+                super().close()
+
+    def __init__(self, filepath, compression_policy=None, threads=1):
+        '''
+        コンストラクタ
+        '''
+        self.filepath = filepath
+        if compression_policy == None:
+            compression_policy = CompressionPolicy()
+        self.compression_policy = compression_policy
+        self.date_time = time.localtime(time.time())[:6]
+        self.zip_file = zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED)
+        # 書き込んだエントリの（エントリ名, 圧縮方式の表示名）
+        self.entries = []
+        # 並列圧縮（スレッド数が2以上の場合のみ）
+        # NOTE: 圧縮中のエントリは書き込む順に保持し、先頭から順にzipファイルに書き込む
+        self.executor = None
+        self.pending = collections.deque()
+        self.max_pending = threads * 2
+        if threads > 1 and self.supports_raw_write():
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+    @classmethod
+    def supports_raw_write(cls):
+        '''
+        圧縮済みのデータを直接書き込めるか（並列圧縮・前回作成したepubファイルのエントリの再利用に使用する）
+        '''
+        if cls.raw_write_supported == None:
+            supported = cls.RAW_WRITE_VERSIONS[0] <= sys.version_info[:2] <= cls.RAW_WRITE_VERSIONS[1]
+            supported = supported and all([hasattr(zipfile.ZipInfo, name) for name in cls.RAW_WRITE_METHODS])
+            if supported:
+                with zipfile.ZipFile(io.BytesIO(), 'w') as zip_file:
+                    supported = all([hasattr(zip_file, name) for name in cls.RAW_WRITE_ATTRIBUTES])
+                    zip_file.close()
+            cls.raw_write_supported = supported
+        return cls.raw_write_supported
+
+    def create_zip_info(self, arcname, compress_type=zipfile.ZIP_DEFLATED, compress_level=None):
+        '''
+        zipファイルのエントリ情報作成
+        '''
+        zip_info = zipfile.ZipInfo(arcname, date_time=self.date_time)
+        zip_info.compress_type = compress_type
+        zip_info.external_attr = 0o644 << 16
+        self.set_compress_level(zip_info, compress_level)
+        return zip_info
+
+    def set_compress_level(self, zip_info, compress_level):
+        '''
+        エントリの圧縮レベル設定
+        '''
+        # NOTE: Python 3.13以降はcompress_level、それより前は_compresslevelで圧縮レベルを指定する
+        if hasattr(zip_info, 'compress_level'):
+            zip_info.compress_level = compress_level
+        else:
+            zip_info._compresslevel = compress_level
+
+    def select_compression(self, arcname, compress_type=None, sample=None):
+        '''
+        エントリの圧縮方式の選択（圧縮方式が指定された場合はそれを優先する）
+        '''
+        if compress_type == None:
+            compression = self.compression_policy.select(arcname, sample)
+        elif compress_type == zipfile.ZIP_STORED:
+            compression = (zipfile.ZIP_STORED, None, 'stored')
+        else:
+            compression = (compress_type, self.compression_policy.level, 'deflate({0})'.format(6 if self.compression_policy.level == -1 else self.compression_policy.level))
+        self.entries.append((arcname, compression[2]))
+        return compression
+
+    def is_parallel(self, compression):
+        '''
+        並列圧縮するか
+        '''
+        # NOTE: 圧縮レベル0のdeflateは入力の分割のされ方で出力が変わるため、逐次書き込みと同じ結果になるように並列圧縮しない
+        return self.executor != None and not (compression[0] == zipfile.ZIP_DEFLATED and compression[1] == 0)
+
+    def open_text(self, arcname, compress_type=None, comment=None, stream=False):
+        '''
+        テキストデータを書き込むエントリを開く（改行はファイルに書き込む場合と同じくOSの改行コードになる）
+        stream: サイズが大きいデータを直接書き込む（メモリ上に保持せず、サイズに関わらず書き込めるようにZIP64形式にする）
+        '''
+        compression = self.select_compression(arcname, compress_type)
+        zip_info = self.create_zip_info(arcname, compression[0], compression[1])
+        if comment != None:
+            zip_info.comment = comment
+        if not stream and self.is_parallel(compression):
+            return io.TextIOWrapper(self.EntryBuffer(self, zip_info), encoding='utf-8')
+        self.flush_pending()
+        return io.TextIOWrapper(self.zip_file.open(zip_info, 'w', force_zip64=stream), encoding='utf-8')
+
+    def set_comment(self, arcname, comment):
+        '''
+        直接書き込んだエントリのコメント設定（セントラルディレクトリはzipファイルを閉じる時に書き込むため、書き込み後も設定できる）
+        '''
+        self.zip_file.NameToInfo[arcname].comment = comment
+
+    def write_text(self, arcname, data, compress_type=None, comment=None):
+        '''
+        テキストデータ書き込み
+        '''
+        with self.open_text(arcname, compress_type, comment) as f:
+            f.write(data)
+
+    def write_file(self, arcname, filepath, compress_type=None, comment=None, data=None):
+        '''
+        ファイル書き込み（data: 読み込み済みのファイルの内容。エントリ情報はファイルから作成する）
+        '''
+        sample = None
+        if compress_type == None and self.compression_policy.probe:
+            if data != None:
+                sample = data[:CompressionPolicy.PROBE_SIZE]
+            else:
+                with open(filepath, 'rb') as f:
+                    sample = f.read(CompressionPolicy.PROBE_SIZE)
+                    f.close()
+        compression = self.select_compression(arcname, compress_type, sample)
+        if self.is_parallel(compression):
+            # NOTE: ZipFile.write()と同じエントリ情報にする
+            zip_info = zipfile.ZipInfo.from_file(filepath, arcname)
+            if zip_info.file_size <= self.PARALLEL_MAX_SIZE:
+                zip_info.compress_type = compression[0]
+                self.set_compress_level(zip_info, compression[1])
+                if comment != None:
+                    zip_info.comment = comment
+                self.submit(zip_info, (lambda: data) if data != None else (lambda: pathlib.Path(filepath).read_bytes()))
+                return
+        self.flush_pending()
+        if data != None:
+            # NOTE: ZipFile.write()と同じエントリ情報にする
+            zip_info = zipfile.ZipInfo.from_file(filepath, arcname)
+            zip_info.compress_type = compression[0]
+            self.set_compress_level(zip_info, compression[1])
+            with self.zip_file.open(zip_info, 'w') as f:
+                f.write(data)
+        else:
+            self.zip_file.write(filepath, arcname, compression[0], compression[1])
+        if comment != None:
+            self.zip_file.NameToInfo[arcname].comment = comment
+
+    def write_data(self, arcname, data, compress_type=None, comment=None):
+        '''
+        メモリ上のデータ（バイト列）書き込み
+        '''
+        sample = None
+        if compress_type == None and self.compression_policy.probe:
+            sample = data[:CompressionPolicy.PROBE_SIZE]
+        compression = self.select_compression(arcname, compress_type, sample)
+        zip_info = self.create_zip_info(arcname, compression[0], compression[1])
+        if comment != None:
+            zip_info.comment = comment
+        if self.is_parallel(compression) and len(data) <= self.PARALLEL_MAX_SIZE:
+            self.submit(zip_info, lambda: data)
+            return
+        self.flush_pending()
+        with self.zip_file.open(zip_info, 'w', force_zip64=len(data) > zipfile.ZIP64_LIMIT) as f:
+            f.write(data)
+
+    def copy_entry(self, reader, source_info):
+        '''
+        前回作成したepubファイルのエントリを圧縮済みのデータのまま書き込む
+        '''
+        zip_info = zipfile.ZipInfo(source_info.filename, date_time=source_info.date_time)
+        zip_info.compress_type = source_info.compress_type
+        zip_info.external_attr = source_info.external_attr
+        zip_info.comment = source_info.comment
+        if not self.supports_raw_write():
+            # 圧縮済みのデータを直接書き込めない場合は展開したデータを書き込む
+            self.entries.append((source_info.filename, '{0}(reused)'.format('stored' if source_info.compress_type == zipfile.ZIP_STORED else 'deflate')))
+            if zip_info.compress_type == zipfile.ZIP_DEFLATED:
+                self.set_compress_level(zip_info, self.compression_policy.level)
+            self.flush_pending()
+            with zipfile.ZipFile(reader.filepath, 'r') as source_file, source_file.open(source_info, 'r') as source, self.zip_file.open(zip_info, 'w', force_zip64=source_info.file_size > zipfile.ZIP64_LIMIT) as destination:
+                shutil.copyfileobj(source, destination)
+            return
+        zip_info.CRC = source_info.CRC
+        zip_info.file_size = source_info.file_size
+        zip_info.compress_size = source_info.compress_size
+        self.entries.append((source_info.filename, '{0}(reused)'.format('stored' if source_info.compress_type == zipfile.ZIP_STORED else 'deflate')))
+        if self.executor != None and source_info.compress_size <= self.PARALLEL_MAX_SIZE:
+            self.pending.append((zip_info, self.executor.submit(reader.read_raw, source_info)))
+            while len(self.pending) > self.max_pending:
+                self.write_pending()
+            return
+        self.flush_pending()
+        self.write_compressed(zip_info, reader.iter_raw(source_info))
+
+    def submit(self, zip_info, read_data):
+        '''
+        エントリの圧縮を開始する（圧縮中のエントリが多い場合は先頭から書き込んで待つ）
+        '''
+        self.pending.append((zip_info, self.executor.submit(self.compress, zip_info, read_data)))
+        while len(self.pending) > self.max_pending:
+            self.write_pending()
+
+    @classmethod
+    def compress(cls, zip_info, read_data):
+        '''
+        エントリのデータを圧縮する（zlibは圧縮中にGILを解放するため、スレッドで並列に実行できる）
+        '''
+        data = read_data()
+        zip_info.file_size = len(data)
+        zip_info.CRC = zlib.crc32(data)
+        if zip_info.compress_type == zipfile.ZIP_DEFLATED:
+            # NOTE: ZipFile.open()で書き込む場合と同じraw deflate
+            compress_level = zip_info.compress_level if hasattr(zip_info, 'compress_level') else zip_info._compresslevel
+            if compress_level == None:
+                compress_level = zlib.Z_DEFAULT_COMPRESSION
+            compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+            data = compressor.compress(data) + compressor.flush()
+        zip_info.compress_size = len(data)
+        return data
+
+    def write_pending(self):
+        '''
+        圧縮中の先頭のエントリを圧縮済みのデータでzipファイルに書き込む
+        '''
+        zip_info, future = self.pending.popleft()
+        self.write_compressed(zip_info, [future.result()])
+
+    def write_compressed(self, zip_info, chunks):
+        '''
+        圧縮済みのデータ（バイト列のイテラブル）をエントリとしてzipファイルに書き込む（supports_raw_write()で確認した場合のみ）
+        '''
+        # NOTE: ZipFile.open()で書き込んで閉じた場合と同じローカルファイルヘッダとデータを書き込む
+        zip64 = zip_info.file_size > zipfile.ZIP64_LIMIT or zip_info.compress_size > zipfile.ZIP64_LIMIT
+        zip_file = self.zip_file
+        zip_info.flag_bits = 0x00
+        if not zip_file._seekable:
+            zip_info.flag_bits |= 0x08
+        with zip_file._lock:
+            if zip_file._seekable:
+                zip_file.fp.seek(zip_file.start_dir)
+            zip_info.header_offset = zip_file.fp.tell()
+            zip_file._writecheck(zip_info)
+            zip_file._didModify = True
+            zip_file.fp.write(zip_info.FileHeader(zip64))
+            for data in chunks:
+                zip_file.fp.write(data)
+            if zip_info.flag_bits & 0x08:
+                zip_file.fp.write(struct.pack('<LLQQ' if zip64 else '<LLLL', self.DD_SIGNATURE, zip_info.CRC, zip_info.compress_size, zip_info.file_size))
+            zip_file.start_dir = zip_file.fp.tell()
+            zip_file.filelist.append(zip_info)
+            zip_file.NameToInfo[zip_info.filename] = zip_info
+
+    def flush_pending(self):
+        '''
+        圧縮中のエントリをすべてzipファイルに書き込む
+        '''
+        while len(self.pending) > 0:
+            self.write_pending()
+
+    def close(self):
+        '''
+        zipファイルを閉じる
+        '''
+        try:
+            self.flush_pending()
+        finally:
+            if self.executor != None:
+                self.executor.shutdown(wait=True, cancel_futures=True)
+                self.executor = None
+            self.pending.clear()
+            self.zip_file.close()
+
+
+class BatchBase(object):
+    '''
+    バッチ基底クラス
+    '''
+
+    debug = False
+    stdout_silent = False
+
+    class BatchException(Exception):
+        '''
+        バッチ例外
+        '''
+        pass
+
+    class ReturnCode(IntEnum):
+        '''
+        戻り値
+        '''
+        NormalEnd = 0
+        WarningEnd = 1
+        AbnormalEnd = 2
+
+    def __init__(self, batch_name, description, argument_settings, log_file_name='', debug=False, stdout_silent=False):
+        '''
+        コンストラクタ
+        '''
+        # パラメータチェック
+        if Utility.is_empty(batch_name):
+            batch_name = 'Unknown batch'
+        if Utility.is_empty(description):
+            description = 'Nothing'
+
+        keys = [
+            'short_name',
+            'long_name',
+            'destination',
+            'default_value',
+            'help'
+        ]
+        for argument_setting in argument_settings:
+            for key in keys:
+                if not key in argument_setting:
+                    raise Exception('パラメータ{0}は必須です。'.format(key))
+
+        # バッチ名
+        self.batch_name = batch_name
+
+        # パラメータ
+        self.parser = ArgumentParser(description=description)
+        for argument_setting in argument_settings:
+            short_name = None
+            if 'short_name' in argument_setting:
+                short_name = argument_setting['short_name']
+            long_name = None
+            if 'long_name' in argument_setting:
+                long_name = argument_setting['long_name']
+            destination = None
+            if 'destination' in argument_setting:
+                destination = argument_setting['destination']
+            required = False
+            if 'required' in argument_setting:
+                required = argument_setting['required']
+            default_value = None
+            if 'default_value' in argument_setting:
+                default_value = argument_setting['default_value']
+            help = None
+            if 'help' in argument_setting:
+                help = argument_setting['help']
+            # 値を省略可能なパラメータ（値を省略した場合はconst_valueになる）
+            if 'const_value' in argument_setting:
+                self.parser.add_argument(short_name, long_name, dest=destination, required=required, default=default_value, help=help, nargs='?', const=argument_setting['const_value'])
+                continue
+            self.parser.add_argument(short_name, long_name, dest=destination, required=required, default=default_value, help=help)
+
+        # デフォルトのパラメータ設定
+        self.parser.add_argument('-d', '--debug', dest='debug', required=False, default='0', help='デバッグ')
+        self.parser.add_argument('-s', '--silent', dest='silent', required=False, default='0', help='標準出力にログを出力するか')
+
+        # ログファイル名決定
+        if Utility.is_empty(log_file_name):
+            frame = inspect.stack()[1]
+            module = inspect.getmodule(frame[0])
+            log_file_name = os.path.basename(module.__file__) + '.log'
+        FileSystem.create_directory(LOG_DIR)
+        log_file_path = os.path.join(LOG_DIR, log_file_name)
+
+        # ------------------------------
+        # ログ設定
+        # ------------------------------
+        log_level = logging.INFO
+        if self.debug:
+            log_level = logging.DEBUG
+        log_format = '%(asctime)s- %(name)s - %(levelname)s - %(message)s'
+        # NOTE: 同じプロセスで複数のバッチを同時に実行できるように、ロガーはインスタンスごとに作成する
+        #       （logging.getLogger()で名前から取得するロガーはプロセス全体で共有される）
+        self.log0 = logging.Logger(self.parser.prog)
+        self.log0.setLevel(log_level)
+
+        # 標準出力ログ（パラメータで非表示可能）
+        if not self.stdout_silent:
+            self.sh = logging.StreamHandler()
+            self.sh.setLevel(log_level)
+            self.sh.setFormatter(logging.Formatter(log_format))
+            self.log0.addHandler(self.sh)
+
+        # ファイル出力ログ
+        self.fh = logging.FileHandler(filename=log_file_path, encoding='utf-8')
+        self.fh.setLevel(log_level)
+        self.fh.setFormatter(logging.Formatter(log_format))
+        self.log0.addHandler(self.fh)
+
+    def main(self, args):
+        '''
+        メイン処理（継承クラスにて実装）
+        '''
+        raise NotImplementedError()
+
+    def execute(self, argv=[]):
+        '''
+        バッチ実行
+        '''
+        try:
+            # パラメータ取得
+            args = self.parser.parse_args(args=argv)
+            self.debug = args.debug == '1'
+            self.stdout_silent = args.silent == '1'
+
+            if self.stdout_silent:
+                if 'sh' in vars(self):
+                    self.sh.close()
+                    self.log0.removeHandler(self.sh)
+
+            # メイン処理呼び出し
+            self.info_log('-' * 50)
+            self.info_log('{0} 処理開始'.format(self.batch_name))
+
+            return_code = self.main(args)
+            if return_code == BatchBase.ReturnCode.WarningEnd:
+                self.info_log('{0} 警告終了'.format(self.batch_name))
+                return int(return_code)
+            if return_code == BatchBase.ReturnCode.AbnormalEnd:
+                self.info_log('{0} 異常終了'.format(self.batch_name))
+                return int(return_code)
+            self.info_log('{0} 正常終了'.format(self.batch_name))
+
+            # 戻り値（正常終了）
+            return int(BatchBase.ReturnCode.NormalEnd)
+
+        except BatchBase.BatchException as e:
+            # 継承クラスでBatchExceptionがスローされたら警告終了
+            self.error_log(e)
+            self.info_log('{0} 警告終了'.format(self.batch_name))
+            return int(BatchBase.ReturnCode.WarningEnd)
+
+        except Exception as e:
+            # 継承クラスでExceptionがスローされたら異常終了
+            self.error_log(e)
+            self.info_log('{0} 異常終了'.format(self.batch_name))
+            self.info_log('{0}'.format(traceback.format_exc()))
+            return int(BatchBase.ReturnCode.AbnormalEnd)
+
+    def debug_log(self, message):
+        '''
+        デバッグログ出力
+        '''
+        self.log0.debug(message)
+
+    def info_log(self, message):
+        '''
+        インフォメーションログ出力
+        '''
+        self.log0.info(message)
+
+    def warning_log(self, message):
+        '''
+        ワーニングログ出力
+        '''
+        self.log0.warning(message)
+
+    def error_log(self, message):
+        '''
+        エラーログ出力
+        '''
+        self.log0.error(message)
+
+    def critical_log(self, message):
+        '''
+        クリティカルエラーログ出力
+        '''
+        self.log0.critical(message)
+
+    def exception_info(self):
+        '''
+        例外情報取得
+        '''
+        exc_type, exc_obj, tb = sys.exc_info()
+        if tb != None:
+            f = tb.tb_frame
+            lineno = tb.tb_lineno
+            filename = f.f_code.co_filename
+            
+            linecache.checkcache(filename)
+            line = linecache.getline(filename, lineno, f.f_globals)
+        
+            return 'Exception in ({0}, line {1} "{2}"): {3}'.format(filename, lineno, line.strip(), exc_obj)
+        else:
+            return 'Exception in unknown'
+
+    def __del__(self):
+        '''
+        デストラクタ
+        '''
+        if not self.stdout_silent:
+            if 'sh' in vars(self):
+                self.sh.close()
+                self.log0.removeHandler(self.sh)
+        if 'fh' in vars(self):
+            self.fh.close()
+            self.log0.removeHandler(self.fh)
+
+
+class Batch(BatchBase):
+    '''
+    バッチクラス
+    '''
+
+    args = None
+    setting_yaml_dirpath = ''
+    output_filepath = ''
+    settings = None
+    setting_resolver = None
+    chapters = None
+    contents = None
+    # 並列実行する場合のテキストのチャプターファイルの合計サイズの下限（これより小さい場合は逐次実行する）
+    PARALLEL_MIN_SIZE = 1024 * 1024
+    # 並列実行する場合に先行して変換を開始するチャプター数（プロセス数に対する倍数）
+    PREFETCH_FACTOR = 2
+    # チャプターの本文データの読み込み（チャプターのインデックス => 変換対象、直接書き込むチャプター、本文データを使用する残りのコンテンツ数）
+    chapter_tasks = None
+    chapter_streams = None
+    chapter_references = None
+    # 並列実行する場合のプロセスプール、チャプターのインデックス => 変換する順、変換する順のチャプターのインデックス、変換を開始したチャプター数、チャプターのインデックス => 変換結果
+    chapter_executor = None
+    chapter_order = None
+    chapter_order_indexes = None
+    chapter_submitted = 0
+    chapter_futures = None
+    chapter_prefetch = 0
+    chapter_cache_keys = None
+    # 逐次実行する場合のファイルの先読み（リソースファイルの配置中、チャプターの変換中に次のファイルを読み込む）
+    file_prefetcher = None
+    # PNG最適化（最適化する順のファイルパス、ファイルパス => 最適化する順、並列実行する場合のプロセスプール・最適化を開始したファイル数・ファイルパス => 最適化結果）
+    png_order = None
+    png_positions = None
+    png_executor = None
+    png_submitted = 0
+    png_futures = None
+    png_prefetch = 0
+    png_statistics = None
+    image_cache = None
+    # 同じ内容のリソースファイルの統合（統合したエントリ => 最初に指定したファイルのepubファイル内のパス、統合したファイルのパス、削減したサイズ）
+    resource_aliases = None
+    deduplicated_filepaths = None
+    deduplicated_size = 0
+
+    chapters_replace_rules = None
+    chapter_replace_rules = None
+    content_replace_rules = None
+    epub_writer = None
+    compression_policy = None
+    generated_files = None
+    # META-INF/container.xml（Convert.get_pretty_xml()で成形済みのデータ）
+    CONTAINER_XML = '''<?xml version="1.0" ?>
+<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0">
+	<rootfiles>
+		<rootfile full-path="OEBPS/book.opf" media-type="application/oebps-package+xml"/>
+	</rootfiles>
+</container>'''
+
+    # 差分作成（前回作成したepubファイル, 再利用するコンテンツのインデックス => エントリ情報, チャプターのインデックス => 置換したプレースホルダのパス）
+    incremental = False
+    previous_epub = None
+    reusable_contents = None
+    chapter_setting_paths = None
+    # 処理時間の計測（--profileを指定した場合のみ）
+    profiler = None
+    # メモリ使用量の計測（--memory_traceを指定した場合のみ）
+    memory_tracer = None
+    # 解析済みのテンプレート（(テンプレートファイルのパス, 置換ルール) => ContentTemplate）
+    content_templates = None
+    # チャプターキャッシュ
+    chapter_cache = None
+    # メモリ上の入力ファイル（ファイルパス => 内容）、出力先のストリーム（出力ファイルに書き込む場合はNone）
+    source_files = None
+    output_stream = None
+    # 監視モード（監視するファイルの更新日時, ファイルのダイジェスト, 監視を終了するイベント）
+    WATCH_INTERVAL = 0.5
+    watching = False
+    watch_mtimes = None
+    file_digests = None
+    watch_stop_event = None
+
+    @classmethod
+    def get_argument_settings(cls):
+        '''
+        パラメータ設定の一覧
+        '''
+        set_argument_settings = []
+        set_argument_settings.append({'short_name': '-i', 'long_name': '--input_setting_file', 'destination': 'input_setting_file', 'required': True, 'default_value': '', 'help': '設定ファイルのパス'})
+        set_argument_settings.append({'short_name': '-o', 'long_name': '--output_file', 'destination': 'output_file', 'required': True, 'default_value': '', 'help': '出力ファイルのパス'})
+        set_argument_settings.append({'short_name': '-l', 'long_name': '--compress_level', 'destination': 'compress_level', 'required': False, 'default_value': '', 'help': 'deflateの圧縮レベル（0～9、設定ファイルより優先）'})
+        set_argument_settings.append({'short_name': '-j', 'long_name': '--jobs', 'destination': 'jobs', 'required': False, 'default_value': '1', 'help': 'チャプター変換の並列プロセス数（0: CPU数）'})
+        set_argument_settings.append({'short_name': '-t', 'long_name': '--compress_threads', 'destination': 'compress_threads', 'required': False, 'default_value': '', 'help': '並列圧縮のスレッド数（0: CPU数、設定ファイルより優先）'})
+        set_argument_settings.append({'short_name': '-p', 'long_name': '--compress_probe', 'destination': 'compress_probe', 'required': False, 'default_value': '', 'help': '試験圧縮で圧縮効果がないファイルを無圧縮で格納するか（設定ファイルより優先）'})
+        set_argument_settings.append({'short_name': '-n', 'long_name': '--optimize_png', 'destination': 'optimize_png', 'required': False, 'default_value': '', 'help': 'PNGファイルを可逆に最適化してから格納するか（設定ファイルより優先）'})
+        set_argument_settings.append({'short_name': '-r', 'long_name': '--incremental', 'destination': 'incremental', 'required': False, 'default_value': '0', 'help': '前回作成したepubファイルから変更のないエントリを再利用するか'})
+        set_argument_settings.append({'short_name': '-c', 'long_name': '--cache', 'destination': 'cache', 'required': False, 'default_value': '1', 'help': 'チャプターキャッシュを使用するか（1: 使用する、0: 使用しない、clear: 削除してから使用する）'})
+        set_argument_settings.append({'short_name': '-g', 'long_name': '--cache_dir', 'destination': 'cache_dir', 'required': False, 'default_value': '', 'help': 'チャプターキャッシュのディレクトリ'})
+        set_argument_settings.append({'short_name': '-z', 'long_name': '--cache_size', 'destination': 'cache_size', 'required': False, 'default_value': '256', 'help': 'チャプターキャッシュのサイズの上限（MB）'})
+        set_argument_settings.append({'short_name': '-b', 'long_name': '--stream_size', 'destination': 'stream_size', 'required': False, 'default_value': '', 'help': 'このサイズ（MB）以上のテキストのチャプターファイルを、メモリ上に保持せずにepubファイルに直接書き込む（0: 全て）'})
+        set_argument_settings.append({'short_name': '-e', 'long_name': '--memory_trace', 'destination': 'memory_trace', 'required': False, 'default_value': '0', 'const_value': '1', 'help': '処理ごとのメモリ使用量を計測し、ログと同じディレクトリに出力するか'})
+        set_argument_settings.append({'short_name': '-a', 'long_name': '--read_ahead', 'destination': 'read_ahead', 'required': False, 'default_value': '4', 'help': 'リソースファイル・チャプターファイルを先行して読み込むファイル数（0: 先読みしない）'})
+        set_argument_settings.append({'short_name': '-f', 'long_name': '--profile', 'destination': 'profile', 'required': False, 'default_value': '', 'help': '処理ごと・ファイルごとの処理時間等を出力するJSONファイルのパス'})
+        set_argument_settings.append({'short_name': '-w', 'long_name': '--watch', 'destination': 'watch', 'required': False, 'default_value': '0', 'const_value': '1', 'help': '参照しているファイルを監視し、変更があれば再作成するか'})
+        return set_argument_settings
+
+    def __init__(self):
+        '''
+        コンストラクタ
+        '''
+        batch_name = 'Epub generator'
+        description = '設定ファイルに基づいてepubファイルを作成します。'
+        set_argument_settings = self.get_argument_settings()
+        super(Batch, self).__init__(batch_name, description, set_argument_settings)
+        self.initialize_state()
+
+    def initialize_state(self):
+        '''
+        インスタンスの状態の初期化
+        '''
+        # 作成する電子書籍ごとの状態はインスタンスで保持する
+        # NOTE: 同じプロセスで複数の電子書籍を作成する場合（一括作成／スレッドでの同時実行）に状態が共有されないようにする
+        self.settings = {}
+        self.chapters = []
+        self.contents = []
+        self.chapter_replace_rules = []
+        self.content_replace_rules = []
+        self.generated_files = {}
+        self.reusable_contents = {}
+        self.chapter_setting_paths = {}
+        self.content_templates = {}
+        self.source_files = {}
+        self.resource_aliases = {}
+        self.deduplicated_filepaths = set()
+        self.deduplicated_size = 0
+        self.watch_stop_event = threading.Event()
+
+    def main(self, args):
+        '''
+        メイン処理
+        '''
+        self.args = args
+
+        # パラメータ出力
+        self.info_log('設定ファイル: {0}'.format(self.args.input_setting_file))
+        self.info_log('出力ファイル: {0}'.format(self.args.output_file))
+        if self.args.debug == '1':
+            self.info_log('デバッグ: ON')
+
+        # デバッグ
+        if self.args.debug == '1':
+            self.debug = True
+
+        # ファイルチェック
+        if Utility.is_empty(self.args.input_setting_file):
+            raise BatchBase.BatchException('設定ファイルを指定してください。')
+        if not FileSystem.exists_file(self.args.input_setting_file):
+            raise BatchBase.BatchException('設定ファイルが見つかりません。')
+
+        # チャプターキャッシュ
+        self.open_chapter_cache()
+
+        # 監視モード
+        self.watching = self.args.watch == '1'
+        if self.watching:
+            self.file_digests = {}
+
+        if not self.watching:
+            self.build()
+            return
 
+        # 監視モードでは作成に失敗しても監視を継続する
         try:
-            # 設定ファイル読み込み
-            self.load_setting_file()
+            self.build()
+        except BatchBase.BatchException as e:
+            self.error_log(e)
+            self.settings = None
+        self.watch()
 
-            # mimetypeファイル作成
-            self.create_mimetype()
+    def build(self, reload_settings=True):
+        '''
+        epubファイル作成（監視モードで設定ファイルに変更がない場合は、読み込み済みの設定・置換ルールを使用する）
+        '''
+        self.profiler = None
+        if not Utility.is_empty(self.args.profile):
+            self.profiler = BuildProfiler()
+        self.memory_tracer = None
+        if self.args.memory_trace == '1':
+            self.memory_tracer = MemoryTracer()
+            self.memory_tracer.start()
+        try:
+            # 設定ファイル読み込み
+            self.reset_build_state(reload_settings)
+            if reload_settings:
+                self.run_stage('load_setting_file')
 
-            # META-INFディレクトリ作成
-            self.create_meta_inf()
-            self.create_meta_inf_container_xml()
+            # epubファイル作成開始
+            self.run_stage('open_epub')
 
-            # OEBPSディレクトリ作成
-            self.create_oebps()
+            # 前回作成したepubファイルの読み込み（差分作成）
+            self.run_stage('load_previous_epub')
 
-            # リソースディレクトリ作成
-            self.create_oebps_resources()
+            # mimetypeファイル作成
+            self.run_stage('create_mimetype')
 
-            # コンテンツディレクトリ作成
-            self.create_oebps_contents()
+            # META-INF/container.xmlファイル作成
+            self.run_stage('create_meta_inf_container_xml')
 
             # リソースファイルの配置
-            self.deploy_resource_files()
+            self.run_stage('deploy_resource_files')
+
+            # 再利用するコンテンツの検索（差分作成）
+            self.run_stage('find_reusable_contents')
 
             # チャプターファイルの読み込み
-            self.load_chapter_files()
+            self.run_stage('load_chapter_files')
 
             # OEPBSコンテンツファイル作成
-            self.create_oebps_content_files()
+            self.run_stage('create_oebps_content_files')
 
             # opfファイル作成
-            self.create_oebps_book_opf()
-
-            # 不要なディレクトリ削除
-            paths = [self.oebps_resources_dirpath, self.oebps_contents_dirpath]
-            for path in paths:
-                files = []
-                FileSystem.collect_filepaths(path, files)
-                if len(files) == 1:
-                    FileSystem.remove_directory(path)
+            self.run_stage('create_oebps_book_opf')
 
             # epubファイル作成
-            self.create_epub()
-        except Exception as e:
-            # NOTE: chdirしたディレクトリはpythonプロセスが掴んでいるため削除できないので、最後にスクリプトのディレクトリに戻す
-            os.chdir(os.path.dirname(__file__))
-            self.delete_work_dir()
-            raise e
+            self.run_stage('create_epub')
         finally:
-            os.chdir(os.path.dirname(__file__))
-            self.delete_work_dir()
+            self.run_stage('discard_epub')
+
+            # メモリ使用量の計測結果の出力（作成に失敗した場合も出力する）
+            if self.memory_tracer != None:
+                self.output_memory_trace()
+
+        # 処理時間の計測結果の出力
+        if self.profiler != None:
+            self.output_profile()
+
+    def run_stage(self, name):
+        '''
+        作成処理の実行（計測する場合は処理時間と書き込んだエントリを記録する）
+        '''
+        if self.profiler == None and self.memory_tracer == None:
+            return getattr(self, name)()
+        with contextlib.ExitStack() as stack:
+            if self.memory_tracer != None:
+                stack.enter_context(self.memory_tracer.stage(name))
+            if self.profiler == None:
+                return getattr(self, name)()
+            stage = stack.enter_context(self.profiler.stage(name))
+            entry_count = len(self.epub_writer.entries) if self.epub_writer != None else 0
+            try:
+                return getattr(self, name)()
+            finally:
+                if self.epub_writer != None:
+                    stage['entries'].extend([arcname for arcname, method in self.epub_writer.entries[entry_count:]])
+
+    def profile_item(self, kind, name, arcname=None, filepath=None):
+        '''
+        ファイルごとの計測（計測しない場合は何もしない）
+        '''
+        if self.profiler == None:
+            return contextlib.nullcontext({})
+        return self.profiler.item(kind, name, arcname, filepath)
+
+    def output_memory_trace(self):
+        '''
+        メモリ使用量の計測結果をログと同じディレクトリのJSONファイルに出力する（出力に失敗した場合は警告のみ）
+        '''
+        memory_tracer = self.memory_tracer
+        self.memory_tracer = None
+        try:
+            memory_tracer.stop()
+            filepath = '{0}.memory_{1}_{2}.json'.format(os.path.splitext(self.fh.baseFilename)[0], DateTimeHelper.now().strftime('%Y%m%d%H%M%S'), os.getpid())
+            with open(filepath, 'w', encoding='utf-8') as f:
+                json.dump(memory_tracer.create_report(os.path.abspath(self.args.input_setting_file), self.output_filepath), f, ensure_ascii=False, indent=2)
+                f.close()
+        except Exception as e:
+            self.warning_log('メモリ使用量の計測結果を出力できませんでした。 {0}'.format(self.exception_info()))
+            return
+
+        def to_mb(value):
+            return '-' if value == None else '{0:.1f}MB'.format(value / 1024 / 1024)
+
+        self.info_log('メモリ使用量 - 最大: {0}（RSS: {1}）'.format(to_mb(memory_tracer.peak_traced), to_mb(memory_tracer.peak_rss)))
+        for stage in memory_tracer.stages:
+            self.info_log('メモリ使用量 - {0}: 最大: {1} / 処理後に残ったメモリ: {2} / RSS最大: {3}'.format(stage['name'], to_mb(stage['tracedPeak']), to_mb(stage['retained']), to_mb(stage['rssPeak'])))
+        self.info_log('メモリを確保した箇所:')
+        for allocation in memory_tracer.top_allocations:
+            self.info_log('{0:>10}  {1}'.format(to_mb(allocation['size']), allocation['site']))
+        self.info_log('メモリ使用量の計測結果出力 - {0}'.format(filepath))
+
+    def output_profile(self):
+        '''
+        処理時間の計測結果をJSONファイルに出力し、処理時間の長いファイルの一覧をログに出力する
+        '''
+        self.profiler.finish()
+        filepath = os.path.abspath(self.args.profile)
+        try:
+            FileSystem.create_directory(os.path.dirname(filepath))
+            with open(filepath, 'w', encoding='utf-8') as f:
+                json.dump(self.profiler.create_report(os.path.abspath(self.args.input_setting_file), self.output_filepath), f, ensure_ascii=False, indent=2)
+                f.close()
+        except Exception as e:
+            raise BatchBase.BatchException('処理時間の計測結果の出力中にエラーが発生しました。 {0}'.format(self.exception_info()))
+
+        self.info_log('処理時間 - 合計: {0:.3f}秒'.format(self.profiler.duration))
+        for stage in self.profiler.stages:
+            self.info_log('処理時間 - {0}: {1:.3f}秒 / 読み込み: {2}バイト / 書き込み: {3}バイト（圧縮後: {4}バイト） / {5}件'.format(stage['name'], stage['duration'], stage['bytesRead'], stage['bytesWritten'], stage['compressedBytes'], stage['items']))
+        self.info_log('処理時間の長いファイル:')
+        for item in self.profiler.get_top_items():
+            self.info_log('{0:>9.3f}秒  {1:<14}  {2}'.format(item['duration'], item['kind'], item['name']))
+        self.info_log('処理時間の計測結果出力 - {0}'.format(filepath))
+
+    def open_chapter_cache(self):
+        '''
+        チャプターキャッシュの準備
+        '''
+        if self.args.cache == '0':
+            return
+        if not self.args.cache in ['1', 'clear']:
+            raise BatchBase.BatchException('チャプターキャッシュの指定が不正です。 {0}'.format(self.args.cache))
+        try:
+            max_size = int(float(self.args.cache_size) * 1024 * 1024)
+        except (TypeError, ValueError):
+            raise BatchBase.BatchException('チャプターキャッシュのサイズの指定が不正です。 {0}'.format(self.args.cache_size))
+        dirpath = CACHE_DIR
+        if not Utility.is_empty(self.args.cache_dir):
+            dirpath = os.path.abspath(self.args.cache_dir)
+        try:
+            self.chapter_cache = ChapterCache(dirpath, max_size)
+            if self.args.cache == 'clear':
+                ChapterCache.clear_directory(dirpath)
+                self.info_log('チャプターキャッシュ削除 - {0}'.format(dirpath))
+        except Exception as e:
+            raise BatchBase.BatchException('チャプターキャッシュの準備中にエラーが発生しました。 {0}'.format(self.exception_info()))
+
+    def reset_build_state(self, reload_settings=True):
+        '''
+        epubファイル作成ごとの状態の初期化
+        '''
+        self.chapters = []
+        self.contents = []
+        self.previous_epub = None
+        self.reusable_contents = {}
+        self.chapter_setting_paths = {}
+        self.content_templates = {}
+        if reload_settings:
+            self.generated_files = dict(self.source_files)
+
+    def get_watch_filepaths(self):
+        '''
+        監視するファイルのパス（設定ファイルと、設定ファイルから参照しているファイル）
+        '''
+        filepaths = [os.path.abspath(self.args.input_setting_file)]
+        if self.settings == None or not 'contents' in self.settings:
+            return filepaths
+        for stylesheet in self.settings['resources']['styleSheets']:
+            if 'settingFilePath' in stylesheet:
+                filepaths.append(stylesheet['settingFilePath'])
+        for image in self.settings['resources']['images']:
+            if 'settingFilePath' in image:
+                filepaths.append(image['settingFilePath'])
+        for file in self.settings['resources']['chapters']['files']:
+            filepaths.append(file['settingFilePath'])
+        for content in self.settings['contents']:
+            if not content['settingFilePath'] in self.generated_files:
+                filepaths.append(content['settingFilePath'])
+        return list(dict.fromkeys(filepaths))
+
+    def get_watch_mtimes(self):
+        '''
+        監視するファイルの更新日時とサイズ（ファイルがない場合はNone）
+        '''
+        mtimes = {}
+        for filepath in self.get_watch_filepaths():
+            try:
+                stat = os.stat(filepath)
+                mtimes[filepath] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                mtimes[filepath] = None
+        return mtimes
 
-    def delete_work_dir(self):
+    def watch(self):
         '''
-        作業ディレクトリ削除
+        参照しているファイルを監視し、変更があれば再作成する（Ctrl+Cまたはwatch_stop_eventで終了）
         '''
-        if not self.debug:
-            retry_count = 0
-            while (True):
-                retry_count += 1
-                has_error = False
+        self.watch_mtimes = self.get_watch_mtimes()
+        self.info_log('監視開始 - {0}ファイル（Ctrl+Cで終了）'.format(len(self.watch_mtimes)))
+        try:
+            while not self.watch_stop_event.wait(self.WATCH_INTERVAL):
+                mtimes = self.get_watch_mtimes()
+                changed_filepaths = [filepath for filepath in mtimes if self.watch_mtimes.get(filepath) != mtimes[filepath]]
+                if len(changed_filepaths) == 0:
+                    continue
+                for filepath in changed_filepaths:
+                    self.info_log('変更検知 - {0}'.format(filepath))
+
+                # 設定ファイルに変更がある場合のみ設定を読み込み直す
+                start = time.perf_counter()
+                # NOTE: 統合したリソースファイルに変更がある場合は、統合し直すために読み込み直す
+                reload_settings = os.path.abspath(self.args.input_setting_file) in changed_filepaths or self.settings == None or not 'contents' in self.settings
+                if len(self.deduplicated_filepaths & set(changed_filepaths)) > 0:
+                    reload_settings = True
                 try:
-                    if FileSystem.exists_file(self.work_dir):
-                        FileSystem.remove_directory(self.work_dir)
-                except Exception as e:
-                    has_error = True
-                    self.info_log('一時ファイル／ディレクトリ削除中にエラーが発生しました。リトライします。')
-                    if retry_count >= 5:
-                        raise BatchBase.BatchException('一時ファイル／ディレクトリ削除中にエラーが発生しました。 {0}'.format(self.exception_info()))
-                    time.sleep(5)
-                if not has_error:
-                    break
+                    self.build(reload_settings)
+                    self.info_log('再作成 - {0:.3f}秒'.format(time.perf_counter() - start))
+                except BatchBase.BatchException as e:
+                    # 監視は継続する（ファイルを修正すれば再作成される）
+                    self.error_log(e)
+                    if reload_settings:
+                        self.settings = None
+                self.watch_mtimes = self.get_watch_mtimes()
+        except KeyboardInterrupt:
+            pass
+        self.info_log('監視終了')
+
+    def open_epub(self):
+        '''
+        epubファイル作成開始（出力ファイルと同じディレクトリの一時ファイルに書き込む。出力先がストリームの場合は直接書き込む）
+        '''
+        output = self.output_stream
+        if output == None:
+            output = '{0}.{1}.tmp'.format(self.output_filepath, uuid4().hex)
+        try:
+            self.epub_writer = EpubWriter(output, self.compression_policy, self.settings['compression']['threads'])
+        except Exception as e:
+            raise BatchBase.BatchException('epubファイル作成中にエラーが発生しました。 {0}'.format(self.exception_info()))
 
-    def load_setting_file(self):
+    def discard_epub(self):
         '''
-        設定ファイル読み込み
+        作成途中のepubファイル削除
+        '''
+        if self.epub_writer != None:
+            try:
+                self.epub_writer.close()
+            except Exception as e:
+                pass
+            if self.output_stream == None:
+                FileSystem.remove_file(self.epub_writer.filepath)
+            self.epub_writer = None
+
+    def load_previous_epub(self):
+        '''
+        前回作成したepubファイルの読み込み（差分作成の場合のみ）
+        '''
+        self.incremental = (self.args.incremental == '1' or self.watching) and self.output_stream == None
+        if not self.incremental or not FileSystem.exists_file(self.output_filepath):
+            return
+        try:
+            self.previous_epub = EpubReader(self.output_filepath)
+        except Exception as e:
+            self.warning_log('前回作成したepubファイルを読み込めないため、すべてのファイルを作成します。 {0}'.format(self.exception_info()))
+            return
+        self.info_log('差分作成 - {0}'.format(self.output_filepath))
+
+    def find_reusable_entry(self, arcname, inputs):
+        '''
+        前回作成したepubファイルから再利用できるエントリを検索する（入力データと参照した設定値が同じエントリ）
+        '''
+        if self.previous_epub == None:
+            return None
+        zip_info = self.previous_epub.find(arcname)
+        if zip_info == None or not EntryFingerprint.matches(zip_info.comment, inputs, self.setting_resolver):
+            return None
+        return zip_info
+
+    def reuse_entry(self, zip_info):
+        '''
+        前回作成したepubファイルのエントリを再利用する
+        '''
+        try:
+            self.epub_writer.copy_entry(self.previous_epub, zip_info)
+        except Exception as e:
+            raise BatchBase.BatchException('ファイル再利用中にエラーが発生しました。 {0}'.format(self.exception_info()))
+        self.info_log('ファイル再利用 - /{0}'.format(zip_info.filename))
+
+    def get_compression_digest(self):
+        '''
+        圧縮設定のダイジェスト作成（圧縮設定を変更した場合はエントリを再作成する）
+        '''
+        values = [self.compression_policy.level, sorted(self.compression_policy.stored_media_types), self.compression_policy.probe]
+        if self.compression_policy.optimize_png:
+            # NOTE: 最適化しない場合は従来と同じダイジェストにする（前回のepubファイルのエントリを再利用できるように）
+            values.append(('optimizePng', PngOptimizer.VERSION))
+        return EntryFingerprint.digest(*values)
+
+    def get_resource_inputs(self, filepath, data=None):
+        '''
+        リソースファイルのエントリの入力データのダイジェスト作成
+        '''
+        return EntryFingerprint.digest(self.get_file_digest(filepath, data), self.get_compression_digest())
+
+    def get_content_inputs(self, content_index):
+        '''
+        コンテンツファイルのエントリの入力データのダイジェスト作成
+        （テンプレート、コンテンツの置換設定、紐づけたチャプターのファイル・置換設定・タイトル等）
+        '''
+        content = self.settings['contents'][content_index]
+        filepath = content['settingFilePath']
+        template_digest = self.get_file_digest(filepath)
+        values = [template_digest, self.content_replace_rules[content_index].rules, self.get_compression_digest()]
+        if self.get_content_template(content_index).has_loop:
+            # 全チャプターのループがある場合は全チャプターのタイトルとファイルパス
+            values.append([(file['title'], file['filePath']) for file in self.settings['resources']['chapters']['files']])
+        if content['bindChapter']:
+            chapter_index = content['bindChapterIndex']
+            file = self.settings['resources']['chapters']['files'][chapter_index]
+            chapter_digest = None
+            if file['fileType'] == 'text':
+                chapter_digest = self.get_file_digest(file['settingFilePath'])
+            values.extend([chapter_digest, self.chapter_replace_rules[chapter_index].rules, self.settings['resources']['chapters']['transformMode'], file['title'], file['fileType'], file['filePath']])
+        return EntryFingerprint.digest(*values)
+
+    def get_file_digest(self, filepath, data=None):
+        '''
+        ファイルのダイジェスト取得（監視モードでは更新日時とサイズが同じファイルのダイジェストを再利用する）
+        data: 先読みしたファイルの内容（ファイルを読み込んだ場合と同じダイジェストになる）
+        '''
+        if filepath in self.generated_files:
+            return EntryFingerprint.digest(self.generated_files[filepath])
+        if data != None:
+            return hashlib.sha256(data).hexdigest()
+        if self.file_digests == None:
+            return EntryFingerprint.file_digest(filepath)
+        stat = os.stat(filepath)
+        key = (stat.st_mtime_ns, stat.st_size)
+        if filepath in self.file_digests and self.file_digests[filepath][0] == key:
+            return self.file_digests[filepath][1]
+        digest = EntryFingerprint.file_digest(filepath)
+        self.file_digests[filepath] = (key, digest)
+        return digest
+
+    def exists_source(self, filepath):
+        '''
+        入力ファイルがあるか（メモリ上のファイルを含む）
+        '''
+        return filepath in self.generated_files or FileSystem.exists_file(filepath)
+
+    def get_source_size(self, filepath):
+        '''
+        入力ファイルのサイズ取得（メモリ上のファイルはUTF-8で書き込んだ場合のサイズ）
+        '''
+        if filepath in self.generated_files:
+            data = self.generated_files[filepath]
+            return len(data) if type(data) is bytes else len(data.encode('utf-8'))
+        return FileSystem.get_file_size(filepath)
+
+    def find_reusable_contents(self):
+        '''
+        前回作成したepubファイルから再利用できるコンテンツファイルを検索する（差分作成の場合のみ）
+        '''
+        self.reusable_contents = {}
+        if self.previous_epub == None:
+            return
+        for content_index in range(len(self.settings['contents'])):
+            zip_info = self.find_reusable_entry('OEBPS/contents_{0}.xhtml'.format(content_index + 1), self.get_content_inputs(content_index))
+            if zip_info != None:
+                self.reusable_contents[content_index] = zip_info
+        self.info_log('差分作成 - 再利用するコンテンツ: {0}/{1}件'.format(len(self.reusable_contents), len(self.settings['contents'])))
+
+    def read_setting_file(self):
+        '''
+        設定ファイルの内容を読み込み、設定ファイルのディレクトリを設定する
         '''
         settings = {}
 
@@ -704,11 +3192,20 @@ class Batch(BatchBase):
         except Exception as e:
             raise BatchBase.BatchException('設定ファイル読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
 
-        self.setting_yaml_dirpath = os.path.dirname(self.args.input_setting_file)
+        # 設定ファイル中の相対パスは設定ファイルのディレクトリを基準にする
+        # NOTE: カレントディレクトリは変更しない（同じプロセスで複数のバッチを同時に実行できるようにするため）
+        self.setting_yaml_dirpath = os.path.dirname(os.path.abspath(self.args.input_setting_file))
+
+        return settings
+
+    def load_setting_file(self):
+        '''
+        設定ファイル読み込み
+        '''
+        settings = self.read_setting_file()
 
-        # カレントディレクトリを設定ファイルのディレクトリにする
-        # NOTE: 設定ファイル中の相対パスを絶対パス変換するために必要
-        os.chdir(self.setting_yaml_dirpath)
+        # 出力ファイルの相対パスも設定ファイルのディレクトリを基準にする（従来の動作と同じ）
+        self.output_filepath = os.path.join(self.setting_yaml_dirpath, self.args.output_file)
 
         self.info_log('設定ファイル読み込み')
 
@@ -751,6 +3248,53 @@ class Batch(BatchBase):
                 other_author['authorCopyRight'] = ''
         if not 'pageProgressionDirection' in settings or Utility.is_empty(settings['pageProgressionDirection']):
             settings['pageProgressionDirection'] = ''
+
+        # ------------------------------
+        # 圧縮設定値補正
+        # ------------------------------
+        compression = {
+            'level': -1,
+            'storedMediaTypes': list(CompressionPolicy.STORED_MEDIA_TYPES),
+            'probe': False,
+            'threads': 1,
+            'optimizePng': False,
+        }
+        if 'compression' in settings and type(settings['compression']) is dict:
+            if 'level' in settings['compression'] and not Utility.is_empty(settings['compression']['level']):
+                compression['level'] = settings['compression']['level']
+            if 'storedMediaTypes' in settings['compression'] and type(settings['compression']['storedMediaTypes']) is list:
+                compression['storedMediaTypes'] = settings['compression']['storedMediaTypes']
+            if 'probe' in settings['compression'] and type(settings['compression']['probe']) is bool:
+                compression['probe'] = settings['compression']['probe']
+            if 'threads' in settings['compression'] and not Utility.is_empty(settings['compression']['threads']):
+                compression['threads'] = settings['compression']['threads']
+            if 'optimizePng' in settings['compression'] and type(settings['compression']['optimizePng']) is bool:
+                compression['optimizePng'] = settings['compression']['optimizePng']
+        if not Utility.is_empty(self.args.compress_level):
+            compression['level'] = self.args.compress_level
+        if not Utility.is_empty(self.args.compress_probe):
+            compression['probe'] = self.args.compress_probe == '1'
+        if not Utility.is_empty(self.args.compress_threads):
+            compression['threads'] = self.args.compress_threads
+        if not Utility.is_empty(self.args.optimize_png):
+            compression['optimizePng'] = self.args.optimize_png == '1'
+        try:
+            compression['level'] = int(compression['level'])
+        except (TypeError, ValueError):
+            compression['level'] = -1
+        if compression['level'] < -1 or compression['level'] > 9:
+            self.warning_log('圧縮レベルの値が不正なためデフォルト値を設定します。{0}'.format(compression['level']))
+            compression['level'] = -1
+        try:
+            compression['threads'] = int(compression['threads'])
+        except (TypeError, ValueError):
+            compression['threads'] = -1
+        if compression['threads'] < 0:
+            self.warning_log('圧縮スレッド数の値が不正なためデフォルト値を設定します。{0}'.format(compression['threads']))
+            compression['threads'] = 1
+        if compression['threads'] == 0:
+            compression['threads'] = os.cpu_count() or 1
+        settings['compression'] = compression
         
         # ------------------------------
         # リソース設定値補正
@@ -767,8 +3311,10 @@ class Batch(BatchBase):
         if 'styleSheets' in settings['resources']:
             if type(settings['resources']['styleSheets']) is list:
                 for stylesheet in settings['resources']['styleSheets']:
+                    if type(stylesheet) is dict:
+                        stylesheet = ResourceRecord(stylesheet)
                     if 'filePath' in stylesheet and not Utility.is_empty(stylesheet['filePath']):
-                        if not FileSystem.exists_file(stylesheet['filePath']):
+                        if not self.exists_source(stylesheet['filePath']):
                             raise BatchBase.BatchException('指定されたファイルが見つかりません。 {0}'.format(stylesheet['filePath']))
                         stylesheet['settingFilePath'] = stylesheet['filePath']
                         stylesheet['filePath'] = './resources/' + os.path.basename(stylesheet['settingFilePath'])
@@ -781,8 +3327,10 @@ class Batch(BatchBase):
         if 'images' in settings['resources']:
             if type(settings['resources']['images']) is list:
                 for image in settings['resources']['images']:
+                    if type(image) is dict:
+                        image = ResourceRecord(image)
                     if 'filePath' in image and not Utility.is_empty(image['filePath']):
-                        if not FileSystem.exists_file(image['filePath']):
+                        if not self.exists_source(image['filePath']):
                             raise BatchBase.BatchException('指定されたファイルが見つかりません。 {0}'.format(image['filePath']))
                         image['settingFilePath'] = image['filePath']
                         image['filePath'] = './resources/' + os.path.basename(image['settingFilePath'])
@@ -790,12 +3338,26 @@ class Batch(BatchBase):
                     images.append(image)
         settings['resources']['images'] = images
 
+        # 同じ内容のリソースファイルを統合するか
+        deduplicate = False
+        if 'deduplicate' in settings['resources'] and type(settings['resources']['deduplicate']) is bool:
+            deduplicate = settings['resources']['deduplicate']
+        settings['resources']['deduplicate'] = deduplicate
+
         # チャプター
         chapters = {
+            'transformMode': 'line',
             'replaces': [],
             'files': [],
         }
         if 'chapters' in settings['resources']:
+            if 'transformMode' in settings['resources']['chapters'] and not Utility.is_empty(settings['resources']['chapters']['transformMode']):
+                transform_mode = settings['resources']['chapters']['transformMode']
+                if transform_mode in ('line', 'document'):
+                    chapters['transformMode'] = transform_mode
+                else:
+                    self.warning_log('transformModeの値が不正なためデフォルト値を設定します。{0}'.format(chapters['transformMode']))
+
             replaces = []
             if 'replaces' in settings['resources']['chapters']:
                 if type(settings['resources']['chapters']['replaces']) is list:
@@ -828,7 +3390,7 @@ class Batch(BatchBase):
                         setting_filepath = ''
                         if 'filePath' in file:
                             setting_filepath = file['filePath']
-                        if not FileSystem.exists_file(setting_filepath):
+                        if not self.exists_source(setting_filepath):
                             raise BatchBase.BatchException('指定されたファイルが見つかりません。 {0}'.format(setting_filepath))
                         if 'fileType' in file:
                             filetype = file['fileType']
@@ -859,15 +3421,16 @@ class Batch(BatchBase):
                                             'placeHolder': place_holder,
                                             'replaceContent': replace_content,
                                         })
-                        files.append({
+                        # NOTE: チャプター数が多い場合に備えて、置換設定は変更しないタプルで保持する（置換設定がない場合は共有される）
+                        files.append(ChapterRecord({
                             'title': title,
                             'fileType': filetype,
                             'filePath': '',     # チャプターのファイルパスは後で補正
                             'manifestFilePath': '', # 〃
                             'settingFilePath': setting_filepath,
                             'bindContent': False,
-                            'replaces': replaces
-                        })
+                            'replaces': tuple(replaces),
+                        }))
             chapters['files'] = files
 
         settings['resources']['chapters'] = chapters
@@ -881,7 +3444,7 @@ class Batch(BatchBase):
                     setting_filepath = ''
                     if 'filePath' in file and not Utility.is_empty(file['filePath']):
                         setting_filepath = file['filePath']
-                    if not FileSystem.exists_file(setting_filepath):
+                    if not self.exists_source(setting_filepath):
                         raise BatchBase.BatchException('指定されたファイルが見つかりません。 {0}'.format(setting_filepath))
                     is_navigation_content = False
                     if 'isNavigationContent' in file and not Utility.is_empty(file['isNavigationContent']):
@@ -914,6 +3477,7 @@ class Batch(BatchBase):
                                         'placeHolder': place_holder,
                                         'replaceContent': replace_content,
                                     })
+                    replaces = tuple(replaces)
                     use_chapters = []
                     if 'useChapters' in file:
                         if type(file['useChapters']) is list:
@@ -928,7 +3492,7 @@ class Batch(BatchBase):
                                     })
                                 # チャプター分作成する場合は、コンテンツ配列も追加する
                                 content_index = len(contents) + 1
-                                contents.append({
+                                contents.append(ContentRecord({
                                     'filePath': './contents_{0}.xhtml'.format(content_index),
                                     'manifestFilePath': './contents_{0}.xhtml'.format(content_index),
                                     'settingFilePath': setting_filepath,
@@ -940,7 +3504,7 @@ class Batch(BatchBase):
                                     'bindChapter': True,
                                     'bindChapterIndex': use_chapter['chapterIndex'] - 1,
                                     'spineHidden': False,
-                                })
+                                }))
                                 # チャプターのファイルパスを補正する
                                 chapter = settings['resources']['chapters']['files'][use_chapter['chapterIndex'] - 1]
                                 if chapter['fileType'] == 'text':
@@ -954,7 +3518,7 @@ class Batch(BatchBase):
 
                     else:
                         content_index = len(contents) + 1
-                        contents.append({
+                        contents.append(ContentRecord({
                             'filePath': './contents_{0}.xhtml'.format(content_index),
                             'manifestFilePath': './contents_{0}.xhtml'.format(content_index),
                             'settingFilePath': setting_filepath,
@@ -966,7 +3530,7 @@ class Batch(BatchBase):
                             'bindChapter': False,
                             'bindChapterIndex': None,
                             'spineHidden': False,
-                        })
+                        }))
 
         # ------------------------------
         # 設定ファイルのチェック
@@ -982,7 +3546,7 @@ class Batch(BatchBase):
                 break
         if not has_navigation_content:
             self.warning_log('目次コンテンツ未指定のためダミーの目次コンテンツを作成します。')
-            navigation_content_file = os.path.join(self.work_dir, str(uuid4().int))
+            navigation_content_file = os.path.join(self.setting_yaml_dirpath, str(uuid4().int))
             data = '''
 <?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE html>
@@ -1000,16 +3564,13 @@ class Batch(BatchBase):
 </body>
 </html>
             '''
+            # NOTE: ファイルには書き込まず、メモリ上のファイルとして扱う
             try:
-                if FileSystem.exists_file(navigation_content_file):
-                    FileSystem.remove_file(navigation_content_file)
-                with open(navigation_content_file, 'w', encoding='utf-8') as f:
-                    f.write(Convert.get_pretty_xml(data))
-                    f.close()
+                self.generated_files[navigation_content_file] = Convert.get_pretty_xml(data)
             except Exception as e:
                 raise BatchBase.BatchException('目次コンテンツファイル作成中にエラーが発生しました。 {0}'.format(self.exception_info()))
 
-            contents.append({
+            contents.append(ContentRecord({
                 'filePath': './contents_{0}.xhtml'.format(len(contents) + 1),
                 'manifestFilePath': './contents_{0}.xhtml'.format(len(contents) + 1),
                 'settingFilePath': navigation_content_file,
@@ -1021,380 +3582,803 @@ class Batch(BatchBase):
                 'bindChapter': False,
                 'bindChapterIndex': None,
                 'spineHidden': True,
-            })
+            }))
 
         settings['contents'] = contents
 
         self.settings = settings
 
-        # 設定ファイルの内容を一次元配列で持つ
-        self.convert_yaml_to_list('setting', self.settings, self.replaces)
-        for key in self.replaces:
-            self.debug_log('{0} => {1}'.format(key, self.replaces[key]))
+        # 同じ内容のリソースファイルの統合
+        self.deduplicate_resource_files()
+
+        # 圧縮方式
+        self.compression_policy = CompressionPolicy(compression['level'], compression['storedMediaTypes'], compression['probe'], compression['optimizePng'])
+
+        # 置換ルールのコンパイル
+        try:
+            self.compile_replace_rules()
+        except re.error as e:
+            raise BatchBase.BatchException('置換設定の正規表現が不正です。 {0}'.format(self.exception_info()))
+
+        # 設定値の置換
+        self.setting_resolver = SettingResolver(self.settings)
+        if self.debug:
+            replaces = {}
+            self.convert_yaml_to_list('setting', self.settings, replaces)
+            for key in replaces:
+                self.debug_log('{0} => {1}'.format(key, replaces[key]))
+
+    def deduplicate_resource_files(self):
+        '''
+        同じ内容のリソースファイル（スタイルシート、画像、画像のチャプター）を1つのエントリに統合する
+        後に指定したファイルのfilePath・manifestFilePathは、最初に指定したファイルのパスにする
+        '''
+        self.resource_aliases = {}
+        self.deduplicated_filepaths = set()
+        self.deduplicated_size = 0
+        resources = self.settings['resources']
+        if not resources['deduplicate']:
+            return
+
+        # 配置するファイル（epubファイル内のパス, 設定値）
+        records = []
+        for stylesheet in resources['styleSheets']:
+            if 'settingFilePath' in stylesheet and not Utility.is_empty(stylesheet['settingFilePath']):
+                records.append(('./resources/' + os.path.basename(stylesheet['settingFilePath']), stylesheet))
+        for image in resources['images']:
+            if 'settingFilePath' in image and not Utility.is_empty(image['settingFilePath']):
+                records.append(('./resources/' + os.path.basename(image['settingFilePath']), image))
+        for file in resources['chapters']['files']:
+            if file['fileType'] != 'text' and not Utility.is_empty(file['settingFilePath']):
+                records.append(('./contents/' + os.path.basename(file['settingFilePath']), file))
+
+        # NOTE: 同じファイル名のファイルは後に指定したファイルで上書きする（deploy_resource_files()と同じ）
+        entries = {}
+        for filepath, record in records:
+            entries[filepath] = record['settingFilePath']
+
+        # 内容（サイズとダイジェスト） => 最初に指定したファイルのepubファイル内のパス
+        canonical_filepaths = {}
+        for filepath in entries:
+            try:
+                size = self.get_source_size(entries[filepath])
+                key = (size, self.get_file_digest(entries[filepath]))
+            except Exception as e:
+                raise BatchBase.BatchException('リソースファイル読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
+            if not key in canonical_filepaths:
+                canonical_filepaths[key] = filepath
+                continue
+            self.resource_aliases['OEBPS/' + filepath[2:]] = canonical_filepaths[key]
+            self.deduplicated_filepaths.add(os.path.abspath(entries[filepath]))
+            self.deduplicated_filepaths.add(os.path.abspath(entries[canonical_filepaths[key]]))
+            self.deduplicated_size += size
+            self.info_log('リソースファイルの統合 - {0} -> {1}'.format(filepath, canonical_filepaths[key]))
+
+        for filepath, record in records:
+            canonical_filepath = self.resource_aliases.get('OEBPS/' + filepath[2:])
+            if canonical_filepath == None:
+                continue
+            for key in ['filePath', 'manifestFilePath']:
+                if key in record and not Utility.is_empty(record[key]):
+                    record[key] = canonical_filepath
+
+    def compile_replace_rules(self):
+        '''
+        置換ルールのコンパイル
+        '''
+        # チャプター共通の置換
+        self.chapters_replace_rules = ReplaceRules.compile(self.settings['resources']['chapters']['replaces'])
+
+        # チャプター毎の置換（チャプター共通の置換→該当チャプターの置換の順に実行する）
+        # NOTE: チャプター共通の置換がない場合は該当チャプターの置換も実行しない
+        self.chapter_replace_rules = []
+        for file in self.settings['resources']['chapters']['files']:
+            if len(self.chapters_replace_rules) > 0:
+                self.chapter_replace_rules.append(self.chapters_replace_rules + ReplaceRules.compile(file['replaces']))
+            else:
+                self.chapter_replace_rules.append(ReplaceRules())
+
+        # コンテンツ毎の置換（同じ設定から作成されたコンテンツは置換ルールを共有する）
+        self.content_replace_rules = []
+        compiled_rules = {}
+        for content in self.settings['contents']:
+            key = id(content['replaces'])
+            if not key in compiled_rules:
+                compiled_rules[key] = ReplaceRules.compile(content['replaces'])
+            self.content_replace_rules.append(compiled_rules[key])
 
     def deploy_resource_files(self):
         '''
         リソースファイル配置
         '''
 
+        # NOTE: 同じファイル名のファイルは後に指定したファイルで上書きする
+        deploy_files = {}
+
         # スタイルシート: /OEBPS/resources
         for stylesheet in self.settings['resources']['styleSheets']:
-            if stylesheet['settingFilePath'] != '':
-                try:
-                    FileSystem.copy_file(stylesheet['settingFilePath'], self.oebps_resources_dirpath)
-                except Exception as e:
-                    raise BatchBase.BatchException('チャプターファイル読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
-                self.info_log('リソースファイルのコピー - /OEBPS/resources/{0}'.format(os.path.basename(stylesheet['settingFilePath'])))
+            if 'settingFilePath' in stylesheet and stylesheet['settingFilePath'] != '':
+                deploy_files['OEBPS/resources/{0}'.format(os.path.basename(stylesheet['settingFilePath']))] = stylesheet['settingFilePath']
 
         # 画像: /OEBPS/resources
         for image in self.settings['resources']['images']:
-            if stylesheet['settingFilePath'] != '':
-                try:
-                    FileSystem.copy_file(image['settingFilePath'], self.oebps_resources_dirpath)
-                except Exception as e:
-                    raise BatchBase.BatchException('リソースファイル読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
-                self.info_log('リソースファイルのコピー - /OEBPS/resources/{0}'.format(os.path.basename(image['settingFilePath'])))
+            if 'settingFilePath' in image and image['settingFilePath'] != '':
+                deploy_files['OEBPS/resources/{0}'.format(os.path.basename(image['settingFilePath']))] = image['settingFilePath']
 
         # コンテンツ（画像のみ）: /OEBPS/contents
         for file in self.settings['resources']['chapters']['files']:
             if not file['fileType'] == 'text' and file['settingFilePath'] != '':
-                try:
-                    FileSystem.copy_file(file['settingFilePath'], self.oebps_contents_dirpath)
-                except Exception as e:
-                    raise BatchBase.BatchException('リソースファイル読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
-                self.info_log('リソースファイルのコピー - /OEBPS/contents/{0}'.format(os.path.basename(file['settingFilePath'])))
+                deploy_files['OEBPS/contents/{0}'.format(os.path.basename(file['settingFilePath']))] = file['settingFilePath']
+
+        # 同じ内容のファイルは最初に指定したファイルのみ配置する
+        for arcname in self.resource_aliases:
+            deploy_files.pop(arcname, None)
+        if len(self.resource_aliases) > 0:
+            self.info_log('リソースファイルの統合 - {0}件 / 削減: {1}バイト'.format(len(self.resource_aliases), self.deduplicated_size))
+
+        # NOTE: 最適化するPNGファイルは最適化の処理で読み込むため先読みしない
+        png_filepaths = []
+        if self.compression_policy.optimize_png:
+            png_filepaths = [deploy_files[arcname] for arcname in deploy_files if mimetypes.guess_type(arcname)[0] == 'image/png']
+        self.open_png_optimizer(png_filepaths)
+        self.open_file_prefetcher([deploy_files[arcname] for arcname in deploy_files if not deploy_files[arcname] in png_filepaths])
+        try:
+            for arcname in deploy_files:
+                with self.profile_item('resource', deploy_files[arcname], arcname, deploy_files[arcname]) as item:
+                    self.deploy_resource_file(arcname, deploy_files[arcname], item)
+        finally:
+            self.close_file_prefetcher()
+            self.close_png_optimizer()
+
+    def deploy_resource_file(self, arcname, filepath, item):
+        '''
+        リソースファイル1件分の配置
+        '''
+        comment = None
+        data = self.get_prefetched_data(filepath)
+        if self.incremental:
+            try:
+                inputs = self.get_resource_inputs(filepath, data)
+            except Exception as e:
+                raise BatchBase.BatchException('リソースファイル読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
+            zip_info = self.find_reusable_entry(arcname, inputs)
+            if zip_info != None:
+                self.reuse_entry(zip_info)
+                item['reused'] = True
+                return
+            comment = EntryFingerprint.create(inputs)
+        optimized = self.optimize_png_file(filepath)
+        if optimized != None:
+            item['optimizedSize'] = len(optimized)
+            data = optimized
+        try:
+            if filepath in self.generated_files:
+                if data == None:
+                    data = self.generated_files[filepath]
+                self.epub_writer.write_data(arcname, data if type(data) is bytes else data.encode('utf-8'), comment=comment)
+            else:
+                self.epub_writer.write_file(arcname, filepath, comment=comment, data=data)
+        except Exception as e:
+            raise BatchBase.BatchException('リソースファイル読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
+        self.info_log('リソースファイルの配置 - /{0}'.format(arcname))
+
+    def open_png_optimizer(self, filepaths):
+        '''
+        PNG最適化の準備（並列プロセス数が2以上の場合はプロセスプールを作成し、配置する順に先行して最適化する）
+        チャプターキャッシュを使用する場合は、最適化結果を画像キャッシュに保存する
+        '''
+        self.png_order = list(dict.fromkeys(filepaths))
+        self.png_positions = dict([(filepath, position) for position, filepath in enumerate(self.png_order)])
+        self.png_executor = None
+        self.png_submitted = 0
+        self.png_futures = {}
+        self.png_statistics = {'files': 0, 'optimized': 0, 'hits': 0, 'savedSize': 0}
+        self.image_cache = None
+        if len(self.png_order) == 0:
+            return
+        jobs = min(self.get_jobs(), len(self.png_order))
+        try:
+            if self.chapter_cache != None:
+                self.image_cache = ImageCache(os.path.join(self.chapter_cache.dirpath, ImageCache.DIRNAME), self.chapter_cache.max_size)
+            if jobs > 1:
+                self.info_log('PNG最適化 - 並列実行（プロセス数: {0}）'.format(jobs))
+                self.png_prefetch = jobs * self.PREFETCH_FACTOR
+                self.png_executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        except Exception as e:
+            raise BatchBase.BatchException('PNGファイルの最適化の準備中にエラーが発生しました。 {0}'.format(self.exception_info()))
+
+    def close_png_optimizer(self):
+        '''
+        プロセスプールの終了と最適化結果の出力（画像キャッシュのサイズの上限を超えた場合は古いものから削除する）
+        '''
+        if self.png_executor != None:
+            self.png_executor.shutdown(cancel_futures=True)
+            self.png_executor = None
+        self.png_futures = {}
+        if self.png_statistics == None or self.png_statistics['files'] == 0:
+            return
+        if self.image_cache != None and self.png_statistics['hits'] < self.png_statistics['files']:
+            self.image_cache.evict()
+        self.info_log('PNG最適化 - 対象: {0}件 / 最適化: {1}件 / 画像キャッシュ: {2}件 / 削減: {3}バイト'.format(self.png_statistics['files'], self.png_statistics['optimized'], self.png_statistics['hits'], self.png_statistics['savedSize']))
+
+    def get_png_task(self, filepath):
+        '''
+        PNG最適化の引数（ファイルパス, メモリ上のファイルの内容, 画像キャッシュのディレクトリ）
+        '''
+        data = self.generated_files.get(filepath)
+        return (filepath, data if type(data) is bytes else None, None if self.image_cache == None else self.image_cache.dirpath)
+
+    def optimize_png_file(self, filepath):
+        '''
+        PNGファイルの最適化（最適化したデータを返す。対象外・最適化しない場合はNone）
+        '''
+        if self.png_positions == None or not filepath in self.png_positions:
+            return None
+        if filepath in self.generated_files and type(self.generated_files[filepath]) is not bytes:
+            return None
+        try:
+            if self.png_executor != None:
+                position = self.png_positions[filepath]
+                while self.png_submitted < len(self.png_order) and self.png_submitted <= position + self.png_prefetch:
+                    submit_filepath = self.png_order[self.png_submitted]
+                    self.png_submitted += 1
+                    self.png_futures[submit_filepath] = self.png_executor.submit(PngOptimizer.optimize_file, *self.get_png_task(submit_filepath))
+            if filepath in self.png_futures:
+                optimized, size, hit = self.png_futures.pop(filepath).result()
+            else:
+                optimized, size, hit = PngOptimizer.optimize_file(*self.get_png_task(filepath))
+        except Exception as e:
+            raise BatchBase.BatchException('PNGファイルの最適化中にエラーが発生しました。 {0}'.format(self.exception_info()))
+        self.png_statistics['files'] += 1
+        if hit:
+            self.png_statistics['hits'] += 1
+        if optimized != None:
+            self.png_statistics['optimized'] += 1
+            self.png_statistics['savedSize'] += size - len(optimized)
+            self.debug_log('PNG最適化 - {0} ({1} -> {2})'.format(filepath, size, len(optimized)))
+        return optimized
+
+    def open_file_prefetcher(self, filepaths):
+        '''
+        ファイルの先読み開始（メモリ上のファイルは対象外）
+        '''
+        try:
+            read_ahead = int(self.args.read_ahead)
+        except (TypeError, ValueError):
+            raise BatchBase.BatchException('先行して読み込むファイル数の指定が不正です。 {0}'.format(self.args.read_ahead))
+        if read_ahead < 0:
+            raise BatchBase.BatchException('先行して読み込むファイル数の指定が不正です。 {0}'.format(self.args.read_ahead))
+        self.file_prefetcher = FilePrefetcher([filepath for filepath in filepaths if not filepath in self.generated_files], read_ahead)
+        self.file_prefetcher.start()
+
+    def close_file_prefetcher(self):
+        '''
+        ファイルの先読み終了
+        '''
+        if self.file_prefetcher == None:
+            return
+        self.file_prefetcher.close()
+        self.debug_log('ファイルの先読み - ヒット: {0}件 / ミス: {1}件'.format(self.file_prefetcher.hits, self.file_prefetcher.misses))
+        self.file_prefetcher = None
+
+    def get_prefetched_data(self, filepath):
+        '''
+        先読みしたファイルの内容取得（先読みしていない場合はNone）
+        '''
+        if self.file_prefetcher == None:
+            return None
+        return self.file_prefetcher.get(filepath)
 
     def load_chapter_files(self):
         '''
         チャプターファイル読み込み
+        （本文データは紐づけたコンテンツファイルの作成時に読み込み、書き込み後に解放する）
         '''
 
         chapter_count = 0
 
-        chapters_replaces = self.settings['resources']['chapters']['replaces']
-
+        transform_mode = self.settings['resources']['chapters']['transformMode']
+
+        # 差分作成の場合は、再作成するコンテンツに紐づけたチャプターのみ変換する
+        # NOTE: 同じチャプターを複数のコンテンツに紐づけた場合は、最後のコンテンツファイルの作成後に解放する
+        self.chapter_references = collections.Counter()
+        for content_index, content in enumerate(self.settings['contents']):
+            if content['bindChapter'] and not content_index in self.reusable_contents:
+                self.chapter_references[content['bindChapterIndex']] += 1
+
+        # テキストのチャプターの変換対象（チャプターのインデックス => チャプターのインデックス, ファイルパス, 置換方式）
+        # NOTE: サイズが大きいチャプターは変換せず、コンテンツファイル作成時に読み込みながら書き込む
+        self.chapter_tasks = {}
+        self.chapter_streams = set()
+        self.chapter_cache_keys = {}
+        stream_size = self.get_stream_size()
         for file in self.settings['resources']['chapters']['files']:
+            replace_rules = self.chapter_replace_rules[chapter_count]
             chapter_count += 1
+            file.body = None
 
-            title = file['title']
-            filetype = file['fileType']
-            filepath = file['filePath']
             setting_filepath = file['settingFilePath']
-            if not FileSystem.exists_file(setting_filepath):
+            if not self.exists_source(setting_filepath):
                 raise BatchBase.BatchException('チャプターファイルが見つかりません。: {0}'.format(setting_filepath))
-            body = ''
-            if filetype == 'text':
+            if self.previous_epub != None and not chapter_count - 1 in self.chapter_references:
+                continue
+            if file['fileType'] == 'text':
                 # テキストの場合は本文データの置換実行
-                try:
-                    with open(setting_filepath, 'r', encoding='utf-8') as f:
-                        lines = f.read().splitlines()
-                        for line in lines:
-                            line = line + '\n'
-                            if len(chapters_replaces) > 0:
-                                # チャプター共通の置換
-                                line = self.content_replace(line, chapters_replaces)
-                                # 該当チャプターの置換
-                                line = self.content_replace(line, file['replaces'])
-                            line = self.content_replace_by_setting(line)
-                            body = body + line
-                        f.close()
-                except Exception as e:
-                    raise BatchBase.BatchException('チャプターファイル読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
-
-            # チャプターデータを収集
-            self.chapters.append({
-                'title': title,
-                'body': body,
-                'fileType': filetype,
-                'filePath': filepath,
-                'replaces': [
-                    {
-                        'type': 'simple',
-                        'placeHolder': '{$chapter.title}',
-                        'replaceContent': title,
-                    },
-                    {
-                        'type': 'simple',
-                        'placeHolder': '{$chapter.body}',
-                        'replaceContent': body,
-                    },
-                    {
-                        'type': 'simple',
-                        'placeHolder': '{$chapter.filePath}',
-                        'replaceContent': file['filePath']
-                    },
-                ]
-            })
+                task_transform_mode = transform_mode
+                if transform_mode == 'document' and not replace_rules.line_local:
+                    self.warning_log('行をまたいでマッチする可能性のある置換設定があるため、行単位で置換します。 {0}'.format(setting_filepath))
+                    task_transform_mode = 'line'
+                self.chapter_tasks[chapter_count - 1] = (chapter_count - 1, setting_filepath, task_transform_mode)
+                if stream_size != None and self.get_source_size(setting_filepath) >= stream_size:
+                    self.chapter_streams.add(chapter_count - 1)
+                    self.debug_log('チャプターファイルを直接書き込みます。 {0}'.format(setting_filepath))
+
+            self.debug_log('リソースファイルの読み込み - {0}'.format(file['filePath']))
+
+        self.chapters = self.settings['resources']['chapters']['files']
+
+        # 変換する順（コンテンツファイルの作成順）
+        self.chapter_order = {}
+        for content_index, content in enumerate(self.settings['contents']):
+            chapter_index = content['bindChapterIndex']
+            if content['bindChapter'] and not content_index in self.reusable_contents and chapter_index in self.chapter_tasks and not chapter_index in self.chapter_streams and not chapter_index in self.chapter_order:
+                self.chapter_order[chapter_index] = len(self.chapter_order)
+        self.chapter_order_indexes = list(self.chapter_order.keys())
+        self.open_chapter_executor()
+
+    def open_chapter_executor(self):
+        '''
+        並列プロセス数が2以上の場合はチャプター変換のプロセスプールを作成する（ファイルが小さい場合は逐次実行する）
+        '''
+        self.chapter_executor = None
+        self.chapter_submitted = 0
+        self.chapter_futures = {}
+        jobs = min(self.get_jobs(), len(self.chapter_order))
+        if jobs > 1:
+            total_size = 0
+            for chapter_index in self.chapter_order:
+                total_size += self.get_source_size(self.chapter_tasks[chapter_index][1])
+            if total_size < self.PARALLEL_MIN_SIZE:
+                self.debug_log('チャプターファイルが小さいため逐次実行します。 {0}'.format(total_size))
+                jobs = 1
+        if jobs <= 1:
+            # 逐次実行する場合は、変換する順にチャプターファイルを先読みする
+            self.open_file_prefetcher([self.chapter_tasks[chapter_index][1] for chapter_index in self.chapter_order_indexes])
+            return
+
+        self.info_log('チャプター変換 - 並列実行（プロセス数: {0}）'.format(jobs))
+        self.chapter_prefetch = jobs * self.PREFETCH_FACTOR
+        try:
+            self.chapter_executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=ChapterTransformer.initialize_worker, initargs=(self.setting_resolver, self.chapter_replace_rules, self.generated_files))
+        except Exception as e:
+            raise BatchBase.BatchException('チャプターファイル読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
+
+    def close_chapter_files(self):
+        '''
+        チャプターの本文データの解放とプロセスプールの終了（チャプターキャッシュのサイズの上限を超えた場合は古いものから削除する）
+        '''
+        if self.chapter_executor != None:
+            self.chapter_executor.shutdown(cancel_futures=True)
+            self.chapter_executor = None
+        self.close_file_prefetcher()
+        self.chapter_futures = {}
+        for chapter in self.chapters:
+            chapter.body = None
+
+        if self.chapter_cache != None:
+            if self.chapter_cache.stores > 0:
+                self.chapter_cache.evict()
+            self.info_log('チャプターキャッシュ - ヒット: {0}件 / ミス: {1}件 / 保存: {2}件 / 削除: {3}件'.format(self.chapter_cache.hits, self.chapter_cache.misses, self.chapter_cache.stores, self.chapter_cache.evictions))
+
+    def load_chapter_body(self, chapter_index):
+        '''
+        チャプターの本文データ読み込み（読み込み済みの場合はそのまま返す）
+        '''
+        chapter = self.chapters[chapter_index]
+        if chapter.body != None:
+            return chapter.body
+        if chapter_index in self.chapter_streams:
+            index, filepath, transform_mode = self.chapter_tasks[chapter_index]
+            chapter.body = ChapterStream(self.setting_resolver, filepath, self.chapter_replace_rules[chapter_index], transform_mode, self.generated_files)
+        elif chapter_index in self.chapter_tasks:
+            chapter.body = self.transform_chapter(chapter_index)
+        else:
+            # 画像のチャプター、差分作成で変換しないチャプター
+            chapter.body = []
+        return chapter.body
 
-            self.debug_log('リソースファイルの読み込み - {0}'.format(filepath))
+    def release_chapter_body(self, chapter_index):
+        '''
+        チャプターの本文データの解放（本文データを使用するコンテンツファイルを全て作成した場合のみ）
+        '''
+        self.chapter_references[chapter_index] -= 1
+        if self.chapter_references[chapter_index] <= 0:
+            self.chapters[chapter_index].body = None
 
-    def create_mimetype(self):
+    def get_chapter_cache_key(self, chapter_index, data=None):
+        '''
+        チャプターキャッシュのキー取得（data: 先読みしたチャプターファイルの内容）
+        '''
+        if not chapter_index in self.chapter_cache_keys:
+            index, filepath, transform_mode = self.chapter_tasks[chapter_index]
+            try:
+                self.chapter_cache_keys[chapter_index] = EntryFingerprint.digest(self.get_file_digest(filepath, data), self.chapter_replace_rules[chapter_index].rules, transform_mode)
+            except Exception as e:
+                raise BatchBase.BatchException('チャプターファイル読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
+        return self.chapter_cache_keys[chapter_index]
+
+    def transform_chapter(self, chapter_index):
+        '''
+        テキストのチャプターファイルを変換し、本文データを返す（チャプターキャッシュにある場合は変換しない）
+        置換したプレースホルダのパスはchapter_setting_pathsに保持する
+        '''
+        index, filepath, transform_mode = self.chapter_tasks[chapter_index]
+        data = self.get_prefetched_data(filepath)
+
+        # チャプターキャッシュから取得
+        if self.chapter_cache != None:
+            with self.profile_item('chapterCache', filepath) as item:
+                cached = self.chapter_cache.get(self.get_chapter_cache_key(chapter_index, data), self.setting_resolver)
+                item['hit'] = cached != None
+            if cached != None:
+                body, self.chapter_setting_paths[chapter_index] = cached
+                self.debug_log('チャプターキャッシュ - ヒット: {0}'.format(filepath))
+                return body
+
+        if self.chapter_executor != None:
+            self.submit_chapter_tasks(chapter_index)
+        if chapter_index in self.chapter_futures:
+            body = self.receive_chapter_task(chapter_index)
+        else:
+            with self.profile_item('chapter', filepath, filepath=filepath) as item:
+                self.setting_resolver.accessed = set()
+                body = self.transform_chapter_file(filepath, self.chapter_replace_rules[chapter_index], transform_mode, data)
+                self.chapter_setting_paths[chapter_index] = self.setting_resolver.accessed
+                self.setting_resolver.accessed = None
+                item['transformMode'] = transform_mode
+                item['rules'] = len(self.chapter_replace_rules[chapter_index])
+
+        # チャプターキャッシュに保存
+        if self.chapter_cache != None:
+            if not self.chapter_cache.put(self.get_chapter_cache_key(chapter_index), body, self.setting_resolver, self.chapter_setting_paths[chapter_index]):
+                self.warning_log('チャプターキャッシュに保存できませんでした。 {0}'.format(filepath))
+        return body
+
+    def submit_chapter_tasks(self, chapter_index):
         '''
-        ファイル作成 - /mimetype
+        プロセスプールでの変換開始（変換するチャプターと、その後に作成するチャプターを先行して変換する）
         '''
+        position = self.chapter_order[chapter_index]
+        while self.chapter_submitted < len(self.chapter_order) and self.chapter_submitted <= position + self.chapter_prefetch:
+            submit_index = self.chapter_order_indexes[self.chapter_submitted]
+            self.chapter_submitted += 1
+            # NOTE: チャプターキャッシュにあるチャプターは変換しない
+            if self.chapter_cache != None and FileSystem.exists_file(self.chapter_cache.get_filepath(self.get_chapter_cache_key(submit_index))) and submit_index != chapter_index:
+                continue
+            try:
+                self.chapter_futures[submit_index] = self.chapter_executor.submit(ChapterTransformer.transform_in_worker, self.chapter_tasks[submit_index])
+            except Exception as e:
+                raise BatchBase.BatchException('チャプターファイル読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
 
-        self.mimetype_filepath = os.path.join(self.work_dir, 'mimetype')
-
-        if FileSystem.exists_file(self.mimetype_filepath):
-            FileSystem.remove_file(self.mimetype_filepath)
-
+    def receive_chapter_task(self, chapter_index):
+        '''
+        プロセスプールでの変換結果の受け取り
+        '''
+        index, filepath, transform_mode = self.chapter_tasks[chapter_index]
         try:
-            with open(self.mimetype_filepath, 'w', encoding='utf-8') as f:
-                f.write('application/epub+zip')
-                f.close()
+            body, setting_paths, duration = self.chapter_futures.pop(chapter_index).result()
         except Exception as e:
-            raise BatchBase.BatchException('mimetypeファイル作成中にエラーが発生しました。 {0}'.format(self.exception_info()))
-
-        self.info_log('ファイル作成 - /mimetype')
-
-    def create_meta_inf(self):
+            raise BatchBase.BatchException('チャプターファイル読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
+        self.chapter_setting_paths[chapter_index] = setting_paths
+        if self.profiler != None:
+            # NOTE: 処理時間はワーカープロセスで変換した時間
+            item = self.profiler.create_item('chapter', filepath, filepath=filepath)
+            item.update({'duration': duration, 'transformMode': transform_mode, 'rules': len(self.chapter_replace_rules[chapter_index])})
+            self.profiler.add_item(item)
+        return body
+
+    def get_jobs(self):
+        '''
+        並列プロセス数取得
+        '''
+        try:
+            jobs = int(self.args.jobs)
+        except (TypeError, ValueError):
+            raise BatchBase.BatchException('並列プロセス数の指定が不正です。 {0}'.format(self.args.jobs))
+        if jobs < 0:
+            raise BatchBase.BatchException('並列プロセス数の指定が不正です。 {0}'.format(self.args.jobs))
+        if jobs == 0:
+            jobs = os.cpu_count() or 1
+        return jobs
+
+    def get_stream_size(self):
+        '''
+        チャプターファイルを直接書き込むサイズ取得（バイト、直接書き込まない場合はNone）
         '''
-        ディレクトリ作成 - /META-INF
+        if Utility.is_empty(self.args.stream_size):
+            return None
+        try:
+            stream_size = float(self.args.stream_size)
+        except (TypeError, ValueError):
+            raise BatchBase.BatchException('チャプターファイルを直接書き込むサイズの指定が不正です。 {0}'.format(self.args.stream_size))
+        if stream_size < 0:
+            raise BatchBase.BatchException('チャプターファイルを直接書き込むサイズの指定が不正です。 {0}'.format(self.args.stream_size))
+        return int(stream_size * 1024 * 1024)
+
+    def transform_chapter_file(self, filepath, replace_rules, transform_mode='line', data=None):
+        '''
+        チャプターファイルを読み込み、置換した本文データを分割された文字列のリストで返す（data: 先読みしたファイルの内容）
         '''
+        source_files = self.generated_files if data == None else {filepath: data}
+        try:
+            return ChapterTransformer(self.setting_resolver, source_files=source_files).transform(filepath, replace_rules, transform_mode)
+        except Exception as e:
+            raise BatchBase.BatchException('チャプターファイル読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
 
-        self.meta_inf_dirpath = os.path.join(self.work_dir, 'META-INF')
+    def create_mimetype(self):
+        '''
+        ファイル作成 - /mimetype
+        '''
 
+        # mimetypeはzipファイルの先頭に、かつ圧縮なしで登録
         try:
-            if FileSystem.exists_file(self.meta_inf_dirpath):
-                FileSystem.remove_directory(self.meta_inf_dirpath)
-            FileSystem.create_directory(self.meta_inf_dirpath)
+            self.epub_writer.write_text('mimetype', 'application/epub+zip', zipfile.ZIP_STORED)
         except Exception as e:
-            raise BatchBase.BatchException('/META-INFディレクトリ作成中にエラーが発生しました。 {0}'.format(self.exception_info()))
+            raise BatchBase.BatchException('mimetypeファイル作成中にエラーが発生しました。 {0}'.format(self.exception_info()))
 
-        self.info_log('ディレクトリ作成 - /META-INF')
+        self.info_log('ファイル作成 - /mimetype')
 
     def create_meta_inf_container_xml(self):
         '''
         ファイル作成 - /META-INF/container.xml
         '''
 
-        container_xml_filepath = os.path.join(self.meta_inf_dirpath, 'container.xml')
-
-        data = '''
-<?xml version="1.0" encoding="UTF-8"?>
-<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
-	<rootfiles>
-		<rootfile full-path="OEBPS/book.opf" media-type="application/oebps-package+xml"/>
-	</rootfiles>
-</container>
-'''
         try:
-            if FileSystem.exists_file(container_xml_filepath):
-                FileSystem.remove_file(container_xml_filepath)
-            with open(container_xml_filepath, 'w', encoding='utf-8') as f:
-                f.write(Convert.get_pretty_xml(data))
-                f.close()
+            self.epub_writer.write_text('META-INF/container.xml', self.CONTAINER_XML)
         except Exception as e:
             raise BatchBase.BatchException('/META-INF/container.xmlファイル作成中にエラーが発生しました。 {0}'.format(self.exception_info()))
 
         self.info_log('ファイル作成 - /META-INF/container.xml')
 
-    def create_oebps(self):
+    def create_oebps_content_files(self):
         '''
-        ディレクトリ作成 - /OEBPS
+        コンテンツファイル作成
         '''
+        content_count = 0
+        try:
+            for content in self.settings['contents']:
+                filepath = content['settingFilePath']
 
-        self.oebps_dirpath = os.path.join(self.work_dir, 'OEBPS')
+                if not self.exists_source(filepath):
+                    raise BatchBase.BatchException('コンテンツファイルが見つかりません。: {0}'.format(filepath))
 
-        try:
-            if FileSystem.exists_file(self.oebps_dirpath):
-                FileSystem.remove_directory(self.oebps_dirpath)
-            FileSystem.create_directory(self.oebps_dirpath)
-        except Exception as e:
-            raise BatchBase.BatchException('/META-INFディレクトリ作成中にエラーが発生しました。 {0}'.format(self.exception_info()))
+                content_count += 1
 
-        self.info_log('ディレクトリ作成 - /OEBPS')
+                arcname = 'OEBPS/contents_{0}.xhtml'.format(content_count)
+                with self.profile_item('content', arcname, arcname) as item:
+                    self.create_oebps_content_file(content_count - 1, arcname, item)
+        finally:
+            self.close_chapter_files()
 
-    def create_oebps_resources(self):
+    def create_oebps_content_file(self, content_index, arcname, item):
         '''
-        ディレクトリ作成 - /OEBPS/resources
+        コンテンツファイル1件分の作成
         '''
-
-        self.oebps_resources_dirpath = os.path.join(self.oebps_dirpath, 'resources')
-
+        content = self.settings['contents'][content_index]
+
+        # 差分作成で入力データに変更がない場合は前回のファイルを再利用する
+        if content_index in self.reusable_contents:
+            self.reuse_entry(self.reusable_contents[content_index])
+            item['reused'] = True
+            return
+
+        # コンテンツファイル読み込み（同じテンプレートから作成するコンテンツは解析済みのテンプレートを共有する）
+        template = self.get_content_template(content_index)
+        setting_paths = template.setting_paths
+        chapter = None
+        stream = False
+        if content['bindChapter']:
+            chapter = self.chapters[content['bindChapterIndex']]
+            body = self.load_chapter_body(content['bindChapterIndex'])
+            setting_paths = setting_paths | self.chapter_setting_paths.get(content['bindChapterIndex'], set())
+            stream = type(body) is ChapterStream
+            item['chapter'] = chapter['title']
+            if stream:
+                # 直接書き込むチャプターはコンテンツファイル作成時に読み込む
+                item['bytesRead'] = self.get_source_size(body.filepath)
+
+        # 差分作成の場合は入力データのダイジェストと参照した設定値をエントリに保存する
+        # NOTE: 直接書き込むチャプターは置換したプレースホルダのパスが書き込み後に確定するため、書き込み後に保存する
+        comment = None
+        if self.incremental and not stream:
+            comment = self.create_content_comment(content_index, setting_paths)
+
+        # コンテンツファイル作成
         try:
-            if FileSystem.exists_file(self.oebps_resources_dirpath):
-                FileSystem.remove_directory(self.oebps_resources_dirpath)
-            FileSystem.create_directory(self.oebps_resources_dirpath)
+            with self.epub_writer.open_text(arcname, comment=comment, stream=stream) as f:
+                template.render(f.write, self.setting_resolver, chapter, self.chapters)
         except Exception as e:
-            raise BatchBase.BatchException('/OEBPS/resourcesディレクトリ作成中にエラーが発生しました。 {0}'.format(self.exception_info()))
+            raise BatchBase.BatchException('コンテンツファイル作成中にエラーが発生しました。 {0}'.format(self.exception_info()))
+        if self.incremental and stream:
+            self.epub_writer.set_comment(arcname, self.create_content_comment(content_index, setting_paths | body.setting_paths))
+        if chapter != None:
+            self.release_chapter_body(content['bindChapterIndex'])
 
-        self.info_log('ディレクトリ作成 - /OEBPS/resources')
+        self.info_log('ファイル作成 - /{0}'.format(arcname))
 
-    def create_oebps_contents(self):
+    def create_content_comment(self, content_index, setting_paths):
         '''
-        ディレクトリ作成 - /OEBPS/contents
+        コンテンツファイルのエントリのコメント作成（入力データのダイジェストと参照した設定値）
         '''
-
-        self.oebps_contents_dirpath = os.path.join(self.oebps_dirpath, 'contents')
-
         try:
-            if FileSystem.exists_file(self.oebps_contents_dirpath):
-                FileSystem.remove_directory(self.oebps_contents_dirpath)
-            FileSystem.create_directory(self.oebps_contents_dirpath)
+            return EntryFingerprint.create(self.get_content_inputs(content_index), self.setting_resolver, setting_paths)
         except Exception as e:
-            raise BatchBase.BatchException('/OEBPS/contentsディレクトリ作成中にエラーが発生しました。 {0}'.format(self.exception_info()))
-
-        self.info_log('ディレクトリ作成 - /OEBPS/contents')
+            raise BatchBase.BatchException('コンテンツファイル読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
 
-    def create_oebps_content_files(self):
+    def get_content_template(self, content_index):
         '''
-        コンテンツファイル作成
+        コンテンツのテンプレート取得（テンプレートファイルとコンテンツの置換ルールが同じ場合は1回だけ読み込み、解析する）
         '''
-        content_count = 0
-        for content in self.settings['contents']:
-            filepath = content['settingFilePath']
-            create_by_chapters_count = content['createByChaptersCount']
-            use_chapters = content['useChapters']
-
-            if not FileSystem.exists_file(filepath):
-                raise BatchBase.BatchException('コンテンツファイルが見つかりません。: {0}'.format(filepath))
-
-            content_count += 1
-
-            # コンテンツファイル読み込み
+        content = self.settings['contents'][content_index]
+        filepath = content['settingFilePath']
+        replace_rules = self.content_replace_rules[content_index]
+        key = (filepath, replace_rules.rules)
+        if key in self.content_templates:
+            return self.content_templates[key]
+
+        with self.profile_item('template', filepath, filepath=filepath):
             content_data = ''
             try:
-                with open(filepath, 'r', encoding='utf-8') as f:
+                with ChapterTransformer.open_source(filepath, self.generated_files) as f:
                     content_data = f.read()
                     f.close()
             except Exception as e:
                 raise BatchBase.BatchException('コンテンツファイル読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
 
-            # 置換
-            content_data = self.content_replace(content_data, content['replaces'])
-            content_data = self.content_replace_by_setting(content_data)
-            if content['bindChapter']:
-                chapter = self.chapters[content['bindChapterIndex']]
-                content_data = self.content_replace(content_data, chapter['replaces'])
-
-            # コンテンツファイル作成
-            oebps_xhtml_filepath = os.path.join(self.oebps_dirpath, 'contents_{0}.xhtml'.format(content_count))
+            # 置換してから解析する
             try:
-                with open(oebps_xhtml_filepath, 'w', encoding='utf-8') as f:
-                    f.write(content_data)
-                    f.close()
-            except Exception as e:
-                raise BatchBase.BatchException('コンテンツファイル作成中にエラーが発生しました。 {0}'.format(self.exception_info()))
-
-            self.info_log('ファイル作成 - /OEBPS/{0}'.format(os.path.basename(oebps_xhtml_filepath)))
+                template = ContentTemplate(replace_rules.apply(content_data))
+            except ValueError as e:
+                raise BatchBase.BatchException('コンテンツファイルの解析中にエラーが発生しました。 {0} {1}'.format(filepath, self.exception_info()))
+        self.content_templates[key] = template
+        return template
 
     def create_oebps_book_opf(self):
         '''
         ファイル作成 - /OEBPS/book.opf
         '''
-        xml_opf = ET.Element('package', {'xmlns': 'http://www.idpf.org/2007/opf', 'unique-identifier': 'BookID', 'version': '3.0', 'xml:lang': 'ja'})
-        xml_opf_metadata = ET.SubElement(xml_opf, 'metadata', {'xmlns:dc': 'http://purl.org/dc/elements/1.1/'})
+        try:
+            with self.profile_item('opf', 'OEBPS/book.opf', 'OEBPS/book.opf'), self.epub_writer.open_text('OEBPS/book.opf') as f:
+                self.write_oebps_book_opf(XmlWriter(f.write))
+        except Exception as e:
+            raise BatchBase.BatchException('/OEBPS/book.opfファイル作成中にエラーが発生しました。 {0}'.format(self.exception_info()))
+
+        self.info_log('ファイル作成 - /OEBPS/book.opf')
+
+    def get_media_type(self, filepath):
+        '''
+        マニフェストに記載するメディアタイプ取得（拡張子から判定できない場合はエラー）
+        '''
+        media_type = mimetypes.guess_type(filepath)[0]
+        if media_type == None:
+            raise BatchBase.BatchException('メディアタイプを判定できないファイルです。 {0}'.format(filepath))
+        return media_type
+
+    def write_oebps_book_opf(self, xml_writer):
+        '''
+        book.opfの書き込み（要素を順に直接書き込む）
+        '''
+        xml_writer.start('package', {'xmlns': 'http://www.idpf.org/2007/opf', 'unique-identifier': 'BookID', 'version': '3.0', 'xml:lang': 'ja'})
+        xml_writer.start('metadata', {'xmlns:dc': 'http://purl.org/dc/elements/1.1/'})
 
         replace_hash = self.settings
 
         # ID
         if not Utility.is_empty(replace_hash['bookId']):
-            dc_identifier = ET.SubElement(xml_opf_metadata, 'dc:identifier', {'id': 'BookID'})
-            dc_identifier.text = 'urn:uuid:{0}'.format(replace_hash['bookId'])
-            meta_identifier = ET.SubElement(xml_opf_metadata, 'meta', {'property': 'dcterms:identifier', 'id': 'uuid'})
-            meta_identifier.text = 'urn:uuid:{0}'.format(replace_hash['bookId'])
+            xml_writer.element('dc:identifier', {'id': 'BookID'}, 'urn:uuid:{0}'.format(replace_hash['bookId']))
+            xml_writer.element('meta', {'property': 'dcterms:identifier', 'id': 'uuid'}, 'urn:uuid:{0}'.format(replace_hash['bookId']))
 
         # 言語
         if not Utility.is_empty(replace_hash['language']):
-            dc_language = ET.SubElement(xml_opf_metadata, 'dc:language')
-            dc_language.text = replace_hash['language']
-            meta_language = ET.SubElement(xml_opf_metadata, 'meta', {'property': 'dcterms:language', 'id': 'pub-lang'})
-            meta_language.text = replace_hash['language']
+            xml_writer.element('dc:language', None, replace_hash['language'])
+            xml_writer.element('meta', {'property': 'dcterms:language', 'id': 'pub-lang'}, replace_hash['language'])
 
         # 更新日時
         if not Utility.is_empty(replace_hash['modified']):
-            dc_modified = ET.SubElement(xml_opf_metadata, 'dc:date')
-            dc_modified.text = replace_hash['modified']
-            meta_modified = ET.SubElement(xml_opf_metadata, 'meta', {'property': 'dcterms:modified'})
-            meta_modified.text = replace_hash['modified']
+            xml_writer.element('dc:date', None, replace_hash['modified'])
+            xml_writer.element('meta', {'property': 'dcterms:modified'}, replace_hash['modified'])
 
         # タイトル
         if not Utility.is_empty(replace_hash['title']):
-            dc_title = ET.SubElement(xml_opf_metadata, 'dc:title')
-            dc_title.text = replace_hash['title']
-            meta_title = ET.SubElement(xml_opf_metadata, 'meta', {'property': 'dcterms:title', 'id': 'dcterm-title'})
-            meta_title.text = replace_hash['title']
+            xml_writer.element('dc:title', None, replace_hash['title'])
+            xml_writer.element('meta', {'property': 'dcterms:title', 'id': 'dcterm-title'}, replace_hash['title'])
 
         # 著者
         if not Utility.is_empty(replace_hash['authorName']):
-            dc_author = ET.SubElement(xml_opf_metadata, 'dc:creator', {'id': 'creatorMain'})
-            dc_author.text = replace_hash['authorName']
-            meta_author = ET.SubElement(xml_opf_metadata, 'meta', {'refines': '#creatorMain', 'property': 'role', 'scheme': 'marc:relators', 'id': 'roleMain'})
-            meta_author.text = replace_hash['authorName']
+            xml_writer.element('dc:creator', {'id': 'creatorMain'}, replace_hash['authorName'])
+            xml_writer.element('meta', {'refines': '#creatorMain', 'property': 'role', 'scheme': 'marc:relators', 'id': 'roleMain'}, replace_hash['authorName'])
 
         # 著者／寄与者
         other_author_count = 0
         for other_author in replace_hash['otherAuthors']:
             if not Utility.is_empty(other_author['authorName']):
                 other_author_count += 1
-                dc_other_author = ET.SubElement(xml_opf_metadata, 'dc:creator', {'id': 'creator{0}'.format(other_author_count)})
-                dc_other_author.text = other_author['authorName']
-                meta_other_author = ET.SubElement(xml_opf_metadata, 'meta', {'refines': '#creator{0}'.format(other_author_count), 'property': 'role', 'scheme': 'marc:relators', 'id': 'role{0}'.format(other_author_count)})
-                meta_other_author.text = other_author['authorName']
+                xml_writer.element('dc:creator', {'id': 'creator{0}'.format(other_author_count)}, other_author['authorName'])
+                xml_writer.element('meta', {'refines': '#creator{0}'.format(other_author_count), 'property': 'role', 'scheme': 'marc:relators', 'id': 'role{0}'.format(other_author_count)}, other_author['authorName'])
 
         # コピーライト
         if not Utility.is_empty(replace_hash['authorCopyRight']):
-            dc_author_copyright = ET.SubElement(xml_opf_metadata, 'dc:rights')
-            dc_author_copyright.text = replace_hash['authorCopyRight']
-            meta_author_copyright = ET.SubElement(xml_opf_metadata, 'meta', {'property': 'dcterms:rights', 'id': 'rights'})
-            meta_author_copyright.text = replace_hash['authorCopyRight']
+            xml_writer.element('dc:rights', None, replace_hash['authorCopyRight'])
+            xml_writer.element('meta', {'property': 'dcterms:rights', 'id': 'rights'}, replace_hash['authorCopyRight'])
 
         # カバー
         for image in self.settings['resources']['images']:
             if image['isCover']:
-                meta_cover = ET.SubElement(xml_opf_metadata, 'meta', {'name': 'cover', 'content': 'cover-image'})
+                xml_writer.element('meta', {'name': 'cover', 'content': 'cover-image'})
                 break
 
-        # マニフェスト／スパイン
-        xml_manifest = ET.SubElement(xml_opf, 'manifest')
-        xml_spine_attributes = {}
-        if not Utility.is_empty(replace_hash['pageProgressionDirection']):
-            xml_spine_attributes['page-progression-direction'] = replace_hash['pageProgressionDirection']
-        xml_spine = ET.SubElement(xml_opf, 'spine', xml_spine_attributes)
+        xml_writer.end('metadata')
+
+        # マニフェスト
+        xml_writer.start('manifest')
+
+        # NOTE: 同じ内容のリソースファイルを統合した場合、同じパスのアイテムは1つにする
+        manifest_hrefs = set()
 
         # リソース（スタイルシート）からマニフェスト作成
         stylesheet_count = 0
         for stylesheet in self.settings['resources']['styleSheets']:
+            if stylesheet['manifestFilePath'] in manifest_hrefs:
+                continue
+            manifest_hrefs.add(stylesheet['manifestFilePath'])
             stylesheet_count += 1
             properties = {
                 'id': 'css_{0}'.format(stylesheet_count),
                 'href': stylesheet['manifestFilePath'],
-                'media-type': mimetypes.guess_type(stylesheet['manifestFilePath'])[0]
+                'media-type': self.get_media_type(stylesheet['manifestFilePath'])
             }
-            xml_manifest_stylesheet = ET.SubElement(xml_manifest, 'item', properties)
+            xml_writer.element('item', properties)
 
         # リソース（画像）からマニフェスト作成
         image_count = 0
         setted_cover = False
+        cover_href = None
         for image in self.settings['resources']['images']:
+            if image['isCover']:
+                cover_href = image['manifestFilePath']
+                break
+        for image in self.settings['resources']['images']:
+            if image['manifestFilePath'] in manifest_hrefs:
+                continue
+            manifest_hrefs.add(image['manifestFilePath'])
             image_count += 1
 
-            # 表紙がある場合は属性をセット
+            # 表紙がある場合は属性をセット（表紙と同じ内容の画像を先に指定した場合はその画像）
             properties = {}
-            if image['isCover'] and not setted_cover:
+            if image['manifestFilePath'] == cover_href and not setted_cover:
                 properties['properties'] = 'cover-image'
                 setted_cover = True
             properties['id'] = 'image_{0}'.format(image_count)
             properties['href'] = image['manifestFilePath']
-            properties['media-type'] = mimetypes.guess_type(image['manifestFilePath'])[0]
+            properties['media-type'] = self.get_media_type(image['manifestFilePath'])
 
-            xml_manifest_image = ET.SubElement(xml_manifest, 'item', properties)
+            xml_writer.element('item', properties)
 
         # チャプターからマニフェスト作成
         chapter_count = 0
         for chapter in self.settings['resources']['chapters']['files']:
-            if not chapter['fileType'] == 'text' and chapter['bindContent']:
+            if not chapter['fileType'] == 'text' and chapter['bindContent'] and not chapter['manifestFilePath'] in manifest_hrefs:
+                manifest_hrefs.add(chapter['manifestFilePath'])
                 chapter_count += 1
 
                 properties = {}
                 properties['id'] = 'chapter_{0}'.format(chapter_count)
                 properties['href'] = chapter['manifestFilePath']
-                properties['media-type'] = mimetypes.guess_type(chapter['manifestFilePath'])[0]
+                properties['media-type'] = self.get_media_type(chapter['manifestFilePath'])
 
-                xml_manifest_chapter = ET.SubElement(xml_manifest, 'item', properties)
+                xml_writer.element('item', properties)
 
-        # コンテンツからマニフェスト・スパイン作成
+        # コンテンツからマニフェスト作成
         content_count = 0
         for content in self.settings['contents']:
             content_count += 1
@@ -1405,61 +4389,49 @@ class Batch(BatchBase):
                 manifest_properties['properties'] = 'nav'
             manifest_properties['id'] = 'content_{0}'.format(content_count)
             manifest_properties['href'] = content['filePath']
-            manifest_properties['media-type'] = mimetypes.guess_type(content['filePath'])[0]
+            manifest_properties['media-type'] = self.get_media_type(content['filePath'])
 
-            xml_manifest_content = ET.SubElement(xml_manifest, 'item', manifest_properties)
+            xml_writer.element('item', manifest_properties)
 
-            if not content['spineHidden']:
-                spine_properties = {}
-                spine_properties['idref'] = 'content_{0}'.format(content_count)
-                xml_spine_content = ET.SubElement(xml_spine, 'itemref', spine_properties)
+        xml_writer.end('manifest')
 
-        # book.opfファイル作成
-        oebps_book_opf_filepath = os.path.join(self.oebps_dirpath, 'book.opf')
-        if FileSystem.exists_file(oebps_book_opf_filepath):
-            FileSystem.remove_file(oebps_book_opf_filepath)
+        # スパイン
+        xml_spine_attributes = {}
+        if not Utility.is_empty(replace_hash['pageProgressionDirection']):
+            xml_spine_attributes['page-progression-direction'] = replace_hash['pageProgressionDirection']
+        xml_writer.start('spine', xml_spine_attributes)
 
-        try:
-            with open(oebps_book_opf_filepath, 'w', encoding='utf-8') as f:
-                f.write(Convert.get_pretty_xml(ET.tostring(xml_opf, encoding='utf-8')))
-                f.close()
-        except Exception as e:
-            raise BatchBase.BatchException('/OEBPS/book.opfファイル作成中にエラーが発生しました。 {0}'.format(self.exception_info()))
+        # コンテンツからスパイン作成
+        content_count = 0
+        for content in self.settings['contents']:
+            content_count += 1
+            if not content['spineHidden']:
+                xml_writer.element('itemref', {'idref': 'content_{0}'.format(content_count)})
 
-        self.info_log('ファイル作成 - /OEBPS/book.opf')
+        xml_writer.end('spine')
+        xml_writer.end('package')
 
     def create_epub(self):
         '''
         epubファイル作成
         '''
 
-        # ------------------------------
-        # epubファイル作成
-        # ------------------------------
-        if FileSystem.exists_file(self.args.output_file):
-            FileSystem.remove_file(self.args.output_file)
-        try:
-            with zipfile.ZipFile(self.args.output_file, 'w', zipfile.ZIP_DEFLATED) as f:
-                # mimetypeはzipファイルの先頭に、かつ圧縮なしで登録
-                f.write(self.mimetype_filepath, 'mimetype', zipfile.ZIP_STORED)
-
-                # META-INFディレクトリ登録
-                filepaths = []
-                FileSystem.collect_filepaths(self.meta_inf_dirpath, filepaths)
-                for filepath in filepaths:
-                    f.write(filepath, filepath.replace(self.work_dir, ''), zipfile.ZIP_DEFLATED)
-
-                # OEBPSディレクトリ登録
-                filepaths = []
-                FileSystem.collect_filepaths(self.oebps_dirpath, filepaths)
-                for filepath in filepaths:
-                    f.write(filepath, filepath.replace(self.work_dir, ''), zipfile.ZIP_DEFLATED)
+        # エントリごとの圧縮方式
+        for arcname, method in self.epub_writer.entries:
+            self.info_log('圧縮方式 - /{0}: {1}'.format(arcname, method))
 
-                f.close()
+        # 一時ファイルに書き込んだepubファイルを出力ファイルに置き換える
+        try:
+            self.epub_writer.close()
+            if self.output_stream == None:
+                os.replace(self.epub_writer.filepath, self.output_filepath)
+            if self.profiler != None:
+                self.profiler.set_entries(self.epub_writer.zip_file.infolist(), self.epub_writer.entries)
+            self.epub_writer = None
         except Exception as e:
             raise BatchBase.BatchException('epubファイル作成中にエラーが発生しました。 {0}'.format(self.exception_info()))
 
-        self.info_log('ファイル作成 - ' + self.args.output_file)
+        self.info_log('ファイル作成 - ' + (self.output_filepath if self.output_stream == None else '（ストリーム）'))
 
     def reclusive_setting_callback(self, data, callback):
         '''
@@ -1481,7 +4453,7 @@ class Batch(BatchBase):
         if key == 'filePath' and type(value) == str and value != '':
             # if len(value) > 2 and (value[:2] == './' or value[:2] == '.\\'):
             #     return re.sub('^\.', re.sub(r'\\', r'\\\\', self.setting_yaml_dirpath), value)
-            return os.path.abspath(value)
+            return os.path.abspath(os.path.join(self.setting_yaml_dirpath, value))
         else:
             return value
 
@@ -1490,42 +4462,13 @@ class Batch(BatchBase):
         コンテンツ置換
         '''
 
-        if Utility.is_empty(content):
-            return content
-        if replaces == None or len(replaces) == 0:
-            return content
-
-        simple_replaces = []
-        regex_replaces = []
-
-        for replace in replaces:
-            if 'type' in replace:
-                # YAMLで記載を省略するとNoneになるケースがあるため、置換データを補正する
-                if replace['replaceContent'] == None:
-                    replace['replaceContent'] = ''
-
-                # シンプル／正規表現タイプの検索／置換セットを追加する
-                if replace['type'] == 'simple':
-                    simple_replaces.append(replace)
-                elif replace['type'] == 'regex':
-                    regex_replaces.append(replace)
-            else:
-                simple_replaces.append(replace)
-
-        # 最初に正規表現での置換を実行
-        for replace in regex_replaces:
-            content = re.sub(replace['placeHolder'], replace['replaceContent'], content)
-
-        # 単純置換を実行
-        for replace in simple_replaces:
-            content = content.replace(replace['placeHolder'], replace['replaceContent'])
-
-        return content
+        return ReplaceRules.compile(replaces).apply(content)
 
     def content_replace_by_setting(self, content):
-        for key in self.replaces:
-            content = content.replace('{' + key + '}', str(self.replaces[key]))
-        return content
+        '''
+        コンテンツ中の{$setting.xxxx}を設定値で置換
+        '''
+        return self.setting_resolver.resolve(content)
 
     def convert_yaml_to_list(self, parent_data, source, dest):
         '''
@@ -1533,13 +4476,17 @@ class Batch(BatchBase):
         '''
 
         for key in source:
-            if type(source[key]) is dict:
+            if type(source[key]) is dict or isinstance(source[key], SettingRecord):
                 self.convert_yaml_to_list(parent_data + '.' + key, source[key], dest)
-            elif type(source[key]) is list:
+            elif type(source[key]) is list or type(source[key]) is tuple:
                 counter = 0
                 for data in source[key]:
                     counter += 1
-                    self.convert_yaml_to_list(parent_data + '.' + key + '.' + str(counter), data, dest)
+                    if type(data) is dict or isinstance(data, SettingRecord):
+                        self.convert_yaml_to_list(parent_data + '.' + key + '.' + str(counter), data, dest)
+                    else:
+                        # 値の配列（例: compression.storedMediaTypes）
+                        dest['$' + parent_data + '.' + key + '.' + str(counter)] = '' if data == None else data
             else:
                 value = ''
                 if source[key] != None:
@@ -1547,7 +4494,567 @@ class Batch(BatchBase):
                 dest['$' + parent_data + '.' + key] = value
 
 
+class EpubBuilder(Batch):
+    '''
+    電子書籍作成クラス（アプリケーションから呼び出す場合に使用する）
+    設定値（または設定ファイル）とメモリ上のファイルからepubファイルを作成し、バイナリのストリーム（またはファイル）に書き込む
+    ログファイルの作成、ロガーの登録、カレントディレクトリの変更、一時ファイルの作成は行わない
+    '''
+
+    # パラメータの初期値（コマンドラインで実行する場合と異なるもの）
+    # NOTE: チャプターキャッシュはディレクトリに書き込むため、初期値では使用しない
+    DEFAULT_OPTIONS = {
+        'cache': '0',
+    }
+
+    def __init__(self, settings=None, setting_file=None, source_files=None, base_dirpath=None, options=None, logger=None):
+        '''
+        コンストラクタ
+        settings: 設定値（設定ファイルを読み込んだ場合と同じ形式の辞書。変更せずに複製して使用する）
+        setting_file: 設定ファイルのパス（settingsを指定しない場合）
+        source_files: メモリ上のファイル（設定値のfilePathと同じパス => 内容（文字列／バイト列））
+        base_dirpath: 設定値・メモリ上のファイルの相対パスの基準ディレクトリ（初期値: 設定ファイルのディレクトリ／カレントディレクトリ）
+        options: パラメータ（パラメータのdestination => 値、例: {'compress_level': '9'}）
+        logger: ログの出力先（初期値: 出力しない）
+        '''
+        if settings == None and Utility.is_empty(setting_file):
+            raise BatchBase.BatchException('設定値または設定ファイルを指定してください。')
+        self.batch_name = 'Epub builder'
+        self.stdout_silent = True
+        if logger == None:
+            # NOTE: logging.getLogger()で取得せず、プロセス全体のロガーの設定を変更しない
+            logger = logging.Logger(self.batch_name)
+            logger.setLevel(logging.INFO)
+            logger.addHandler(logging.NullHandler())
+        self.log0 = logger
+
+        # パラメータ（コマンドラインで実行する場合と同じ）
+        values = {'debug': '0', 'silent': '1'}
+        for argument_setting in self.get_argument_settings():
+            values[argument_setting['destination']] = argument_setting['default_value']
+        values.update(self.DEFAULT_OPTIONS)
+        for key, value in (options or {}).items():
+            if not key in values:
+                raise BatchBase.BatchException('不明なパラメータです。 {0}'.format(key))
+            values[key] = value
+        values['input_setting_file'] = setting_file if settings == None else ''
+        values['output_file'] = ''
+        values['watch'] = '0'
+        self.args = Namespace(**values)
+        self.debug = self.args.debug == '1'
+
+        self.initialize_state()
+        self.setting_values = settings
+        if base_dirpath == None:
+            base_dirpath = os.path.dirname(os.path.abspath(setting_file)) if settings == None else os.getcwd()
+        self.base_dirpath = os.path.abspath(base_dirpath)
+        for filepath, data in (source_files or {}).items():
+            self.source_files[os.path.abspath(os.path.join(self.base_dirpath, filepath))] = data
+
+    def read_setting_file(self):
+        '''
+        設定値の読み込み（設定値を指定した場合は複製する）
+        '''
+        if self.setting_values == None:
+            settings = super(EpubBuilder, self).read_setting_file()
+        else:
+            try:
+                settings = copy.deepcopy(dict(self.setting_values))
+            except Exception as e:
+                raise BatchBase.BatchException('設定値の読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
+        self.setting_yaml_dirpath = self.base_dirpath
+        return settings
+
+    def write(self, output):
+        '''
+        epubファイルを作成し、バイナリのストリーム（またはファイルパス）に書き込む（作成に失敗した場合はBatchException）
+        NOTE: ストリームに書き込む場合、作成に失敗するとストリームには途中までのデータが書き込まれる
+        '''
+        if hasattr(output, 'write'):
+            self.output_stream = output
+            self.args.output_file = ''
+        else:
+            self.output_stream = None
+            self.args.output_file = os.path.join(self.base_dirpath, output)
+        try:
+            if self.chapter_cache == None:
+                self.open_chapter_cache()
+            self.build()
+        finally:
+            self.output_stream = None
+
+    def to_bytes(self):
+        '''
+        epubファイルを作成し、バイト列で返す（作成に失敗した場合はBatchException）
+        '''
+        output = io.BytesIO()
+        self.write(output)
+        return output.getvalue()
+
+
+class MultiBatch(BatchBase):
+    '''
+    一括作成バッチクラス（複数の設定ファイルから電子書籍をワーカープロセスで並列に作成する）
+    '''
+
+    args = None
+    # 作成結果（設定ファイル, 出力ファイル, 戻り値, 処理時間, メッセージ）
+    results = None
+
+    def __init__(self):
+        '''
+        コンストラクタ
+        '''
+        batch_name = 'Epub generator (batch)'
+        description = '複数の設定ファイルに基づいてepubファイルを一括で作成します。'
+        set_argument_settings = []
+        set_argument_settings.append({'short_name': '-i', 'long_name': '--input_setting_files', 'destination': 'input_setting_files', 'required': False, 'default_value': '', 'help': '設定ファイルのパス（ワイルドカード可、{0}区切りで複数指定可）'.format(os.pathsep)})
+        set_argument_settings.append({'short_name': '-o', 'long_name': '--output_directory', 'destination': 'output_directory', 'required': False, 'default_value': '', 'help': '出力ディレクトリのパス（-i指定時）'})
+        set_argument_settings.append({'short_name': '-m', 'long_name': '--manifest_file', 'destination': 'manifest_file', 'required': False, 'default_value': '', 'help': '設定ファイルと出力ファイルの対応を記載したファイルのパス'})
+        set_argument_settings.append({'short_name': '-w', 'long_name': '--workers', 'destination': 'workers', 'required': False, 'default_value': '0', 'help': 'ワーカープロセス数（0: CPU数）'})
+        set_argument_settings.append({'short_name': '-l', 'long_name': '--compress_level', 'destination': 'compress_level', 'required': False, 'default_value': '', 'help': 'deflateの圧縮レベル（0～9、設定ファイルより優先）'})
+        set_argument_settings.append({'short_name': '-t', 'long_name': '--compress_threads', 'destination': 'compress_threads', 'required': False, 'default_value': '', 'help': '並列圧縮のスレッド数（0: CPU数、設定ファイルより優先）'})
+        set_argument_settings.append({'short_name': '-p', 'long_name': '--compress_probe', 'destination': 'compress_probe', 'required': False, 'default_value': '', 'help': '試験圧縮で圧縮効果がないファイルを無圧縮で格納するか（設定ファイルより優先）'})
+        set_argument_settings.append({'short_name': '-n', 'long_name': '--optimize_png', 'destination': 'optimize_png', 'required': False, 'default_value': '', 'help': 'PNGファイルを可逆に最適化してから格納するか（設定ファイルより優先）'})
+        set_argument_settings.append({'short_name': '-r', 'long_name': '--incremental', 'destination': 'incremental', 'required': False, 'default_value': '0', 'help': '前回作成したepubファイルから変更のないエントリを再利用するか'})
+        set_argument_settings.append({'short_name': '-c', 'long_name': '--cache', 'destination': 'cache', 'required': False, 'default_value': '1', 'help': 'チャプターキャッシュを使用するか（1: 使用する、0: 使用しない、clear: 削除してから使用する）'})
+        set_argument_settings.append({'short_name': '-g', 'long_name': '--cache_dir', 'destination': 'cache_dir', 'required': False, 'default_value': '', 'help': 'チャプターキャッシュのディレクトリ'})
+        set_argument_settings.append({'short_name': '-z', 'long_name': '--cache_size', 'destination': 'cache_size', 'required': False, 'default_value': '256', 'help': 'チャプターキャッシュのサイズの上限（MB）'})
+        set_argument_settings.append({'short_name': '-b', 'long_name': '--stream_size', 'destination': 'stream_size', 'required': False, 'default_value': '', 'help': 'このサイズ（MB）以上のテキストのチャプターファイルを、メモリ上に保持せずにepubファイルに直接書き込む（0: 全て）'})
+        set_argument_settings.append({'short_name': '-e', 'long_name': '--memory_trace', 'destination': 'memory_trace', 'required': False, 'default_value': '0', 'const_value': '1', 'help': '電子書籍ごとに処理ごとのメモリ使用量を計測し、ログと同じディレクトリに出力するか'})
+        set_argument_settings.append({'short_name': '-a', 'long_name': '--read_ahead', 'destination': 'read_ahead', 'required': False, 'default_value': '4', 'help': 'リソースファイル・チャプターファイルを先行して読み込むファイル数（0: 先読みしない）'})
+        super(MultiBatch, self).__init__(batch_name, description, set_argument_settings)
+
+        self.results = []
+
+    def main(self, args):
+        '''
+        メイン処理
+        '''
+        self.args = args
+
+        # デバッグ
+        if self.args.debug == '1':
+            self.debug = True
+
+        # 作成対象の収集
+        books = []
+        if not Utility.is_empty(self.args.input_setting_files):
+            books.extend(self.find_setting_files())
+        if not Utility.is_empty(self.args.manifest_file):
+            books.extend(self.load_manifest_file())
+        if len(books) == 0:
+            raise BatchBase.BatchException('作成対象の設定ファイルが見つかりません。')
+
+        workers = self.get_workers()
+        self.info_log('作成対象: {0}件 / ワーカープロセス数: {1}'.format(len(books), workers))
+
+        # 電子書籍ごとのパラメータ
+        # NOTE: ワーカープロセスではチャプター変換を並列実行しない
+        options = ['-s', '1', '-d', self.args.debug, '-j', '1', '-r', self.args.incremental, '-e', self.args.memory_trace, '-a', self.args.read_ahead]
+        if not Utility.is_empty(self.args.compress_level):
+            options.extend(['-l', self.args.compress_level])
+        if not Utility.is_empty(self.args.compress_threads):
+            options.extend(['-t', self.args.compress_threads])
+        if not Utility.is_empty(self.args.compress_probe):
+            options.extend(['-p', self.args.compress_probe])
+        if not Utility.is_empty(self.args.optimize_png):
+            options.extend(['-n', self.args.optimize_png])
+        if not Utility.is_empty(self.args.stream_size):
+            options.extend(['-b', self.args.stream_size])
+
+        # チャプターキャッシュは全ワーカープロセスで共有する（削除はワーカープロセスの起動前に1回だけ行う）
+        cache = self.args.cache
+        cache_dir = CACHE_DIR
+        if not Utility.is_empty(self.args.cache_dir):
+            cache_dir = os.path.abspath(self.args.cache_dir)
+        if cache == 'clear':
+            try:
+                ChapterCache.clear_directory(cache_dir)
+            except Exception as e:
+                raise BatchBase.BatchException('チャプターキャッシュの削除中にエラーが発生しました。 {0}'.format(self.exception_info()))
+            self.info_log('チャプターキャッシュ削除 - {0}'.format(cache_dir))
+            cache = '1'
+        options.extend(['-c', cache, '-g', cache_dir, '-z', self.args.cache_size])
+
+        # NOTE: ワーカープロセスはWindowsと同じ動作になるようにspawnで起動する
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = []
+            for setting_filepath, output_filepath in books:
+                FileSystem.create_directory(os.path.dirname(output_filepath))
+                futures.append(executor.submit(MultiBatch.build_book, ['-i', setting_filepath, '-o', output_filepath] + options))
+            for (setting_filepath, output_filepath), future in zip(books, futures):
+                try:
+                    return_code, elapsed = future.result()
+                    message = ''
+                except Exception as e:
+                    return_code, elapsed = BatchBase.ReturnCode.AbnormalEnd, 0.0
+                    message = str(e)
+                self.results.append({
+                    'settingFilePath': setting_filepath,
+                    'outputFilePath': output_filepath,
+                    'returnCode': BatchBase.ReturnCode(return_code),
+                    'elapsed': elapsed,
+                    'message': message,
+                })
+
+        # 作成結果の出力
+        self.output_results()
+
+        return max([result['returnCode'] for result in self.results])
+
+    @classmethod
+    def build_book(cls, argv):
+        '''
+        ワーカープロセスでの電子書籍作成（戻り値と処理時間を返す）
+        '''
+        start = time.perf_counter()
+        return_code = Batch().execute(argv)
+        return (return_code, time.perf_counter() - start)
+
+    def get_workers(self):
+        '''
+        ワーカープロセス数取得
+        '''
+        try:
+            workers = int(self.args.workers)
+        except (TypeError, ValueError):
+            raise BatchBase.BatchException('ワーカープロセス数の指定が不正です。 {0}'.format(self.args.workers))
+        if workers < 0:
+            raise BatchBase.BatchException('ワーカープロセス数の指定が不正です。 {0}'.format(self.args.workers))
+        if workers == 0:
+            workers = os.cpu_count() or 1
+        return workers
+
+    def find_setting_files(self):
+        '''
+        設定ファイルの検索（出力ファイルは設定ファイルの共通ディレクトリからの相対パスで出力ディレクトリに作成する）
+        '''
+        if Utility.is_empty(self.args.output_directory):
+            raise BatchBase.BatchException('出力ディレクトリを指定してください。')
+
+        setting_filepaths = []
+        for pattern in self.args.input_setting_files.split(os.pathsep):
+            if Utility.is_empty(pattern):
+                continue
+            filepaths = sorted(glob.glob(pattern, recursive=True))
+            if len(filepaths) == 0:
+                self.warning_log('設定ファイルが見つかりません。 {0}'.format(pattern))
+            for filepath in filepaths:
+                filepath = os.path.abspath(filepath)
+                if FileSystem.exists_file(filepath) and not filepath in setting_filepaths:
+                    setting_filepaths.append(filepath)
+        if len(setting_filepaths) == 0:
+            return []
+
+        # 例: books/a/setting.yaml, books/b/setting.yaml → 出力ディレクトリ/a/setting.epub, 出力ディレクトリ/b/setting.epub
+        base_dirpath = os.path.commonpath([os.path.dirname(filepath) for filepath in setting_filepaths])
+        output_dirpath = os.path.abspath(self.args.output_directory)
+        books = []
+        for filepath in setting_filepaths:
+            output_filepath = os.path.join(output_dirpath, os.path.splitext(os.path.relpath(filepath, base_dirpath))[0] + '.epub')
+            books.append((filepath, output_filepath))
+        return books
+
+    def load_manifest_file(self):
+        '''
+        設定ファイルと出力ファイルの対応を記載したファイルの読み込み（相対パスはこのファイルのディレクトリから解決する）
+        '''
+        manifest_filepath = os.path.abspath(self.args.manifest_file)
+        if not FileSystem.exists_file(manifest_filepath):
+            raise BatchBase.BatchException('一括作成ファイルが見つかりません。 {0}'.format(manifest_filepath))
+        try:
+            with open(manifest_filepath, 'r', encoding='utf-8') as f:
+                manifest = yaml.load(f, Loader=yaml.SafeLoader)
+                f.close()
+        except Exception as e:
+            raise BatchBase.BatchException('一括作成ファイル読み込み中にエラーが発生しました。 {0}'.format(self.exception_info()))
+
+        if type(manifest) is not dict or type(manifest.get('books')) is not list:
+            raise BatchBase.BatchException('一括作成ファイルにbooksが指定されていません。 {0}'.format(manifest_filepath))
+        dirpath = os.path.dirname(manifest_filepath)
+        books = []
+        for book in manifest['books']:
+            if type(book) is not dict or Utility.is_empty(book.get('settingFilePath')) or Utility.is_empty(book.get('outputFilePath')):
+                raise BatchBase.BatchException('一括作成ファイルのbooksにはsettingFilePathとoutputFilePathを指定してください。 {0}'.format(book))
+            books.append((os.path.join(dirpath, book['settingFilePath']), os.path.join(dirpath, book['outputFilePath'])))
+        return [(os.path.abspath(setting_filepath), os.path.abspath(output_filepath)) for setting_filepath, output_filepath in books]
+
+    def output_results(self):
+        '''
+        作成結果の一覧出力
+        '''
+        self.info_log('作成結果:')
+        self.info_log('{0:>4}  {1:<11}  {2:>9}  {3}'.format('No.', 'Result', 'Time(s)', 'Setting file -> Output file'))
+        count = 0
+        for result in self.results:
+            count += 1
+            self.info_log('{0:>4}  {1:<11}  {2:>9.2f}  {3} -> {4}'.format(count, result['returnCode'].name, result['elapsed'], result['settingFilePath'], result['outputFilePath']))
+            if not Utility.is_empty(result['message']):
+                self.info_log('      {0}'.format(result['message']))
+        for return_code in BatchBase.ReturnCode:
+            self.info_log('{0}: {1}件'.format(return_code.name, len([result for result in self.results if result['returnCode'] == return_code])))
+
+
+class BuildServer(BatchBase):
+    '''
+    作成サーバーバッチクラス（Unixドメインソケットで作成依頼を受け付け、起動済みのワーカープロセスで電子書籍を作成する）
+    NOTE: 依頼ごとのPythonの起動・モジュールのインポート・パラメータ解析の準備を省略するために使用する
+    '''
+
+    # 1件の作成依頼の上限サイズ（バイト）
+    MAX_REQUEST_SIZE = 64 * 1024 * 1024
+
+    args = None
+
+    class SocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        '''
+        ソケットサーバー（接続ごとにスレッドで処理する）
+        NOTE: 受付の停止後、作成中・待機中の依頼の結果を返すまで終了を待機する
+        '''
+        daemon_threads = False
+        block_on_close = True
+        build_server = None
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        '''
+        作成依頼の受付（1回の接続で1件の依頼を受け付け、結果を返す）
+        '''
+
+        # 作成依頼の受信のタイムアウト（秒）
+        timeout = 60
+
+        def handle(self):
+            '''
+            受付処理
+            '''
+            try:
+                data = self.rfile.readline(BuildServer.MAX_REQUEST_SIZE + 1)
+            except socket.timeout:
+                return
+            # NOTE: 作成中は送受信しないため、タイムアウトは作成時間に影響しない
+            response = self.server.build_server.handle_request(data)
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode('utf-8') + b'\n')
+
+    def __init__(self):
+        '''
+        コンストラクタ
+        '''
+        batch_name = 'Epub generator (server)'
+        description = '作成依頼をUnixドメインソケットで受け付けてepubファイルを作成します。'
+        set_argument_settings = []
+        set_argument_settings.append({'short_name': '-u', 'long_name': '--socket', 'destination': 'socket', 'required': False, 'default_value': SOCKET_PATH, 'help': 'ソケットファイルのパス'})
+        set_argument_settings.append({'short_name': '-w', 'long_name': '--workers', 'destination': 'workers', 'required': False, 'default_value': '0', 'help': 'ワーカープロセス数（同時に作成する依頼の上限、0: CPU数）'})
+        set_argument_settings.append({'short_name': '-q', 'long_name': '--queue_size', 'destination': 'queue_size', 'required': False, 'default_value': '16', 'help': '作成を待機させる依頼の上限（超えた依頼は警告終了で返す）'})
+        super(BuildServer, self).__init__(batch_name, description, set_argument_settings)
+
+        self.lock = threading.Lock()
+        self.executor = None
+        self.server = None
+        self.workers = 0
+        self.queue_size = 0
+        # 受付中の依頼数（作成中＋待機中）
+        self.jobs = 0
+
+    def main(self, args):
+        '''
+        メイン処理
+        '''
+        self.args = args
+
+        # デバッグ
+        if self.args.debug == '1':
+            self.debug = True
+
+        if not hasattr(socket, 'AF_UNIX'):
+            raise BatchBase.BatchException('この環境ではUnixドメインソケットを使用できません。')
+        self.workers = MultiBatch.get_workers(self)
+        try:
+            self.queue_size = int(self.args.queue_size)
+        except (TypeError, ValueError):
+            raise BatchBase.BatchException('待機させる依頼の上限の指定が不正です。 {0}'.format(self.args.queue_size))
+        if self.queue_size < 0:
+            raise BatchBase.BatchException('待機させる依頼の上限の指定が不正です。 {0}'.format(self.args.queue_size))
+
+        socket_path = os.path.abspath(self.args.socket)
+        self.remove_socket_file(socket_path)
+        FileSystem.create_directory(os.path.dirname(socket_path))
+
+        self.open_executor()
+        try:
+            try:
+                self.server = BuildServer.SocketServer(socket_path, BuildServer.RequestHandler)
+            except OSError as e:
+                raise BatchBase.BatchException('ソケットファイルの作成中にエラーが発生しました。 {0}'.format(self.exception_info()))
+            self.server.build_server = self
+            try:
+                # 終了シグナルで受付を停止する（serve_forever()と別のスレッドから停止する）
+                if threading.current_thread() is threading.main_thread():
+                    signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+                self.info_log('受付開始 - {0} / ワーカープロセス数: {1} / 待機させる依頼の上限: {2}'.format(socket_path, self.workers, self.queue_size))
+                try:
+                    self.server.serve_forever()
+                except KeyboardInterrupt:
+                    pass
+                self.info_log('受付終了 - {0}'.format(socket_path))
+            finally:
+                self.server.server_close()
+                if os.path.exists(socket_path):
+                    os.remove(socket_path)
+        finally:
+            with self.lock:
+                self.executor.shutdown(wait=True)
+
+        return BatchBase.ReturnCode.NormalEnd
+
+    def remove_socket_file(self, socket_path):
+        '''
+        前回のソケットファイルの削除（起動中の作成サーバーのソケットファイルの場合はBatchException）
+        '''
+        if not os.path.exists(socket_path):
+            return
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.connect(socket_path)
+        except OSError:
+            os.remove(socket_path)
+            return
+        raise BatchBase.BatchException('作成サーバーは既に起動しています。 {0}'.format(socket_path))
+
+    def open_executor(self):
+        '''
+        ワーカープロセスの起動（全ワーカープロセスでモジュールのインポート等を済ませてから受付を開始する）
+        '''
+        # NOTE: ワーカープロセスはWindowsと同じ動作になるようにspawnで起動する
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        pids = set([future.result() for future in [self.executor.submit(BuildServer.initialize_worker) for _ in range(self.workers)]])
+        self.debug_log('ワーカープロセス起動 - {0}'.format(sorted(pids)))
+
+    @classmethod
+    def initialize_worker(cls):
+        '''
+        ワーカープロセスの準備（初回の作成で行う初期化を済ませる）
+        '''
+        mimetypes.init()
+        yaml.load('{}', Loader=yaml.SafeLoader)
+        xml.dom.minidom.parseString('<html/>')
+        return os.getpid()
+
+    def stop(self):
+        '''
+        受付の停止（作成中・待機中の依頼は結果を返してから終了する）
+        '''
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+    def handle_request(self, data):
+        '''
+        作成依頼の処理（結果を返す）
+        '''
+        try:
+            if len(data) > self.MAX_REQUEST_SIZE or not data.endswith(b'\n'):
+                raise BatchBase.BatchException('作成依頼が不正です。')
+            try:
+                request = json.loads(data.decode('utf-8'))
+            except ValueError as e:
+                raise BatchBase.BatchException('作成依頼が不正です。 {0}'.format(e))
+            if type(request) is not dict:
+                raise BatchBase.BatchException('作成依頼が不正です。')
+        except BatchBase.BatchException as e:
+            self.warning_log(e)
+            return {'returnCode': int(BatchBase.ReturnCode.WarningEnd), 'elapsed': 0.0, 'message': str(e)}
+
+        command = request.get('command', 'build')
+        if command == 'stop':
+            self.info_log('停止依頼受付')
+            self.stop()
+            return {'returnCode': int(BatchBase.ReturnCode.NormalEnd), 'elapsed': 0.0, 'message': ''}
+        if command == 'status':
+            with self.lock:
+                return {'returnCode': int(BatchBase.ReturnCode.NormalEnd), 'elapsed': 0.0, 'message': '', 'workers': self.workers, 'queueSize': self.queue_size, 'jobs': self.jobs}
+        if command != 'build':
+            return {'returnCode': int(BatchBase.ReturnCode.WarningEnd), 'elapsed': 0.0, 'message': '不明な依頼です。 {0}'.format(command)}
+
+        # 作成中・待機中の依頼が上限に達している場合は受け付けない
+        with self.lock:
+            if self.jobs >= self.workers + self.queue_size:
+                self.warning_log('作成依頼が上限に達しているため受け付けません。')
+                return {'returnCode': int(BatchBase.ReturnCode.WarningEnd), 'elapsed': 0.0, 'message': '作成依頼が上限に達しています。'}
+            self.jobs += 1
+            executor = self.executor
+        try:
+            return_code, elapsed, message = executor.submit(BuildServer.build_book, request).result()
+        except concurrent.futures.process.BrokenProcessPool as e:
+            # ワーカープロセスが異常終了した場合は起動し直す
+            return_code, elapsed, message = BatchBase.ReturnCode.AbnormalEnd, 0.0, str(e)
+            with self.lock:
+                if self.executor is executor:
+                    self.error_log('ワーカープロセスが異常終了しました。起動し直します。')
+                    executor.shutdown(wait=False)
+                    self.open_executor()
+        except Exception as e:
+            return_code, elapsed, message = BatchBase.ReturnCode.AbnormalEnd, 0.0, str(e)
+        finally:
+            with self.lock:
+                self.jobs -= 1
+        self.info_log('作成結果: {0} ({1:.2f}s) {2}'.format(BatchBase.ReturnCode(return_code).name, elapsed, request.get('argv', request.get('outputFile', ''))))
+        return {'returnCode': int(return_code), 'elapsed': elapsed, 'message': message}
+
+    @classmethod
+    def build_book(cls, request):
+        '''
+        ワーカープロセスでの電子書籍作成（戻り値、処理時間、警告・エラーのログを返す）
+        argv: コマンドラインで実行する場合と同じパラメータ（相対パスはcurrentDirectoryから解決する）
+        settings: 設定値（outputFile・options・baseDirectoryはEpubBuilderと同じ）
+        '''
+        start = time.perf_counter()
+        current_dirpath = os.getcwd()
+        try:
+            if 'argv' in request:
+                argv = [str(value) for value in request['argv']]
+                if len([value for value in argv if value in ['-w', '--watch'] or value.startswith('--watch=')]) > 0:
+                    raise BatchBase.BatchException('作成サーバーではファイルの監視（-w）は指定できません。')
+                if not Utility.is_empty(request.get('currentDirectory')):
+                    os.chdir(request['currentDirectory'])
+                # 警告・エラーのログを結果として返す（標準出力には出力しない）
+                batch = Batch()
+                stream = io.StringIO()
+                handler = logging.StreamHandler(stream)
+                handler.setLevel(logging.WARNING)
+                batch.log0.addHandler(handler)
+                try:
+                    with contextlib.redirect_stderr(stream):
+                        return_code = batch.execute(argv + ['-s', '1'])
+                except SystemExit as e:
+                    # パラメータの解析に失敗した場合（コマンドラインで実行する場合と同じ戻り値とメッセージ）
+                    return_code = e.code if type(e.code) is int else BatchBase.ReturnCode.AbnormalEnd
+                finally:
+                    batch.log0.removeHandler(handler)
+                    batch.fh.close()
+                message = stream.getvalue().strip()
+            else:
+                if type(request.get('settings')) is not dict or Utility.is_empty(request.get('outputFile')):
+                    raise BatchBase.BatchException('作成依頼にはargv、またはsettingsとoutputFileを指定してください。')
+                base_dirpath = request.get('baseDirectory')
+                if Utility.is_empty(base_dirpath):
+                    base_dirpath = request.get('currentDirectory')
+                EpubBuilder(settings=request['settings'], base_dirpath=base_dirpath, options=request.get('options')).write(request['outputFile'])
+                return_code, message = BatchBase.ReturnCode.NormalEnd, ''
+        except BatchBase.BatchException as e:
+            return_code, message = BatchBase.ReturnCode.WarningEnd, str(e)
+        except Exception as e:
+            return_code, message = BatchBase.ReturnCode.AbnormalEnd, '{0}\n{1}'.format(e, traceback.format_exc())
+        finally:
+            os.chdir(current_dirpath)
+        return (int(return_code), time.perf_counter() - start, message)
+
+
 if __name__ == '__main__':
     argv = sys.argv
     del argv[0]
+    # 一括作成
+    if len(argv) > 0 and argv[0] == 'batch':
+        exit(MultiBatch().execute(argv[1:]))
+    # 作成サーバー
+    if len(argv) > 0 and argv[0] == 'server':
+        exit(BuildServer().execute(argv[1:]))
     exit(Batch().execute(argv))
@@ -12,7 +12,21 @@ import uuid
 import subprocess
 import re
 import platform
-from epub_generator import Utility, FileSystem, Convert, DateTimeHelper, BatchBase, Batch
+import sys
+import zipfile
+import glob
+import json
+import logging
+import io
+import pickle
+import copy
+import struct
+import zlib
+import yaml
+import xml.etree.ElementTree as ET
+from epub_generator import Utility, FileSystem, Convert, XmlWriter, DateTimeHelper, ReplaceRules, SettingRecord, ChapterRecord, ResourceRecord, SettingResolver, ContentTemplate, ChapterTransformer, ChapterCache, ImageCache, FilePrefetcher, PngOptimizer, CompressionPolicy, EpubWriter, BatchBase, Batch, EpubBuilder
+from benchmark_epub_generator import SyntheticBook, Benchmark
+from client_epub_generator import BuildClient
 
 EPUB_CHECKER_PATH = r'..\epub-checker\epubcheck.jar'
 
@@ -283,6 +297,78 @@ class TestConvert(TestBase):
         value = '2022-02-28 23:58:59'
         self.assertEqual('20220228235859', Convert.parse(value, 'datetime'))
 
+    def test_normalize_line_breaks(self):
+        '''
+        Convert.normalize_line_breaks
+        '''
+        # 空
+        self.assertEqual('', Convert.normalize_line_breaks(''))
+        self.assertEqual(None, Convert.normalize_line_breaks(None))
+
+        # 末尾に改行を付加
+        self.assertEqual('a\n', Convert.normalize_line_breaks('a'))
+        self.assertEqual('a\n\n', Convert.normalize_line_breaks('a\n\n'))
+
+        # str.splitlines()と同じ区切り
+        value = 'a\r\nb\rc\x0bd\x0ce\x1cf\x85g\u2028h\u2029i\n\n'
+        self.assertEqual(''.join([line + '\n' for line in value.splitlines()]), Convert.normalize_line_breaks(value))
+
+
+class TestXmlWriter(TestBase):
+    def test_write(self):
+        '''
+        XmlWriter
+        '''
+        texts = ['タイトル', 'a&b<c>"d"\'e\'', '  前後の空白  ', '1行目\n\n  \n2行目', '1行目\r\n2行目\r3行目']
+
+        # ElementTreeで作成してConvert.get_pretty_xml()で成形した場合と同じになる
+        package = ET.Element('package', {'xmlns': 'http://www.idpf.org/2007/opf', 'version': '3.0', 'xml:lang': 'ja'})
+        metadata = ET.SubElement(package, 'metadata', {'xmlns:dc': 'http://purl.org/dc/elements/1.1/'})
+        for text in texts:
+            ET.SubElement(metadata, 'dc:title', {'id': 'a&b<"c">'}).text = text
+        ET.SubElement(metadata, 'meta', {'name': 'cover', 'content': 'cover-image'})
+        ET.SubElement(package, 'manifest')
+        spine = ET.SubElement(package, 'spine', {'page-progression-direction': 'rtl'})
+        ET.SubElement(spine, 'itemref', {'idref': 'content_1'})
+        expected = Convert.get_pretty_xml(ET.tostring(package, encoding='utf-8'))
+
+        def write(indent):
+            data = []
+            xml_writer = XmlWriter(data.append, indent)
+            xml_writer.start('package', {'xmlns': 'http://www.idpf.org/2007/opf', 'version': '3.0', 'xml:lang': 'ja'})
+            xml_writer.start('metadata', {'xmlns:dc': 'http://purl.org/dc/elements/1.1/'})
+            for text in texts:
+                xml_writer.element('dc:title', {'id': 'a&b<"c">'}, text)
+            xml_writer.element('meta', {'name': 'cover', 'content': 'cover-image'})
+            xml_writer.end('metadata')
+            xml_writer.start('manifest')
+            xml_writer.end('manifest')
+            xml_writer.start('spine', {'page-progression-direction': 'rtl'})
+            xml_writer.element('itemref', {'idref': 'content_1'})
+            xml_writer.end('spine')
+            xml_writer.end('package')
+            return ''.join(data)
+
+        self.assertEqual(expected, write('\t'))
+
+        # インデントしない
+        data = []
+        xml_writer = XmlWriter(data.append, None)
+        xml_writer.start('spine', {'page-progression-direction': 'rtl'})
+        xml_writer.element('itemref', {'idref': 'content_1'})
+        xml_writer.element('dc:title', None, 'タイトル')
+        xml_writer.end('spine')
+        self.assertEqual('<?xml version="1.0" ?><spine page-progression-direction="rtl"><itemref idref="content_1"/><dc:title>タイトル</dc:title></spine>', ''.join(data))
+
+        # 属性値の改行は文字参照にする
+        data = []
+        XmlWriter(data.append).element('meta', {'content': 'a\nb'})
+        self.assertEqual('<?xml version="1.0" ?>\n<meta content="a&#10;b"/>', ''.join(data))
+
+        # 値のない属性はElementTreeと同じくTypeError
+        with self.assertRaises(TypeError):
+            XmlWriter([].append).element('item', {'media-type': None})
+
 
 class TestDateTimeHelper(TestBase):
     def test_now(self):
@@ -411,6 +497,570 @@ class TestDateTimeHelper(TestBase):
         self.assertEqual('20220228', d.add_days(-1).strftime('%Y%m%d'))
 
 
+class TestReplaceRules(TestBase):
+    def test_compile(self):
+        '''
+        ReplaceRules.compile
+        '''
+        # 正規表現→単純置換の順に並ぶ
+        rules = ReplaceRules.compile([
+            {'type': 'simple', 'placeHolder': 'a', 'replaceContent': 'b'},
+            {'type': 'regex', 'placeHolder': '([0-9]+)', 'replaceContent': '<\\1>'},
+            {'type': 'unknown', 'placeHolder': 'x', 'replaceContent': 'y'},
+            {'type': 'simple', 'placeHolder': 'c', 'replaceContent': None},
+        ])
+        self.assertEqual(3, len(rules))
+        self.assertEqual(('regex', '([0-9]+)', '<\\1>'), rules.rules[0])
+        self.assertEqual(('simple', 'a', 'b'), rules.rules[1])
+        self.assertEqual(('simple', 'c', ''), rules.rules[2])
+
+        # 空
+        self.assertEqual(0, len(ReplaceRules.compile(None)))
+        self.assertEqual(0, len(ReplaceRules.compile([])))
+
+        # 変更不可
+        with self.assertRaises(AttributeError):
+            rules.rules = ()
+
+    def test_apply(self):
+        '''
+        ReplaceRules.apply
+        '''
+        rules = ReplaceRules.compile([
+            {'type': 'simple', 'placeHolder': 'x', 'replaceContent': 'one'},
+            {'type': 'regex', 'placeHolder': '([0-9]+)号', 'replaceContent': '<span>\\1</span>号'},
+            {'type': 'regex', 'placeHolder': '\\n', 'replaceContent': '<br />\\n'},
+        ])
+        self.assertEqual('<span>12</span>号 one<br />\n', rules.apply('12号 x\n'))
+        self.assertEqual('', rules.apply(''))
+        self.assertEqual(None, rules.apply(None))
+
+        # 連結した置換ルールは左から順に実行される
+        rules = ReplaceRules.compile([{'type': 'simple', 'placeHolder': 'a', 'replaceContent': 'b'}]) + ReplaceRules.compile([{'type': 'simple', 'placeHolder': 'b', 'replaceContent': 'c'}])
+        self.assertEqual('cc', rules.apply('ab'))
+
+        # Batch.content_replaceと同じ結果になる
+        replaces = [{'type': 'regex', 'placeHolder': '(！？)', 'replaceContent': '<span class="tcu">!?</span>'}]
+        self.assertEqual(Batch.content_replace(None, 'あ！？', replaces), ReplaceRules.compile(replaces).apply('あ！？'))
+
+
+    def test_is_line_local_rule(self):
+        '''
+        ReplaceRules.is_line_local_rule
+        '''
+        # 行をまたがない
+        self.assertEqual(True, ReplaceRules.is_line_local_rule('simple', '##'))
+        self.assertEqual(True, ReplaceRules.is_line_local_rule('regex', '(！？)'))
+        self.assertEqual(True, ReplaceRules.is_line_local_rule('regex', '\\n', '<br />\\n'))
+        self.assertEqual(True, ReplaceRules.is_line_local_rule('regex', '\\{ruby\\:(\\w+)\\{(\\w+)\\}\\}'))
+        self.assertEqual(True, ReplaceRules.is_line_local_rule('regex', '([0-9]{1,2})号'))
+        self.assertEqual(True, ReplaceRules.is_line_local_rule('regex', '\\\\n'))
+
+        # 行をまたぐ可能性がある
+        self.assertEqual(False, ReplaceRules.is_line_local_rule('simple', 'a\nb'))
+        self.assertEqual(False, ReplaceRules.is_line_local_rule('regex', '^(\\s+)'))
+        self.assertEqual(False, ReplaceRules.is_line_local_rule('regex', 'a$'))
+        self.assertEqual(False, ReplaceRules.is_line_local_rule('regex', '\\n+'))
+        self.assertEqual(False, ReplaceRules.is_line_local_rule('regex', 'a\\nb'))
+        self.assertEqual(False, ReplaceRules.is_line_local_rule('regex', '[^a]'))
+        self.assertEqual(False, ReplaceRules.is_line_local_rule('regex', '(?s).'))
+        self.assertEqual(False, ReplaceRules.is_line_local_rule('regex', 'x*'))
+
+        # 改行を削除／追加する
+        self.assertEqual(False, ReplaceRules.is_line_local_rule('regex', '\\n'))
+        self.assertEqual(False, ReplaceRules.is_line_local_rule('regex', '\\n', '<br />\\n\\n'))
+        self.assertEqual(False, ReplaceRules.is_line_local_rule('regex', '(a)', '\\1\\n'))
+        self.assertEqual(False, ReplaceRules.is_line_local_rule('simple', 'a', 'b\n'))
+
+        # 置換ルール全体
+        self.assertEqual(True, ReplaceRules.compile([{'type': 'regex', 'placeHolder': '\\n', 'replaceContent': '<br />\\n'}]).line_local)
+        self.assertEqual(False, ReplaceRules.compile([{'type': 'regex', 'placeHolder': '\\n', 'replaceContent': '<br />\\n'}, {'type': 'regex', 'placeHolder': '^', 'replaceContent': '　'}]).line_local)
+
+
+class TestSettingResolver(TestBase):
+    def test_resolve(self):
+        '''
+        SettingResolver.resolve
+        '''
+        settings = {
+            'title': 'タイトル',
+            'bookId': 1,
+            'authorName': None,
+            'otherAuthors': [
+                {'authorName': 'ペンネーム2'},
+                {'authorName': 'ペンネーム3'},
+            ],
+            'resources': {'chapters': {'files': [{'title': '第1話', 'filePath': './contents_1.xhtml'}]}},
+            'dotted.key': 'ドット',
+        }
+        resolver = SettingResolver(settings)
+
+        # 階層／配列
+        self.assertEqual('<h1>タイトル</h1>1', resolver.resolve('<h1>{$setting.title}</h1>{$setting.bookId}'))
+        self.assertEqual('ペンネーム2/ペンネーム3', resolver.resolve('{$setting.otherAuthors.1.authorName}/{$setting.otherAuthors.2.authorName}'))
+        self.assertEqual('<a href="./contents_1.xhtml">第1話</a>', resolver.resolve('<a href="{$setting.resources.chapters.files.1.filePath}">{$setting.resources.chapters.files.1.title}</a>'))
+
+        # Noneは空文字
+        self.assertEqual('[]', resolver.resolve('[{$setting.authorName}]'))
+
+        # キーにドットを含む
+        self.assertEqual('ドット', resolver.resolve('{$setting.dotted.key}'))
+
+        # 未定義／値ではないプレースホルダはそのまま残す
+        value = '{$setting.nothing} {$setting.otherAuthors.3.authorName} {$setting.otherAuthors.0.authorName} {$setting.otherAuthors} {$setting.resources.chapters} {$title}'
+        self.assertEqual(value, resolver.resolve(value))
+
+        # 置換後の値は再置換しない
+        resolver = SettingResolver({'a': '{$setting.b}', 'b': 'x'})
+        self.assertEqual('{$setting.b}x', resolver.resolve('{$setting.a}{$setting.b}'))
+
+        # 空
+        self.assertEqual('', resolver.resolve(''))
+        self.assertEqual(None, resolver.resolve(None))
+
+
+class TestSettingRecord(TestBase):
+    def test_record(self):
+        '''
+        SettingRecord（ChapterRecord／ResourceRecord）
+        '''
+        chapter = ChapterRecord({'title': '第1話', 'fileType': 'text', 'filePath': './contents_1.xhtml', 'replaces': ()})
+        chapter.body = ['本文']
+
+        # 辞書と同じくキーで参照できる（本文データは設定値のキーに含めない）
+        self.assertEqual('第1話', chapter['title'])
+        self.assertEqual(['本文'], chapter['body'])
+        self.assertEqual(['title', 'fileType', 'filePath', 'replaces'], chapter.keys())
+        self.assertTrue('title' in chapter)
+        self.assertFalse('body' in chapter)
+        self.assertFalse('bindContent' in chapter)
+        self.assertIsNone(chapter.get('bindContent'))
+        with self.assertRaises(KeyError):
+            chapter['bindContent']
+        with self.assertRaises(KeyError):
+            chapter['nothing'] = ''
+
+        # 本文データはpickle化しない
+        self.assertEqual({'title': '第1話', 'fileType': 'text', 'filePath': './contents_1.xhtml', 'replaces': ()}, dict(pickle.loads(pickle.dumps(chapter)).items()))
+        self.assertIsNone(pickle.loads(pickle.dumps(chapter)).body)
+
+        # リソースは設定ファイルに記載された他のキーも保持する
+        image = ResourceRecord({'filePath': './cover.png', 'isCover': True, 'alt': '表紙'})
+        self.assertEqual('表紙', image['alt'])
+        self.assertEqual(['filePath', 'isCover', 'alt'], image.keys())
+
+        # 設定値として参照できる
+        resolver = SettingResolver({'resources': {'images': [image], 'chapters': {'files': [chapter]}}})
+        self.assertEqual('第1話 表紙 {$setting.resources.chapters.files.1.body}', resolver.resolve('{$setting.resources.chapters.files.1.title} {$setting.resources.images.1.alt} {$setting.resources.chapters.files.1.body}'))
+
+
+class TestContentTemplate(TestBase):
+    def test_render(self):
+        '''
+        ContentTemplate.render
+        '''
+        resolver = SettingResolver({'title': 'タイトル', 'authorName': None})
+        chapters = [
+            {'title': '第1話', 'filePath': './contents_1.xhtml', 'body': ['本文1\n', '{$chapter.filePath}\n']},
+            {'title': None, 'filePath': './contents/2.png', 'body': []},
+        ]
+
+        def render(content, chapter=None):
+            data = []
+            ContentTemplate(content).render(data.append, resolver, chapter, chapters)
+            return ''.join(data)
+
+        # 設定値／チャプターのプレースホルダ（未定義の設定値はそのまま残す）
+        content = '<h1>{$setting.title}{$setting.nothing}</h1>{$chapter.title}[{$chapter.body}]{$chapter.filePath}'
+        template = ContentTemplate(content)
+        self.assertEqual({'title', 'nothing'}, template.setting_paths)
+        self.assertFalse(template.has_loop)
+        self.assertEqual('<h1>タイトル{$setting.nothing}</h1>第1話[本文1\n./contents_1.xhtml\n]./contents_1.xhtml', render(content, chapters[0]))
+        self.assertEqual('[]<img src="./contents/2.png" />', render('{$chapter.title}[{$chapter.body}]<img src="{$chapter.filePath}" />', chapters[1]))
+
+        # チャプターを紐づけていない場合はチャプターのプレースホルダをそのまま残す
+        self.assertEqual('{$chapter.title}{$chapter.body}', render('{$chapter.title}{$chapter.body}'))
+
+        # ループ
+        content = '<ol>\n{$foreach.chapters}<li><a href="{$chapter.filePath}">{$chapter.title}</a>{$setting.authorName}</li>\n{$endforeach}</ol>'
+        self.assertTrue(ContentTemplate(content).has_loop)
+        self.assertEqual('<ol>\n<li><a href="./contents_1.xhtml">第1話</a></li>\n<li><a href="./contents/2.png"></a></li>\n</ol>', render(content))
+
+        # 不正なループ
+        for content in ['{$foreach.chapters}', '{$endforeach}', '{$foreach.chapters}{$foreach.chapters}{$endforeach}{$endforeach}', '{$foreach.chapters}{$chapter.body}{$endforeach}']:
+            with self.assertRaises(ValueError):
+                ContentTemplate(content)
+
+
+class TestChapterCache(TestBase):
+    def test_get_put(self):
+        '''
+        ChapterCache.get／put／evict／clear
+        '''
+        temp_dir = self.create_temp_directory()
+        cache = ChapterCache(os.path.join(temp_dir, 'cache'), 1024 * 1024)
+        resolver = SettingResolver({'title': 'タイトル', 'authorName': '作者'})
+
+        # 保存した本文データ（改行コードもそのまま）と置換したプレースホルダのパスを取得できる
+        self.assertIsNone(cache.get('key1', resolver))
+        self.assertTrue(cache.put('key1', ['タイトル\r\n', '本文\n'], resolver, {'title'}))
+        self.assertEqual((['タイトル\r\n本文\n'], {'title'}), cache.get('key1', resolver))
+        self.assertEqual((1, 1, 1), (cache.hits, cache.misses, cache.stores))
+
+        # 参照した設定値が変わった場合は取得しない（参照していない設定値は影響しない）
+        self.assertIsNone(cache.get('key1', SettingResolver({'title': '別のタイトル', 'authorName': '作者'})))
+        self.assertIsNotNone(cache.get('key1', SettingResolver({'title': 'タイトル', 'authorName': '別の作者'})))
+
+        # サイズの上限を超えた場合は使用日時の古いものから削除する
+        cache.put('key2', ['a' * 100], resolver, set())
+        os.utime(cache.get_filepath('key2'), ns=(1, 1))
+        cache.put('key3', ['b' * 100], resolver, set())
+        cache.max_size = sum(os.path.getsize(cache.get_filepath(key)) for key in ['key1', 'key3'])
+        cache.evict()
+        self.assertIsNone(cache.get('key2', resolver))
+        self.assertIsNotNone(cache.get('key1', resolver))
+        self.assertIsNotNone(cache.get('key3', resolver))
+        self.assertEqual(1, cache.evictions)
+
+        cache.clear()
+        self.assertEqual([], os.listdir(os.path.join(temp_dir, 'cache')))
+
+    def test_split_body(self):
+        '''
+        ChapterCache.get(本文データの分割)
+        '''
+        temp_dir = self.create_temp_directory()
+        cache = ChapterCache(os.path.join(temp_dir, 'cache'), 1024 * 1024)
+        resolver = SettingResolver({})
+
+        def render(body):
+            data = []
+            chapter = {'title': '第1話', 'filePath': './contents_1.xhtml', 'body': body}
+            ContentTemplate('{$chapter.body}').render(data.append, resolver, chapter, [chapter])
+            return ''.join(data)
+
+        # 読み込む単位をまたぐ{$chapter.filePath}も、保存前の本文データと同じく置換される
+        chunk_size = ChapterTransformer.BODY_CHUNK_SIZE
+        try:
+            ChapterTransformer.BODY_CHUNK_SIZE = 64
+            body = ['x' * 59 + '{$chapter.filePath}\n' + 'y' * 200 + '\n', 'z']
+            cache.put('key1', body, resolver, set())
+            cached_body = cache.get('key1', resolver)[0]
+        finally:
+            ChapterTransformer.BODY_CHUNK_SIZE = chunk_size
+        self.assertEqual(''.join(body), ''.join(cached_body))
+        self.assertTrue(all([data.endswith('\n') for data in cached_body[:-1]]))
+        self.assertEqual(render(body), render(cached_body))
+
+    def test_image_cache(self):
+        '''
+        ImageCache.get／put、ChapterCache.clear_directory
+        '''
+        temp_dir = self.create_temp_directory()
+        cache_dir = os.path.join(temp_dir, 'cache')
+        chapter_cache = ChapterCache(cache_dir, 1024 * 1024)
+        image_cache = ImageCache(os.path.join(cache_dir, ImageCache.DIRNAME), 1024 * 1024)
+
+        # 保存したデータ（最適化しない画像の空のデータを含む）をそのまま取得できる
+        self.assertIsNone(image_cache.get('key1'))
+        self.assertTrue(image_cache.put('key1', b'\x89PNG\r\n\x1a\n\x00'))
+        self.assertTrue(image_cache.put('key2', b''))
+        self.assertEqual(b'\x89PNG\r\n\x1a\n\x00', image_cache.get('key1'))
+        self.assertEqual(b'', image_cache.get('key2'))
+        self.assertEqual((2, 1, 2), (image_cache.hits, image_cache.misses, image_cache.stores))
+
+        # チャプターキャッシュのディレクトリごと削除すると画像キャッシュも削除する
+        chapter_cache.put('key1', ['本文'], SettingResolver({}), set())
+        ChapterCache.clear_directory(cache_dir)
+        self.assertEqual([], glob.glob(os.path.join(cache_dir, '*' + ChapterCache.EXTENSION)))
+        self.assertEqual([], os.listdir(image_cache.dirpath))
+
+
+class TestFilePrefetcher(TestBase):
+    def test_get(self):
+        '''
+        FilePrefetcher.get
+        '''
+        temp_dir = self.create_temp_directory()
+        filepaths = [os.path.join(temp_dir, '{0}.txt'.format(i)) for i in range(5)]
+        for i, filepath in enumerate(filepaths):
+            self.create_file(filepath, 'data{0}'.format(i))
+
+        # 先読みしたデータは取得した時点で解放する
+        prefetcher = FilePrefetcher(filepaths + [os.path.join(temp_dir, 'nothing.txt')], 2)
+        prefetcher.start()
+        try:
+            for i, filepath in enumerate(filepaths):
+                for _ in range(100):
+                    if filepath in prefetcher.buffer:
+                        break
+                    time.sleep(0.01)
+                self.assertLessEqual(len(prefetcher.buffer), 2)
+                self.assertEqual('data{0}'.format(i).encode('utf-8'), prefetcher.get(filepath))
+                self.assertEqual(None, prefetcher.get(filepath))
+            # 読み込めないファイルはNone
+            self.assertEqual(None, prefetcher.get(os.path.join(temp_dir, 'nothing.txt')))
+        finally:
+            prefetcher.close()
+        self.assertEqual(5, prefetcher.hits)
+        self.assertEqual({}, prefetcher.buffer)
+
+        # 先読みしない場合・上限より大きいファイルはNone
+        for prefetcher in [FilePrefetcher(filepaths, 0), FilePrefetcher(filepaths, 2, max_buffer_size=1)]:
+            prefetcher.start()
+            time.sleep(0.1)
+            self.assertEqual(None, prefetcher.get(filepaths[0]))
+            prefetcher.close()
+
+
+class TestPngOptimizer(TestBase):
+    def create_png(self, chunks, level=0):
+        '''
+        PNGのデータ作成（chunks: IHDR／IDAT／IEND以外のチャンク、IDATは4チャンクに分割する）
+        '''
+        def chunk(chunk_type, chunk_data):
+            return struct.pack('>I', len(chunk_data)) + chunk_type + chunk_data + struct.pack('>I', zlib.crc32(chunk_type + chunk_data))
+
+        image_data = b''.join([b'\x00' + bytes([y % 256] * 64 * 3) for y in range(64)])
+        compressed = zlib.compress(image_data, level)
+        size = len(compressed) // 4 + 1
+        data = b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 64, 64, 8, 2, 0, 0, 0))
+        data += b''.join([chunk(chunk_type, chunk_data) for chunk_type, chunk_data in chunks])
+        data += b''.join([chunk(b'IDAT', compressed[i:i + size]) for i in range(0, len(compressed), size)])
+        return data + chunk(b'IEND', b'')
+
+    def test_optimize(self):
+        '''
+        PngOptimizer.optimize
+        '''
+        # IDATを圧縮し直し、表示に影響しない補助チャンクを削除する（画像データは変わらない）
+        data = self.create_png([(b'gAMA', struct.pack('>I', 45455)), (b'tEXt', b'Comment\x00test'), (b'tIME', bytes(7))])
+        optimized = PngOptimizer.optimize(data)
+        self.assertLess(len(optimized), len(data))
+        chunks = PngOptimizer.read_chunks(optimized)
+        self.assertEqual([b'IHDR', b'gAMA', b'IDAT', b'IEND'], [chunk_type for chunk_type, chunk_data in chunks])
+        self.assertEqual(zlib.decompress(b''.join([chunk_data for chunk_type, chunk_data in PngOptimizer.read_chunks(data) if chunk_type == b'IDAT'])), zlib.decompress(chunks[2][1]))
+        # 最適化済みのデータは小さくならない
+        self.assertEqual(None, PngOptimizer.optimize(optimized))
+
+        # APNG・不明な必須チャンク・不正なデータは最適化しない
+        self.assertEqual(None, PngOptimizer.optimize(self.create_png([(b'acTL', bytes(8))])))
+        self.assertEqual(None, PngOptimizer.optimize(self.create_png([(b'ABCD', b'')])))
+        self.assertEqual(None, PngOptimizer.optimize(data[:-20] + data[-19:]))
+        self.assertEqual(None, PngOptimizer.optimize(b'GIF89a'))
+
+    def test_deploy(self):
+        '''
+        Batch.execute(PNG最適化)
+        '''
+        temp_dir = self.create_temp_directory()
+        parameters = {'chapters': 2, 'chapterSize': 1, 'images': 2, 'imageSize': 1}
+        setting_filepath = SyntheticBook(os.path.join(temp_dir, 'book'), parameters).create()
+        data = self.create_png([(b'tEXt', b'Comment\x00test')])
+        for name in ['00001.png', '00002.png']:
+            pathlib.Path(temp_dir, 'book', 'image', name).write_bytes(data)
+
+        # 最適化したPNGを格納し、最適化結果は画像キャッシュに保存する
+        cache_dir = os.path.join(temp_dir, 'cache')
+        for jobs in ['1', '2']:
+            epub_filepath = os.path.join(temp_dir, 'book{0}.epub'.format(jobs))
+            self.assertEqual(0, Batch().execute(['-i', setting_filepath, '-o', epub_filepath, '-s', '1', '-n', '1', '-g', cache_dir, '-j', jobs]))
+            with zipfile.ZipFile(epub_filepath) as f:
+                self.assertEqual(PngOptimizer.optimize(data), f.read('OEBPS/resources/00001.png'))
+                self.assertEqual(PngOptimizer.optimize(data), f.read('OEBPS/resources/00002.png'))
+        self.assertEqual(1, len(glob.glob(os.path.join(cache_dir, ImageCache.DIRNAME, '*' + ImageCache.EXTENSION))))
+
+        # 指定しない場合はそのまま格納する
+        epub_filepath = os.path.join(temp_dir, 'book.epub')
+        self.assertEqual(0, Batch().execute(['-i', setting_filepath, '-o', epub_filepath, '-s', '1', '-g', cache_dir]))
+        with zipfile.ZipFile(epub_filepath) as f:
+            self.assertEqual(data, f.read('OEBPS/resources/00001.png'))
+
+
+class TestResourceDeduplication(TestBase):
+    def test_deduplicate(self):
+        '''
+        Batch.execute(同じ内容のリソースファイルの統合)
+        '''
+        temp_dir = self.create_temp_directory()
+        parameters = {'chapters': 2, 'chapterSize': 1, 'images': 3, 'imageSize': 1}
+        setting_filepath = SyntheticBook(os.path.join(temp_dir, 'book'), parameters).create()
+        shutil.copyfile(os.path.join(temp_dir, 'book', 'image', '00001.png'), os.path.join(temp_dir, 'book', 'image', '00003.png'))
+
+        # 省略時は統合しない
+        epub_filepath = os.path.join(temp_dir, 'book.epub')
+        self.assertEqual(0, Batch().execute(['-i', setting_filepath, '-o', epub_filepath, '-s', '1', '-g', os.path.join(temp_dir, 'cache')]))
+        with zipfile.ZipFile(epub_filepath) as f:
+            self.assertIn('OEBPS/resources/00003.png', f.namelist())
+
+        # resources.deduplicate: trueの場合、表紙と同じ内容の画像は格納せず、マニフェストにも追加しない
+        with open(setting_filepath, 'r', encoding='utf-8') as f:
+            settings = yaml.safe_load(f)
+        settings['resources']['deduplicate'] = True
+        with open(setting_filepath, 'w', encoding='utf-8') as f:
+            yaml.safe_dump(settings, f, allow_unicode=True, sort_keys=False)
+        self.assertEqual(0, Batch().execute(['-i', setting_filepath, '-o', epub_filepath, '-s', '1', '-g', os.path.join(temp_dir, 'cache')]))
+        with zipfile.ZipFile(epub_filepath) as f:
+            names = f.namelist()
+            opf = ET.fromstring(f.read('OEBPS/book.opf'))
+        self.assertIn('OEBPS/resources/00001.png', names)
+        self.assertIn('OEBPS/resources/00002.png', names)
+        self.assertNotIn('OEBPS/resources/00003.png', names)
+        items = opf.findall('.//{http://www.idpf.org/2007/opf}item')
+        hrefs = [item.get('href') for item in items]
+        self.assertEqual(len(hrefs), len(set(hrefs)))
+        self.assertEqual(['./resources/00001.png'], [item.get('href') for item in items if item.get('properties') == 'cover-image'])
+
+
+class TestCompressionPolicy(TestBase):
+    def test_select(self):
+        '''
+        CompressionPolicy.select
+        '''
+        # 圧縮済みの画像／フォントは無圧縮
+        policy = CompressionPolicy()
+        self.assertEqual(zipfile.ZIP_STORED, policy.select('OEBPS/resources/cover.png')[0])
+        self.assertEqual(zipfile.ZIP_STORED, policy.select('OEBPS/contents/page.jpg')[0])
+        self.assertEqual(zipfile.ZIP_STORED, policy.select('OEBPS/resources/font.woff2')[0])
+
+        # テキストはdeflate
+        self.assertEqual((zipfile.ZIP_DEFLATED, -1, 'deflate(6)'), policy.select('OEBPS/contents_1.xhtml'))
+        self.assertEqual(zipfile.ZIP_DEFLATED, policy.select('OEBPS/resources/style.css')[0])
+
+        # 圧縮レベル／メディアタイプ指定
+        policy = CompressionPolicy(9, ['image/jpeg'])
+        self.assertEqual((zipfile.ZIP_DEFLATED, 9, 'deflate(9)'), policy.select('OEBPS/resources/cover.png'))
+        self.assertEqual(zipfile.ZIP_STORED, policy.select('OEBPS/contents/page.jpg')[0])
+
+        # 試験圧縮
+        policy = CompressionPolicy(probe=True)
+        self.assertEqual((zipfile.ZIP_STORED, None, 'stored(probe)'), policy.select('OEBPS/resources/data.bin', os.urandom(4096)))
+        self.assertEqual(zipfile.ZIP_DEFLATED, policy.select('OEBPS/resources/data.bin', b'a' * 4096)[0])
+        self.assertEqual(zipfile.ZIP_DEFLATED, policy.select('OEBPS/resources/data.bin')[0])
+
+
+class TestEpubWriter(TestBase):
+    def test_write(self):
+        '''
+        EpubWriter.write_text／write_file／open_text
+        '''
+        temp_dir = self.create_temp_directory()
+        resource_filepath = os.path.join(temp_dir, 'style.css')
+        self.create_file(resource_filepath, 'body {}')
+
+        epub_filepath = os.path.join(temp_dir, 'test.epub')
+        writer = EpubWriter(epub_filepath)
+        writer.write_text('mimetype', 'application/epub+zip', zipfile.ZIP_STORED)
+        writer.write_file('OEBPS/resources/style.css', resource_filepath)
+        with writer.open_text('OEBPS/contents_1.xhtml') as f:
+            f.write('<html>')
+            f.write('</html>')
+        writer.close()
+
+        with zipfile.ZipFile(epub_filepath) as f:
+            infos = f.infolist()
+            self.assertEqual(['mimetype', 'OEBPS/resources/style.css', 'OEBPS/contents_1.xhtml'], [info.filename for info in infos])
+            self.assertEqual(zipfile.ZIP_STORED, infos[0].compress_type)
+            self.assertEqual(zipfile.ZIP_DEFLATED, infos[1].compress_type)
+            self.assertEqual(b'application/epub+zip', f.read('mimetype'))
+            self.assertEqual(b'body {}', f.read('OEBPS/resources/style.css'))
+            self.assertEqual(b'<html></html>', f.read('OEBPS/contents_1.xhtml'))
+
+    def test_compression_policy(self):
+        '''
+        EpubWriter(compression policy)
+        '''
+        temp_dir = self.create_temp_directory()
+        image_filepath = os.path.join(temp_dir, 'cover.png')
+        with open(image_filepath, 'wb') as f:
+            f.write(b'\x89PNG' + b'\x00' * 1024)
+            f.close()
+
+        epub_filepath = os.path.join(temp_dir, 'test.epub')
+        writer = EpubWriter(epub_filepath, CompressionPolicy(9))
+        writer.write_text('mimetype', 'application/epub+zip', zipfile.ZIP_STORED)
+        writer.write_file('OEBPS/resources/cover.png', image_filepath)
+        writer.write_text('OEBPS/book.opf', '<package />' * 100)
+        writer.close()
+
+        self.assertEqual([('mimetype', 'stored'), ('OEBPS/resources/cover.png', 'stored'), ('OEBPS/book.opf', 'deflate(9)')], writer.entries)
+        with zipfile.ZipFile(epub_filepath) as f:
+            self.assertEqual([zipfile.ZIP_STORED, zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED], [info.compress_type for info in f.infolist()])
+            self.assertEqual('<package />' * 100, f.read('OEBPS/book.opf').decode('utf-8'))
+
+    def test_parallel_compression(self):
+        '''
+        EpubWriter(parallel compression)
+        '''
+        temp_dir = self.create_temp_directory()
+        image_filepath = os.path.join(temp_dir, 'cover.png')
+        with open(image_filepath, 'wb') as f:
+            f.write(b'\x89PNG' + os.urandom(2048))
+            f.close()
+        style_filepath = os.path.join(temp_dir, 'style.css')
+        self.create_file(style_filepath, 'body { margin: 0; }\n' * 500)
+
+        # 逐次書き込みと並列圧縮で同じバイト列のファイルが作成されること
+        # （上限サイズを超えるエントリは直接書き込む）
+        results = []
+        for threads in [1, 4]:
+            epub_filepath = os.path.join(temp_dir, 'test_{0}.epub'.format(threads))
+            writer = EpubWriter(epub_filepath, CompressionPolicy(9), threads)
+            writer.date_time = (2022, 1, 31, 0, 0, 0)
+            writer.PARALLEL_MAX_SIZE = 64 * 1024
+            writer.write_text('mimetype', 'application/epub+zip', zipfile.ZIP_STORED)
+            writer.write_file('OEBPS/resources/cover.png', image_filepath)
+            writer.write_file('OEBPS/resources/style.css', style_filepath)
+            for index in range(1, 21):
+                with writer.open_text('OEBPS/contents_{0}.xhtml'.format(index)) as f:
+                    for count in range(index * 100):
+                        f.write('<p>吾輩は猫である。{0}</p>\n'.format(count))
+            writer.write_text('OEBPS/book.opf', '<package />' * 100)
+            writer.close()
+            with open(epub_filepath, 'rb') as f:
+                results.append(f.read())
+                f.close()
+        self.assertEqual(results[0], results[1])
+        with zipfile.ZipFile(os.path.join(temp_dir, 'test_4.epub')) as f:
+            self.assertIsNone(f.testzip())
+            self.assertEqual('mimetype', f.namelist()[0])
+
+    def test_writestr(self):
+        '''
+        EpubWriter(ZipFile.writestrとの比較)
+        '''
+        temp_dir = self.create_temp_directory()
+        entries = [('mimetype', b'application/epub+zip', zipfile.ZIP_STORED), ('OEBPS/resources/cover.png', b'\x89PNG' + os.urandom(2048), zipfile.ZIP_STORED)]
+        for index in range(1, 21):
+            entries.append(('OEBPS/contents_{0}.xhtml'.format(index), ''.join(['<p>吾輩は猫である。{0}</p>'.format(count) for count in range(index * 100)]).encode('utf-8'), zipfile.ZIP_DEFLATED))
+
+        # ZipFile.writestrで逐次書き込んだファイル
+        expected_filepath = os.path.join(temp_dir, 'expected.epub')
+        with zipfile.ZipFile(expected_filepath, 'w') as f:
+            for arcname, data, compress_type in entries:
+                zip_info = zipfile.ZipInfo(arcname, date_time=(2022, 1, 31, 0, 0, 0))
+                zip_info.external_attr = 0o644 << 16
+                f.writestr(zip_info, data, compress_type, 9 if compress_type == zipfile.ZIP_DEFLATED else None)
+            f.close()
+        expected = pathlib.Path(expected_filepath).read_bytes()
+
+        # 並列圧縮（圧縮済みのデータを直接書き込む）／公開APIでの書き込み（直接書き込めない場合）で同じバイト列のファイルが作成されること
+        raw_write_supported = EpubWriter.supports_raw_write()
+        try:
+            for supported in [raw_write_supported, False]:
+                EpubWriter.raw_write_supported = supported
+                epub_filepath = os.path.join(temp_dir, 'test.epub')
+                writer = EpubWriter(epub_filepath, CompressionPolicy(9), 4)
+                self.assertEqual(supported, writer.executor != None)
+                writer.date_time = (2022, 1, 31, 0, 0, 0)
+                for arcname, data, compress_type in entries:
+                    writer.write_data(arcname, data, compress_type)
+                writer.close()
+                self.assertEqual(expected, pathlib.Path(epub_filepath).read_bytes())
+        finally:
+            EpubWriter.raw_write_supported = raw_write_supported
+
+
 class TestBatch(TestBase):
 
     def exist_epub_errors(self, epub_filepath):
@@ -458,7 +1108,7 @@ class TestBatch(TestBase):
         
         return_code = -1
         try:
-            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1'])
+            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1', '-g=' + os.path.join(temp_dir, 'cache')])
         except Exception as e:
             print(e)
         self.assertEqual(1, return_code)
@@ -469,7 +1119,7 @@ class TestBatch(TestBase):
         self.create_file(os.path.join(temp_dir, 'test.yaml'), r'''''')
         return_code = -1
         try:
-            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1'])
+            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1', '-g=' + os.path.join(temp_dir, 'cache')])
         except Exception as e:
             print(e)
         
@@ -484,7 +1134,7 @@ yyyy = zzzz
         ''')
         return_code = -1
         try:
-            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1'])
+            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1', '-g=' + os.path.join(temp_dir, 'cache')])
         except Exception as e:
             print(e)
         
@@ -498,7 +1148,7 @@ xxxx: yyyy
         ''')
         return_code = -1
         try:
-            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1'])
+            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1', '-g=' + os.path.join(temp_dir, 'cache')])
         except Exception as e:
             print(e)
         
@@ -517,7 +1167,7 @@ contents:
         ''')
         return_code = -1
         try:
-            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1'])
+            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1', '-g=' + os.path.join(temp_dir, 'cache')])
         except Exception as e:
             print(e)
         self.assertEqual(1, return_code)
@@ -535,7 +1185,7 @@ contents:
         ''')
         return_code = -1
         try:
-            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1'])
+            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1', '-g=' + os.path.join(temp_dir, 'cache')])
         except Exception as e:
             print(e)
         self.assertEqual(1, return_code)
@@ -564,7 +1214,7 @@ contents:
         return_code = -1
         try:
             # 全てのファイルがない
-            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1'])
+            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1', '-g=' + os.path.join(temp_dir, 'cache')])
         except Exception as e:
             print(e)
         self.assertEqual(1, return_code)
@@ -573,7 +1223,7 @@ contents:
         try:
             # test.css作成
             pathlib.Path(os.path.join(temp_dir, 'test.css')).touch()
-            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1'])
+            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1', '-g=' + os.path.join(temp_dir, 'cache')])
         except Exception as e:
             print(e)
         self.assertEqual(1, return_code)
@@ -582,7 +1232,7 @@ contents:
         try:
             # test.png作成
             pathlib.Path(os.path.join(temp_dir, 'test.png')).touch()
-            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1'])
+            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1', '-g=' + os.path.join(temp_dir, 'cache')])
         except Exception as e:
             print(e)
         self.assertEqual(1, return_code)
@@ -591,7 +1241,7 @@ contents:
         try:
             # test1.png作成
             pathlib.Path(os.path.join(temp_dir, 'test1.png')).touch()
-            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1'])
+            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1', '-g=' + os.path.join(temp_dir, 'cache')])
         except Exception as e:
             print(e)
         self.assertEqual(1, return_code)
@@ -600,11 +1250,580 @@ contents:
         try:
             # test1.xhtml作成
             pathlib.Path(os.path.join(temp_dir, 'test.xhtml')).touch()
-            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1'])
+            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + os.path.join(temp_dir, 'test.epub'), '-s=1', '-g=' + os.path.join(temp_dir, 'cache')])
         except Exception as e:
             print(e)
         self.assertEqual(0, return_code)
 
+    def test_transform_chapter_file(self):
+        '''
+        Batch.transform_chapter_file
+        '''
+        temp_dir = self.create_temp_directory()
+        filepath = os.path.join(temp_dir, 'chapter.txt')
+        self.create_file(filepath, 'はじめに！？\n{ruby:漢字{かんじ}}を読む\n\n  12号\nおわり')
+
+        rules = ReplaceRules.compile([
+            {'type': 'regex', 'placeHolder': '(！？)', 'replaceContent': '<span class="tcu">!?</span>'},
+            {'type': 'regex', 'placeHolder': '\\n', 'replaceContent': '<br />\\n'},
+            {'type': 'regex', 'placeHolder': '\\{ruby\\:(\\w+)\\{(\\w+)\\}\\}', 'replaceContent': '<ruby>\\1<rt>\\2</rt></ruby>'},
+            {'type': 'regex', 'placeHolder': '([0-9]{1,2})号', 'replaceContent': '<span class="tcu">\\1</span>号'},
+        ])
+        batch = Batch()
+        batch.setting_resolver = SettingResolver({})
+        line_body = ''.join(batch.transform_chapter_file(filepath, rules, 'line'))
+        document_body = ''.join(batch.transform_chapter_file(filepath, rules, 'document'))
+        self.assertEqual('はじめに<span class="tcu">!?</span><br />\n<ruby>漢字<rt>かんじ</rt></ruby>を読む<br />\n<br />\n  <span class="tcu">12</span>号<br />\nおわり<br />\n', line_body)
+        self.assertEqual(line_body, document_body)
+
+        # 改行を削除する置換がある場合は、行単位と文書全体で結果が変わるため行単位で置換する
+        self.create_file(filepath, 'a\nb\n')
+        rules = ReplaceRules.compile([
+            {'type': 'regex', 'placeHolder': '\\n', 'replaceContent': ''},
+            {'type': 'regex', 'placeHolder': 'ab', 'replaceContent': 'X'},
+        ])
+        self.assertEqual(False, rules.line_local)
+        self.assertEqual('ab', ''.join(batch.transform_chapter_file(filepath, rules, 'line')))
+        self.assertEqual('X', ''.join(batch.transform_chapter_file(filepath, rules, 'document')))
+
+    @unittest.skipUnless(os.environ.get('EPUB_GENERATOR_MEMORY_TEST_SIZE_MB'), 'EPUB_GENERATOR_MEMORY_TEST_SIZE_MB未指定のためスキップします')
+    def test_chapter_memory_usage(self):
+        '''
+        Batch.execute(peak memory of large chapter file)
+        '''
+        # 合成テキスト（EPUB_GENERATOR_MEMORY_TEST_SIZE_MB=500 で500MB）
+        temp_dir = self.create_temp_directory()
+        size = int(os.environ.get('EPUB_GENERATOR_MEMORY_TEST_SIZE_MB')) * 1024 * 1024
+        line = '吾輩は猫である。名前はまだ無い！？ どこで生れたかとんと見当がつかぬ。 {ruby:薄暗{うすぐら}}い所で泣いていた。\n'
+        block = line * 10000
+        with open(os.path.join(temp_dir, 'chapter.txt'), 'w', encoding='utf-8') as f:
+            written = 0
+            while written < size:
+                f.write(block)
+                written += len(block.encode('utf-8'))
+        input_size = os.path.getsize(os.path.join(temp_dir, 'chapter.txt'))
+
+        self.create_file(os.path.join(temp_dir, 'chapter.xhtml'), '<html><body>{$chapter.body}</body></html>')
+        self.create_file(os.path.join(temp_dir, 'test.yaml'), r'''
+bookId: 5a4ec2a4-4f5b-4a6e-9f44-6c59e6b5a0b1
+modified: "2022-01-31T00:00:00Z"
+resources:
+  chapters:
+    replaces:
+      - type: regex
+        placeHolder: (！？)
+        replaceContent: <span class="tcu">!?</span>
+      - type: regex
+        placeHolder: \n
+        replaceContent: <br />\n
+      - type: regex
+        placeHolder: \{ruby\:(\w+)\{(\w+)\}\}
+        replaceContent: <ruby>\1<rt>\2</rt></ruby>
+    files:
+      - title: chapter
+        fileType: text
+        filePath: ./chapter.txt
+contents:
+  - filePath: ./chapter.xhtml
+    isNavigationContent: false
+    createByChaptersCount: true
+    useChapters:
+      - chapterIndex: 1
+        ''')
+
+        # 別プロセスで実行し、そのプロセス自身の最大RSSを計測する
+        # NOTE: RUSAGE_CHILDRENはこれまでに終了したすべての子プロセス（他のテストのワーカープロセスなど）の最大値になるため使用しない
+        result = Benchmark.run_case(os.path.join(temp_dir, 'test.yaml'), os.path.join(temp_dir, 'test.epub'), [])
+        self.assertEqual(0, result['returnCode'])
+        peak_rss = result['peakRss']
+        if peak_rss == None:
+            self.skipTest('最大RSSを取得できないためスキップします')
+        print('入力サイズ: {0:,} / 最大RSS: {1:,}'.format(input_size, peak_rss))
+
+        # 本文データは1つだけ保持するため、最大RSSは入力サイズ程度（インタプリタ分を除く）に収まる
+        self.assertLess(peak_rss, input_size * 1.3 + 64 * 1024 * 1024)
+
+    def test_parallel_transform(self):
+        '''
+        Batch.execute(parallel chapter transformation)
+        '''
+        temp_dir = self.create_temp_directory()
+
+        # 並列実行の下限サイズを超えるチャプターファイルを複数作成
+        line = '吾輩は猫である。名前はまだ無い！？ {ruby:薄暗{うすぐら}}い所で泣いていた。\n'
+        for index in range(1, 4):
+            self.create_file(os.path.join(temp_dir, 'chapter{0}.txt'.format(index)), '第{0}章\n'.format(index) + line * 8000)
+        self.create_file(os.path.join(temp_dir, 'chapter.xhtml'), '<html><body><h1>{$chapter.title}</h1>{$chapter.body}</body></html>')
+        self.create_file(os.path.join(temp_dir, 'test.yaml'), r'''
+bookId: 5a4ec2a4-4f5b-4a6e-9f44-6c59e6b5a0b1
+modified: "2022-01-31T00:00:00Z"
+resources:
+  chapters:
+    replaces:
+      - type: regex
+        placeHolder: \{ruby\:(\w+)\{(\w+)\}\}
+        replaceContent: <ruby>\1<rt>\2</rt></ruby>
+      - type: simple
+        placeHolder: ！？
+        replaceContent: <span class="tcu">!?</span>
+    files:
+      - title: chapter1
+        fileType: text
+        filePath: ./chapter1.txt
+      - title: chapter2
+        fileType: text
+        filePath: ./chapter2.txt
+        replaces:
+          - type: simple
+            placeHolder: 吾輩
+            replaceContent: 我輩
+      - title: chapter3
+        fileType: text
+        filePath: ./chapter3.txt
+contents:
+  - filePath: ./chapter.xhtml
+    isNavigationContent: false
+    createByChaptersCount: true
+    useChapters:
+      - chapterIndex: 1
+      - chapterIndex: 2
+      - chapterIndex: 3
+        ''')
+
+        # 逐次実行と並列実行で同じ内容のファイルが作成されること
+        script_path = os.path.join(os.path.dirname(__file__), 'epub_generator.py')
+        contents = []
+        for jobs in ['1', '2']:
+            epub_filepath = os.path.join(temp_dir, 'test_{0}.epub'.format(jobs))
+            process = subprocess.run([sys.executable, script_path, '-i', os.path.join(temp_dir, 'test.yaml'), '-o', epub_filepath, '-s', '1', '-g', os.path.join(temp_dir, 'cache'), '-j', jobs])
+            self.assertEqual(0, process.returncode)
+            with zipfile.ZipFile(epub_filepath) as zip_file:
+                contents.append([(name, zip_file.read(name)) for name in zip_file.namelist()])
+        self.assertEqual(contents[0], contents[1])
+        self.assertIn('我輩'.encode('utf-8'), dict(contents[1])['OEBPS/contents_2.xhtml'])
+
+    def test_incremental_build(self):
+        '''
+        Batch.execute(incremental build)
+        '''
+        temp_dir = self.create_temp_directory()
+        for index in range(1, 4):
+            self.create_file(os.path.join(temp_dir, 'chapter{0}.txt'.format(index)), '第{0}章\n{{$setting.authorName}}\n'.format(index))
+        self.create_file(os.path.join(temp_dir, 'chapter.xhtml'), '<html><body><h1>{$chapter.title}</h1>{$chapter.body}</body></html>')
+        self.create_file(os.path.join(temp_dir, 'title.xhtml'), '<html><body><h1>{$setting.title}</h1></body></html>')
+        self.create_file(os.path.join(temp_dir, 'style.css'), 'body { margin: 0; }')
+        setting = r'''
+bookId: 5a4ec2a4-4f5b-4a6e-9f44-6c59e6b5a0b1
+title: {0}
+authorName: {1}
+modified: "2022-01-31T00:00:00Z"
+resources:
+  styleSheets:
+    - filePath: ./style.css
+  chapters:
+    replaces:
+      - type: simple
+        placeHolder: 章
+        replaceContent: 話
+    files:
+      - title: chapter1
+        fileType: text
+        filePath: ./chapter1.txt
+      - title: chapter2
+        fileType: text
+        filePath: ./chapter2.txt
+      - title: chapter3
+        fileType: text
+        filePath: ./chapter3.txt
+contents:
+  - filePath: ./title.xhtml
+    isNavigationContent: false
+  - filePath: ./chapter.xhtml
+    isNavigationContent: false
+    createByChaptersCount: true
+    useChapters:
+      - chapterIndex: 1
+      - chapterIndex: 2
+      - chapterIndex: 3
+        '''
+        setting_filepath = os.path.join(temp_dir, 'test.yaml')
+        epub_filepath = os.path.join(temp_dir, 'test.epub')
+
+        def build(incremental):
+            batch = Batch()
+            self.assertEqual(0, batch.execute(['-i', setting_filepath, '-o', epub_filepath, '-s', '1', '-g', os.path.join(temp_dir, 'cache'), '-r', incremental]))
+            with zipfile.ZipFile(epub_filepath) as f:
+                contents = [(name, f.read(name)) for name in f.namelist()]
+            return (sorted(batch.reusable_contents.keys()), contents)
+
+        # 初回はすべて作成する
+        self.create_file(setting_filepath, setting.format('title1', 'author1'))
+        self.assertEqual([], build('1')[0])
+        # 変更がない場合はすべて再利用する
+        self.assertEqual([0, 1, 2, 3, 4], build('1')[0])
+
+        # チャプターファイルを変更した場合は、そのチャプターのコンテンツのみ作成する
+        self.create_file(os.path.join(temp_dir, 'chapter2.txt'), '第2章（改）\n')
+        reusable_contents, contents = build('1')
+        self.assertEqual([0, 1, 3, 4], reusable_contents)
+        self.assertEqual(contents, build('0')[1])
+
+        # 設定値を変更した場合は、その設定値を参照したコンテンツのみ作成する
+        # （title: 表紙、authorName: チャプター1と3）
+        build('1')
+        self.create_file(setting_filepath, setting.format('title2', 'author1'))
+        self.assertEqual([1, 2, 3, 4], build('1')[0])
+        self.create_file(setting_filepath, setting.format('title2', 'author2'))
+        reusable_contents, contents = build('1')
+        self.assertEqual([0, 2, 4], reusable_contents)
+        self.assertIn('author2'.encode('utf-8'), dict(contents)['OEBPS/contents_2.xhtml'])
+        self.assertEqual(contents, build('0')[1])
+
+    def test_chapter_cache(self):
+        '''
+        Batch.execute(chapter cache)
+        '''
+        temp_dir = self.create_temp_directory()
+        self.create_file(os.path.join(temp_dir, 'chapter1.txt'), '第1章 {$setting.title}\n')
+        self.create_file(os.path.join(temp_dir, 'chapter2.txt'), '第2章\n')
+        self.create_file(os.path.join(temp_dir, 'chapter.xhtml'), '<html><body>{$chapter.body}</body></html>')
+        setting = r'''
+bookId: 5a4ec2a4-4f5b-4a6e-9f44-6c59e6b5a0b1
+title: {0}
+modified: "2022-01-31T00:00:00Z"
+resources:
+  chapters:
+    replaces:
+      - type: simple
+        placeHolder: 章
+        replaceContent: 話
+    files:
+      - title: chapter1
+        fileType: text
+        filePath: ./chapter1.txt
+      - title: chapter2
+        fileType: text
+        filePath: ./chapter2.txt
+contents:
+  - filePath: ./chapter.xhtml
+    isNavigationContent: false
+    createByChaptersCount: true
+    useChapters:
+      - chapterIndex: 1
+      - chapterIndex: 2
+        '''
+        setting_filepath = os.path.join(temp_dir, 'test.yaml')
+        epub_filepath = os.path.join(temp_dir, 'test.epub')
+        cache_dir = os.path.join(temp_dir, 'cache')
+
+        def build(*options):
+            batch = Batch()
+            self.assertEqual(0, batch.execute(['-i', setting_filepath, '-o', epub_filepath, '-s', '1', '-g', cache_dir] + list(options)))
+            with zipfile.ZipFile(epub_filepath) as f:
+                contents = [(name, f.read(name)) for name in f.namelist() if name != 'OEBPS/book.opf']
+            if batch.chapter_cache == None:
+                return (None, contents)
+            return ((batch.chapter_cache.hits, batch.chapter_cache.misses), contents)
+
+        self.create_file(setting_filepath, setting.format('title1'))
+        self.assertEqual((0, 2), build()[0])
+        counts, contents = build()
+        self.assertEqual((2, 0), counts)
+        self.assertEqual(contents, build('-c', '0')[1])
+
+        # 参照している設定値を変更した場合は、そのチャプターのみ変換する
+        self.create_file(setting_filepath, setting.format('title2'))
+        counts, contents = build()
+        self.assertEqual((1, 1), counts)
+        self.assertIn('第1話 title2'.encode('utf-8'), dict(contents)['OEBPS/contents_1.xhtml'])
+        self.assertEqual(contents, build('-c', '0')[1])
+
+        # 削除してから使用する
+        self.assertEqual((0, 2), build('-c', 'clear')[0])
+
+    def test_stream(self):
+        '''
+        Batch.execute(stream)
+        '''
+        temp_dir = self.create_temp_directory()
+        self.create_file(os.path.join(temp_dir, 'chapter1.txt'), ''.join(['第{0}行 {{$setting.title}}\r\n'.format(index) for index in range(1000)]))
+        self.create_file(os.path.join(temp_dir, 'chapter2.txt'), '第2章')
+        self.create_file(os.path.join(temp_dir, 'chapter.xhtml'), '<html><body>{$chapter.title}{$chapter.body}</body></html>')
+        self.create_file(os.path.join(temp_dir, 'test.yaml'), r'''
+bookId: 5a4ec2a4-4f5b-4a6e-9f44-6c59e6b5a0b1
+title: タイトル
+modified: "2022-01-31T00:00:00Z"
+resources:
+  chapters:
+    transformMode: document
+    replaces:
+      - type: regex
+        placeHolder: 第(\d+)行
+        replaceContent: <p>\1</p>
+    files:
+      - title: chapter1
+        fileType: text
+        filePath: ./chapter1.txt
+      - title: chapter2
+        fileType: text
+        filePath: ./chapter2.txt
+contents:
+  - filePath: ./chapter.xhtml
+    isNavigationContent: false
+    createByChaptersCount: true
+    useChapters:
+      - chapterIndex: 1
+      - chapterIndex: 2
+        ''')
+        setting_filepath = os.path.join(temp_dir, 'test.yaml')
+        epub_filepath = os.path.join(temp_dir, 'test.epub')
+
+        def build(*options):
+            self.assertEqual(0, Batch().execute(['-i', setting_filepath, '-o', epub_filepath, '-s', '1', '-c', '0'] + list(options)))
+            with zipfile.ZipFile(epub_filepath) as f:
+                return [(name, f.read(name)) for name in f.namelist() if name != 'OEBPS/book.opf']
+
+        # 直接書き込んでも同じ内容になる
+        expected = build()
+        self.assertEqual(expected, build('-b', '0'))
+        self.assertEqual(expected, build('-b', '0.001'))
+
+        # 差分作成の場合は書き込み後に参照した設定値を保存する
+        build('-b', '0', '-r', '1')
+        with zipfile.ZipFile(epub_filepath) as f:
+            self.assertIn(b'"title"', f.getinfo('OEBPS/contents_1.xhtml').comment)
+        self.assertEqual(expected, build('-b', '0', '-r', '1'))
+
+        self.assertEqual(1, Batch().execute(['-i', setting_filepath, '-o', epub_filepath, '-s', '1', '-g', os.path.join(temp_dir, 'cache'), '-b', 'x']))
+
+    def test_profile(self):
+        '''
+        Batch.execute(profile)
+        '''
+        temp_dir = self.create_temp_directory()
+        self.create_file(os.path.join(temp_dir, 'chapter1.txt'), '第1章\n' * 100)
+        self.create_file(os.path.join(temp_dir, 'chapter2.txt'), '第2章\n')
+        self.create_file(os.path.join(temp_dir, 'style.css'), 'body {}\n')
+        self.create_file(os.path.join(temp_dir, 'chapter.xhtml'), '<html><body>{$chapter.body}</body></html>')
+        self.create_file(os.path.join(temp_dir, 'test.yaml'), r'''
+bookId: 5a4ec2a4-4f5b-4a6e-9f44-6c59e6b5a0b1
+title: タイトル
+modified: "2022-01-31T00:00:00Z"
+resources:
+  styleSheets:
+    - filePath: ./style.css
+  chapters:
+    files:
+      - title: chapter1
+        fileType: text
+        filePath: ./chapter1.txt
+      - title: chapter2
+        fileType: text
+        filePath: ./chapter2.txt
+contents:
+  - filePath: ./chapter.xhtml
+    isNavigationContent: false
+    createByChaptersCount: true
+    useChapters:
+      - chapterIndex: 1
+      - chapterIndex: 2
+        ''')
+        profile_filepath = os.path.join(temp_dir, 'profile', 'report.json')
+        self.assertEqual(0, Batch().execute(['-i', os.path.join(temp_dir, 'test.yaml'), '-o', os.path.join(temp_dir, 'test.epub'), '-s', '1', '-c', '0', '-f', profile_filepath]))
+        with open(profile_filepath, 'r', encoding='utf-8') as f:
+            report = json.load(f)
+
+        stages = {stage['name']: stage for stage in report['stages']}
+        self.assertEqual(['load_setting_file', 'open_epub', 'load_previous_epub', 'create_mimetype', 'create_meta_inf_container_xml', 'deploy_resource_files', 'find_reusable_contents', 'load_chapter_files', 'create_oebps_content_files', 'create_oebps_book_opf', 'create_epub', 'discard_epub'], list(stages.keys()))
+        # チャプターファイルは紐づけたコンテンツファイルの作成時に読み込む
+        self.assertEqual(0, stages['load_chapter_files']['items'])
+        chapters = [item for item in report['items'] if item['kind'] == 'chapter']
+        self.assertEqual(['create_oebps_content_files'] * 2, [item['stage'] for item in chapters])
+        self.assertEqual(len('第1章\n'.encode('utf-8')) * 100 + len('第2章\n'.encode('utf-8')), sum([item['bytesRead'] for item in chapters]))
+        self.assertEqual(['OEBPS/contents_1.xhtml', 'OEBPS/contents_2.xhtml', 'OEBPS/contents_3.xhtml'], stages['create_oebps_content_files']['entries'])
+        self.assertEqual(20, stages['create_mimetype']['bytesWritten'])
+
+        items = {(item['kind'], item['name']): item for item in report['items']}
+        self.assertEqual(len('body {}\n'), items[('resource', os.path.join(temp_dir, 'style.css'))]['bytesRead'])
+        # テンプレートは1回だけ読み込む
+        self.assertEqual(1, len([item for item in report['items'] if item['kind'] == 'template' and item['name'] == os.path.join(temp_dir, 'chapter.xhtml')]))
+        content = items[('content', 'OEBPS/contents_1.xhtml')]
+        self.assertEqual('chapter1', content['chapter'])
+        self.assertEqual(len('<html><body>{0}</body></html>'.format('第1章\n' * 100).encode('utf-8')), content['bytesWritten'])
+        self.assertLess(content['compressedBytes'], content['bytesWritten'])
+        self.assertGreater(items[('opf', 'OEBPS/book.opf')]['bytesWritten'], 0)
+        self.assertEqual(sorted([item['duration'] for item in report['items']], reverse=True)[:10], [item['duration'] for item in report['slowestItems']])
+
+    def test_memory_trace(self):
+        '''
+        Batch.execute(memory trace)
+        '''
+        temp_dir = self.create_temp_directory()
+        self.create_file(os.path.join(temp_dir, 'chapter1.txt'), '第1章\n' * 10000)
+        self.create_file(os.path.join(temp_dir, 'chapter.xhtml'), '<html><body>{$chapter.body}</body></html>')
+        self.create_file(os.path.join(temp_dir, 'test.yaml'), r'''
+bookId: 5a4ec2a4-4f5b-4a6e-9f44-6c59e6b5a0b1
+title: タイトル
+modified: "2022-01-31T00:00:00Z"
+resources:
+  chapters:
+    files:
+      - title: chapter1
+        fileType: text
+        filePath: ./chapter1.txt
+contents:
+  - filePath: ./chapter.xhtml
+    isNavigationContent: false
+    createByChaptersCount: true
+    useChapters:
+      - chapterIndex: 1
+        ''')
+        batch = Batch()
+        self.assertEqual(0, batch.execute(['-i', os.path.join(temp_dir, 'test.yaml'), '-o', os.path.join(temp_dir, 'test.epub'), '-s', '1', '-c', '0', '-e']))
+        # ログと同じディレクトリに出力する
+        filepaths = glob.glob('{0}.memory_*_{1}.json'.format(os.path.splitext(batch.fh.baseFilename)[0], os.getpid()))
+        self.assertEqual(1, len(filepaths))
+        with open(filepaths[0], 'r', encoding='utf-8') as f:
+            report = json.load(f)
+        os.remove(filepaths[0])
+
+        stages = {stage['name']: stage for stage in report['stages']}
+        self.assertEqual(['load_setting_file', 'open_epub', 'load_previous_epub', 'create_mimetype', 'create_meta_inf_container_xml', 'deploy_resource_files', 'find_reusable_contents', 'load_chapter_files', 'create_oebps_content_files', 'create_oebps_book_opf', 'create_epub', 'discard_epub'], list(stages.keys()))
+        # チャプターファイルの本文データはコンテンツファイル作成時に確保され、書き込み後に解放される
+        content_stage = stages['create_oebps_content_files']
+        self.assertGreater(content_stage['tracedPeak'] - content_stage['tracedBefore'], len('第1章\n') * 10000)
+        self.assertLess(content_stage['retained'], len('第1章\n') * 10000)
+        for stage in stages.values():
+            self.assertEqual(stage['tracedAfter'] - stage['tracedBefore'], stage['retained'])
+            self.assertGreaterEqual(stage['tracedPeak'], stage['tracedAfter'])
+        self.assertGreaterEqual(report['peakTraced'], content_stage['tracedPeak'])
+        self.assertGreater(len(report['topAllocations']), 0)
+
+    def test_watch(self):
+        '''
+        Batch.execute(watch mode)
+        '''
+        import threading
+
+        temp_dir = self.create_temp_directory()
+        for index in range(1, 3):
+            self.create_file(os.path.join(temp_dir, 'chapter{0}.txt'.format(index)), '第{0}章\n'.format(index))
+        self.create_file(os.path.join(temp_dir, 'chapter.xhtml'), '<html><body>{$chapter.body}</body></html>')
+        self.create_file(os.path.join(temp_dir, 'test.yaml'), r'''
+bookId: 5a4ec2a4-4f5b-4a6e-9f44-6c59e6b5a0b1
+modified: "2022-01-31T00:00:00Z"
+resources:
+  chapters:
+    files:
+      - title: chapter1
+        fileType: text
+        filePath: ./chapter1.txt
+      - title: chapter2
+        fileType: text
+        filePath: ./chapter2.txt
+contents:
+  - filePath: ./chapter.xhtml
+    isNavigationContent: false
+    createByChaptersCount: true
+    useChapters:
+      - chapterIndex: 1
+      - chapterIndex: 2
+        ''')
+        epub_filepath = os.path.join(temp_dir, 'test.epub')
+
+        def read_content(name):
+            with zipfile.ZipFile(epub_filepath) as f:
+                return f.read(name).decode('utf-8')
+
+        def wait_for(condition):
+            for count in range(100):
+                try:
+                    if condition():
+                        return True
+                except (OSError, KeyError, zipfile.BadZipFile):
+                    pass
+                time.sleep(0.1)
+            return False
+
+        batch = Batch()
+        batch.WATCH_INTERVAL = 0.05
+        results = []
+        thread = threading.Thread(target=lambda: results.append(batch.execute(['-i', os.path.join(temp_dir, 'test.yaml'), '-o', epub_filepath, '-s', '1', '-g', os.path.join(temp_dir, 'cache'), '--watch'])))
+        thread.start()
+        try:
+            self.assertTrue(wait_for(lambda: '第2章' in read_content('OEBPS/contents_2.xhtml')))
+
+            # チャプターファイルを変更すると、そのチャプターのみ再作成される
+            time.sleep(0.1)
+            self.create_file(os.path.join(temp_dir, 'chapter2.txt'), '第2章（改）\n')
+            self.assertTrue(wait_for(lambda: '第2章（改）' in read_content('OEBPS/contents_2.xhtml')))
+            self.assertEqual([0, 2], sorted(batch.reusable_contents.keys()))
+        finally:
+            batch.watch_stop_event.set()
+            thread.join()
+        self.assertEqual([0], results)
+
+    def test_execute_in_threads(self):
+        '''
+        Batch.execute(concurrent builds in threads)
+        '''
+        import concurrent.futures
+
+        temp_dir = self.create_temp_directory()
+
+        # 内容の異なる電子書籍を複数作成（設定ファイル中の相対パスは設定ファイルのディレクトリを基準にする）
+        setting_filepaths = []
+        for index in range(1, 5):
+            book_dir = os.path.join(temp_dir, 'book{0}'.format(index))
+            pathlib.Path(book_dir).mkdir(parents=True, exist_ok=True)
+            for chapter in range(1, index + 1):
+                self.create_file(os.path.join(book_dir, 'chapter{0}.txt'.format(chapter)), '本{0}の第{1}章 {{ruby:薄暗{{うすぐら}}}}\n'.format(index, chapter) * 100)
+            self.create_file(os.path.join(book_dir, 'chapter.xhtml'), '<html><body><h1>{$setting.title}／{$chapter.title}</h1>{$chapter.body}</body></html>')
+            files = ''.join(['      - title: chapter{0}\n        fileType: text\n        filePath: ./chapter{0}.txt\n'.format(chapter) for chapter in range(1, index + 1)])
+            use_chapters = ''.join(['      - chapterIndex: {0}\n'.format(chapter) for chapter in range(1, index + 1)])
+            self.create_file(os.path.join(book_dir, 'setting.yaml'), '''
+bookId: 5a4ec2a4-4f5b-4a6e-9f44-6c59e6b5a0b1
+title: book{0}
+modified: "2022-01-31T00:00:00Z"
+resources:
+  chapters:
+    replaces:
+      - type: regex
+        placeHolder: \\{{ruby\\:(\\w+)\\{{(\\w+)\\}}\\}}
+        replaceContent: <ruby>\\1<rt>\\2</rt></ruby>
+    files:
+{1}contents:
+  - filePath: ./chapter.xhtml
+    isNavigationContent: false
+    createByChaptersCount: true
+    useChapters:
+{2}'''.format(index, files, use_chapters))
+            setting_filepaths.append(os.path.join(book_dir, 'setting.yaml'))
+
+        def build(setting_filepath, epub_filepath):
+            return_code = Batch().execute(['-i', setting_filepath, '-o', epub_filepath, '-s', '1', '-g', os.path.join(temp_dir, 'cache')])
+            with zipfile.ZipFile(epub_filepath) as f:
+                return (return_code, [(name, f.read(name)) for name in f.namelist()])
+
+        # 逐次実行
+        current_dir = os.getcwd()
+        expected = []
+        for index, setting_filepath in enumerate(setting_filepaths):
+            expected.append(build(setting_filepath, os.path.join(temp_dir, 'serial_{0}.epub'.format(index))))
+
+        # スレッドで同時実行（1冊につき3回）しても逐次実行と同じ内容になること
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            futures = []
+            for count in range(3):
+                for index, setting_filepath in enumerate(setting_filepaths):
+                    futures.append((index, executor.submit(build, setting_filepath, os.path.join(temp_dir, 'thread_{0}_{1}.epub'.format(index, count)))))
+            for index, future in futures:
+                self.assertEqual(expected[index], future.result())
+        self.assertEqual((0, 4), (expected[0][0], len(set([str(result[1]) for result in expected]))))
+
+        # カレントディレクトリを変更しないこと
+        self.assertEqual(current_dir, os.getcwd())
+
     def test_create_minimum_epub(self):
         '''
         Batch.execute(minimum epub file)
@@ -633,7 +1852,7 @@ contents:
         return_code = -1
         epub_filepath = os.path.join(temp_dir, 'test.epub')
         try:
-            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + epub_filepath, '-s=1'])
+            return_code = Batch().execute(['-i=' + os.path.join(temp_dir, 'test.yaml'), '-o=' + epub_filepath, '-s=1', '-g=' + os.path.join(temp_dir, 'cache')])
         except Exception as e:
             print(e)
 
@@ -652,7 +1871,7 @@ contents:
         return_code = -1
         epub_filepath = os.path.join(temp_dir, 'test.epub')
         try:
-            return_code = Batch().execute(['-i=' + os.path.join(os.path.dirname(__file__), 'data', 'sample1', 'setting.yaml'), '-o=' + epub_filepath, '-s=1'])
+            return_code = Batch().execute(['-i=' + os.path.join(os.path.dirname(__file__), 'data', 'sample1', 'setting.yaml'), '-o=' + epub_filepath, '-s=1', '-g=' + os.path.join(temp_dir, 'cache')])
         except Exception as e:
             print(e)
 
@@ -671,7 +1890,7 @@ contents:
         return_code = -1
         epub_filepath = os.path.join(temp_dir, 'test.epub')
         try:
-            return_code = Batch().execute(['-i=' + os.path.join(os.path.dirname(__file__), 'data', 'sample2', 'setting.yaml'), '-o=' + epub_filepath, '-s=1'])
+            return_code = Batch().execute(['-i=' + os.path.join(os.path.dirname(__file__), 'data', 'sample2', 'setting.yaml'), '-o=' + epub_filepath, '-s=1', '-g=' + os.path.join(temp_dir, 'cache')])
         except Exception as e:
             print(e)
 
@@ -682,5 +1901,258 @@ contents:
             self.assertEqual(True, epub_result['status'])
 
 
+class TestMultiBatch(TestBase):
+
+    def create_book(self, dirpath, title):
+        '''
+        電子書籍1冊分の設定ファイル等を作成
+        '''
+        pathlib.Path(dirpath).mkdir(parents=True, exist_ok=True)
+        self.create_file(os.path.join(dirpath, 'chapter.txt'), '{0}の本文\n'.format(title) * 10)
+        self.create_file(os.path.join(dirpath, 'chapter.xhtml'), '<html><body><h1>{$setting.title}</h1>{$chapter.body}</body></html>')
+        self.create_file(os.path.join(dirpath, 'setting.yaml'), '''
+bookId: 5a4ec2a4-4f5b-4a6e-9f44-6c59e6b5a0b1
+title: {0}
+modified: "2022-01-31T00:00:00Z"
+resources:
+  chapters:
+    files:
+      - title: chapter
+        fileType: text
+        filePath: ./chapter.txt
+contents:
+  - filePath: ./chapter.xhtml
+    isNavigationContent: false
+    createByChaptersCount: true
+    useChapters:
+      - chapterIndex: 1
+        '''.format(title))
+
+    def test_execute(self):
+        '''
+        MultiBatch.execute(glob／manifest)
+        '''
+        temp_dir = self.create_temp_directory()
+        self.create_book(os.path.join(temp_dir, 'books', 'a'), 'book-a')
+        self.create_book(os.path.join(temp_dir, 'books', 'b'), 'book-b')
+        # 不正な設定ファイル
+        pathlib.Path(os.path.join(temp_dir, 'books', 'c')).mkdir(parents=True, exist_ok=True)
+        self.create_file(os.path.join(temp_dir, 'books', 'c', 'setting.yaml'), 'x: [')
+
+        script_path = os.path.join(os.path.dirname(__file__), 'epub_generator.py')
+
+        # ワイルドカード指定（1冊でも警告終了した場合は警告終了）
+        output_dir = os.path.join(temp_dir, 'out')
+        process = subprocess.run([sys.executable, script_path, 'batch', '-i', os.path.join(temp_dir, 'books', '*', 'setting.yaml'), '-o', output_dir, '-w', '2', '-s', '1', '-g', os.path.join(temp_dir, 'cache')])
+        self.assertEqual(int(BatchBase.ReturnCode.WarningEnd), process.returncode)
+        for name in ['a', 'b']:
+            with zipfile.ZipFile(os.path.join(output_dir, name, 'setting.epub')) as f:
+                self.assertIn('book-{0}'.format(name), f.read('OEBPS/contents_1.xhtml').decode('utf-8'))
+        self.assertFalse(os.path.exists(os.path.join(output_dir, 'c', 'setting.epub')))
+
+        # 一括作成ファイル指定（相対パスは一括作成ファイルのディレクトリから解決する）
+        self.create_file(os.path.join(temp_dir, 'manifest.yaml'), '''
+books:
+  - settingFilePath: ./books/a/setting.yaml
+    outputFilePath: ./manifest/a.epub
+  - settingFilePath: ./books/b/setting.yaml
+    outputFilePath: ./manifest/b.epub
+        ''')
+        process = subprocess.run([sys.executable, script_path, 'batch', '-m', os.path.join(temp_dir, 'manifest.yaml'), '-w', '1', '-s', '1', '-g', os.path.join(temp_dir, 'cache')])
+        self.assertEqual(int(BatchBase.ReturnCode.NormalEnd), process.returncode)
+        for name in ['a', 'b']:
+            with zipfile.ZipFile(os.path.join(output_dir, name, 'setting.epub')) as f1, zipfile.ZipFile(os.path.join(temp_dir, 'manifest', '{0}.epub'.format(name))) as f2:
+                self.assertEqual([f1.read(n) for n in f1.namelist()], [f2.read(n) for n in f2.namelist()])
+
+        # 作成対象なし
+        process = subprocess.run([sys.executable, script_path, 'batch', '-i', os.path.join(temp_dir, 'nothing', '*.yaml'), '-o', output_dir, '-s', '1', '-g', os.path.join(temp_dir, 'cache')])
+        self.assertEqual(int(BatchBase.ReturnCode.WarningEnd), process.returncode)
+
+
+
+class TestEpubBuilder(TestBase):
+    def test_write(self):
+        '''
+        EpubBuilder.write／to_bytes
+        '''
+        temp_dir = self.create_temp_directory()
+        settings = {
+            'bookId': '5a4ec2a4-4f5b-4a6e-9f44-6c59e6b5a0b1',
+            'title': 'タイトル',
+            'modified': '2022-01-31T00:00:00Z',
+            'resources': {
+                'styleSheets': [{'filePath': './style.css'}],
+                'images': [{'filePath': './cover.png', 'isCover': True}],
+                'chapters': {
+                    'replaces': [{'type': 'simple', 'placeHolder': '［改行］', 'replaceContent': '<br />'}],
+                    'files': [
+                        {'title': '第1話', 'fileType': 'text', 'filePath': './chapter1.txt'},
+                        {'title': '第2話', 'fileType': 'text', 'filePath': './chapter2.txt'},
+                    ],
+                },
+            },
+            'contents': [
+                {'filePath': './navigation.xhtml', 'isNavigationContent': True},
+                {'filePath': './chapter.xhtml', 'createByChaptersCount': True, 'useChapters': [{'chapterIndex': 1}, {'chapterIndex': 2}]},
+            ],
+        }
+        source_files = {
+            './style.css': 'body {}\n',
+            './cover.png': b'\x89PNG\r\n\x1a\n' + bytes(range(256)),
+            './chapter1.txt': '本文1［改行］\r\n{$setting.title}\n',
+            './chapter2.txt': '本文2\n'.encode('utf-8'),
+            './navigation.xhtml': '<ol>{$foreach.chapters}<li><a href="{$chapter.filePath}">{$chapter.title}</a></li>{$endforeach}</ol>',
+            './chapter.xhtml': '<html><body>{$chapter.body}</body></html>',
+        }
+
+        # 同じファイルから設定ファイルで作成した場合と同じ内容になる
+        for filepath, data in source_files.items():
+            with open(os.path.join(temp_dir, filepath), 'wb') as f:
+                f.write(data if type(data) is bytes else data.encode('utf-8'))
+        with open(os.path.join(temp_dir, 'setting.yaml'), 'w', encoding='utf-8') as f:
+            f.write(json.dumps(settings, ensure_ascii=False))
+        self.assertEqual(0, Batch().execute(['-i', os.path.join(temp_dir, 'setting.yaml'), '-o', os.path.join(temp_dir, 'expected.epub'), '-s', '1', '-c', '0']))
+
+        loggers = set(logging.Logger.manager.loggerDict.keys())
+        data = EpubBuilder(settings, source_files=source_files, base_dirpath=os.path.join(temp_dir, 'nothing'), options={'compress_level': '9'}).to_bytes()
+        with zipfile.ZipFile(os.path.join(temp_dir, 'expected.epub')) as f1, zipfile.ZipFile(io.BytesIO(data)) as f2:
+            self.assertEqual(f1.namelist(), f2.namelist())
+            self.assertEqual([f1.read(n) for n in f1.namelist()], [f2.read(n) for n in f2.namelist()])
+            self.assertEqual('<html><body>本文1<br />\nタイトル\n</body></html>', f2.read('OEBPS/contents_2.xhtml').decode('utf-8'))
+
+        # 設定値は変更しない、ロガーを登録しない、一時ファイル等を作成しない
+        self.assertEqual('./chapter1.txt', settings['resources']['chapters']['files'][0]['filePath'])
+        self.assertEqual(loggers, set(logging.Logger.manager.loggerDict.keys()))
+        self.assertFalse(os.path.exists(os.path.join(temp_dir, 'nothing')))
+
+        # シークできないストリームにも書き込める
+        class Stream(io.RawIOBase):
+            def __init__(self):
+                self.chunks = []
+            def writable(self):
+                return True
+            def write(self, data):
+                self.chunks.append(bytes(data))
+                return len(data)
+        stream = Stream()
+        EpubBuilder(settings, source_files=source_files, base_dirpath=temp_dir).write(stream)
+        with zipfile.ZipFile(io.BytesIO(data)) as f1, zipfile.ZipFile(io.BytesIO(b''.join(stream.chunks))) as f2:
+            self.assertEqual([f1.read(n) for n in f1.namelist()], [f2.read(n) for n in f2.namelist()])
+
+        # 設定ファイルのディレクトリのファイルとメモリ上のファイル（優先）から作成できる
+        data = EpubBuilder(setting_file=os.path.join(temp_dir, 'setting.yaml'), source_files={'./chapter2.txt': '差し替え'}).to_bytes()
+        with zipfile.ZipFile(io.BytesIO(data)) as f:
+            self.assertEqual('<html><body>差し替え\n</body></html>', f.read('OEBPS/contents_3.xhtml').decode('utf-8'))
+
+        # ファイルがない場合はBatchException
+        with self.assertRaises(BatchBase.BatchException):
+            EpubBuilder(settings, source_files={}, base_dirpath=os.path.join(temp_dir, 'nothing')).to_bytes()
+        with self.assertRaises(BatchBase.BatchException):
+            EpubBuilder(settings, options={'nothing': '1'})
+
+        # メディアタイプを判定できないファイルはBatchException（ファイル名を含む）
+        unknown_settings = copy.deepcopy(settings)
+        unknown_settings['resources']['images'] = [{'filePath': './cover.unknown', 'isCover': True}]
+        with self.assertRaisesRegex(BatchBase.BatchException, 'cover\\.unknown'):
+            EpubBuilder(unknown_settings, source_files=dict(source_files, **{'./cover.unknown': b'data'}), base_dirpath=temp_dir).to_bytes()
+
+
+class TestBuildServer(TestBase):
+    def test_execute(self):
+        '''
+        BuildServer.execute／BuildClient.execute
+        '''
+        temp_dir = self.create_temp_directory()
+        TestMultiBatch.create_book(self, temp_dir, 'book-a')
+        socket_path = os.path.join(temp_dir, 'server.sock')
+        script_path = os.path.join(os.path.dirname(__file__), 'epub_generator.py')
+        client_path = os.path.join(os.path.dirname(__file__), 'client_epub_generator.py')
+
+        server = subprocess.Popen([sys.executable, script_path, 'server', '-u', socket_path, '-w', '2', '-s', '1'])
+        try:
+            for _ in range(600):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.1)
+            self.assertTrue(os.path.exists(socket_path))
+
+            # コマンドラインで実行する場合と同じepubファイルを作成し、同じ戻り値を返す（相対パスはクライアントのカレントディレクトリから解決する）
+            clients = [subprocess.Popen([sys.executable, client_path, '-u', socket_path, '-i', 'setting.yaml', '-o', 'client{0}.epub'.format(i), '-c', '0'], cwd=temp_dir) for i in range(3)]
+            self.assertEqual([0, 0, 0], [client.wait() for client in clients])
+            process = subprocess.run([sys.executable, script_path, '-i', 'setting.yaml', '-o', 'cli.epub', '-s', '1', '-c', '0'], cwd=temp_dir)
+            self.assertEqual(0, process.returncode)
+            with zipfile.ZipFile(os.path.join(temp_dir, 'cli.epub')) as f1:
+                for i in range(3):
+                    with zipfile.ZipFile(os.path.join(temp_dir, 'client{0}.epub'.format(i))) as f2:
+                        self.assertEqual([f1.read(n) for n in f1.namelist()], [f2.read(n) for n in f2.namelist()])
+            for argv, return_code in [(['-i', 'nothing.yaml', '-o', 'x.epub'], 1), (['-i', 'setting.yaml'], 2), (['-i', 'setting.yaml', '-o', 'x.epub', '-w'], 1)]:
+                process = subprocess.run([sys.executable, client_path, '-u', socket_path] + argv, cwd=temp_dir, stderr=subprocess.PIPE)
+                self.assertEqual(return_code, process.returncode)
+                self.assertNotEqual(b'', process.stderr)
+
+            # 設定値から作成できる
+            settings = {
+                'bookId': '5a4ec2a4-4f5b-4a6e-9f44-6c59e6b5a0b1',
+                'title': 'book-b',
+                'modified': '2022-01-31T00:00:00Z',
+                'resources': {'chapters': {'files': [{'title': 'chapter', 'fileType': 'text', 'filePath': './chapter.txt'}]}},
+                'contents': [{'filePath': './chapter.xhtml', 'isNavigationContent': False, 'createByChaptersCount': True, 'useChapters': [{'chapterIndex': 1}]}],
+            }
+            response = BuildClient.send(socket_path, {'settings': settings, 'outputFile': 'settings.epub', 'baseDirectory': temp_dir})
+            self.assertEqual(0, response['returnCode'])
+            with zipfile.ZipFile(os.path.join(temp_dir, 'settings.epub')) as f:
+                self.assertIn('book-b', f.read('OEBPS/contents_1.xhtml').decode('utf-8'))
+            self.assertEqual(1, BuildClient.send(socket_path, {'settings': settings})['returnCode'])
+
+            # 停止するとソケットファイルを削除する
+            self.assertEqual(0, BuildClient.execute(['-u', socket_path, '--stop']))
+            self.assertEqual(0, server.wait(timeout=60))
+            self.assertFalse(os.path.exists(socket_path))
+            self.assertEqual(2, BuildClient.execute(['-u', socket_path, '-i', 'setting.yaml', '-o', 'x.epub']))
+        finally:
+            if server.poll() == None:
+                server.kill()
+                server.wait()
+
+
+class TestBenchmark(TestBase):
+    def test_execute(self):
+        '''
+        Benchmark.execute
+        '''
+        temp_dir = self.create_temp_directory()
+
+        # 同じパラメータからは同じプロジェクトを作成する
+        parameters = {'chapters': 3, 'chapterSize': 2, 'simpleRules': 6, 'regexRules': 6, 'images': 2, 'imageSize': 4, 'fanOut': 2}
+        setting_filepath = SyntheticBook(os.path.join(temp_dir, 'a'), parameters).create()
+        SyntheticBook(os.path.join(temp_dir, 'b'), parameters).create()
+        for filename in ['setting.yaml', os.path.join('chapter', '00003.txt'), os.path.join('image', '00002.png')]:
+            self.assertEqual(pathlib.Path(temp_dir, 'a', filename).read_bytes(), pathlib.Path(temp_dir, 'b', filename).read_bytes())
+
+        # 作成したプロジェクトからepubファイルを作成できる
+        epub_filepath = os.path.join(temp_dir, 'a.epub')
+        self.assertEqual(0, Batch().execute(['-i', setting_filepath, '-o', epub_filepath, '-s', '1', '-c', '0']))
+        with zipfile.ZipFile(epub_filepath) as f:
+            # 目次＋チャプター数×コンテンツファイル数
+            self.assertEqual(7, len([name for name in f.namelist() if name.startswith('OEBPS/contents_')]))
+            self.assertEqual(2, len([name for name in f.namelist() if name.endswith('.png')]))
+
+        # 結果をJSONファイルに出力する
+        output_filepath = os.path.join(temp_dir, 'result.json')
+        self.assertEqual(0, Benchmark().execute(['-p', '', '-c', 'chapters=2,chapterSize=1,images=1,imageSize=1', '-r', '2', '-o', output_filepath, '-w', os.path.join(temp_dir, 'work'), '-s', '1']))
+        with open(output_filepath, 'r', encoding='utf-8') as f:
+            report = json.load(f)
+        self.assertEqual(1, len(report['results']))
+        result = report['results'][0]
+        self.assertEqual('case-chapters2-chapterSize1-images1-imageSize1', result['name'])
+        self.assertEqual(2, len(result['runs']))
+        self.assertIn('load_chapter_files', result['runs'][0]['stages'])
+        self.assertGreater(result['outputSize'], 0)
+
+        # 不正なパラメータ
+        self.assertNotEqual(0, Benchmark().execute(['-p', 'nothing', '-o', output_filepath, '-s', '1']))
+        self.assertNotEqual(0, Benchmark().execute(['-p', '', '-c', 'nothing=1', '-o', output_filepath, '-s', '1']))
+
+
 if __name__ == '__main__':
     unittest.main()